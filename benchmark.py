@@ -0,0 +1,132 @@
+"""
+run canvas_tool commands against fake_canvas fixtures of increasing size and record how they scale.
+
+    python benchmark.py --sizes 50 --sizes 500 --sizes 5000 --output results.json --baseline previous.json
+
+for each fixture size and command this records wall time, the number of requests the server saw, and the
+peak memory of the canvas_tool process. with --baseline, results that got worse by more than --threshold
+are reported as regressions.
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import click
+
+from fake_canvas import Fixture, FakeCanvasServer
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# the commands to benchmark. the active course is CS146-01 and the finished one is CS146-02
+commands = {
+    "list-courses": ["list-courses"],
+    "list-students": ["list-students", "CS146-01"],
+    "collect-reference-info": ["collect-reference-info", "CS146"],
+    "min-grade-analyzer": ["min-grade-analyzer", "CS146"],
+    "export-letter-grade": ["export-letter-grade", "CS146-01", "grades.csv"],
+    "export-gradebook": ["export-gradebook", "CS146-01", "gradebook.csv"],
+    "set-letter-grade": ["set-letter-grade", "CS146-01"],
+    "grade-discussion": ["grade-discussion", "CS146-01", "Discussion 1"],
+    "set-fudge-points": ["set-fudge-points", "CS146-01", "Quiz 1"],
+    "quiz": ["quiz", "CS146-01", "Quiz 1"],
+    "message-students": ["message-students", "CS146-01", "benchmark", "--message", "hello", "Ada Lovelace 0000",
+                         "Alan Lovelace 0001"],
+    "download-submissions": ["download-submissions", "CS146-01", "Programming 1", "--no-dryrun"],
+    "code-similarity": ["code-similarity", "CS146-01", "Programming 1", "py"],
+    "download-course-content": ["download-course-content", "SP26: CS146-01", "--all", "--no-dryrun"],
+    # discussions are left out since upload_discussions can't parse the files download_discussions writes
+    "upload-course-content": ["upload-course-content", "SP26: CS146-01", "--modules", "--pages", "--files"],
+}
+
+
+def max_rss_bytes(usage):
+    # linux reports kilobytes, macos reports bytes
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+
+def run_command(server, ini, workdir, args, timeout):
+    server.reset_stats()
+    with tempfile.TemporaryFile() as stderr, tempfile.TemporaryDirectory("canvas_tool.data") as data:
+        # each run starts with empty caches so commands are measured cold
+        env = {**os.environ, "CANVAS_TOOL_INI": ini, "CANVAS_TOOL_DATA": data, "PYTHONPATH": here}
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(here, "canvas_tool.py")] + args, cwd=workdir,
+                                   env=env, stdout=subprocess.DEVNULL, stderr=stderr)
+        timer = threading.Timer(timeout, process.kill)
+        timer.start()
+        # wait4 rather than wait so we get the resource usage of just this process
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        timer.cancel()
+        process.returncode = os.waitstatus_to_exitcode(status)
+        stderr.seek(0)
+        errors = stderr.read().decode(errors="replace").strip()
+    stats = server.stats_snapshot()
+    return {"seconds": round(elapsed, 3), "requests": sum(stats.get("requests", {}).values()),
+            "throttled": sum(stats.get("throttled", {}).values()),
+            "peak_mb": round(max_rss_bytes(usage) / 2 ** 20, 1), "exit": process.returncode,
+            "error": errors.splitlines()[-1] if errors and process.returncode else None}
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for size, by_command in results.items():
+        for command, result in by_command.items():
+            old = baseline.get(size, {}).get(command)
+            if not old:
+                continue
+            for metric in ("seconds", "requests", "peak_mb"):
+                if old.get(metric) and result.get(metric) and result[metric] > old[metric] * threshold:
+                    regressions.append(f"{command} @ {size} students: {metric} {old[metric]} -> {result[metric]}")
+    return regressions
+
+
+@click.command()
+@click.option("--sizes", multiple=True, type=int, default=[50, 500, 5000], show_default=True,
+              help="number of students in the fixture. can be repeated")
+@click.option("--command", "selected", multiple=True, type=click.Choice(list(commands)),
+              help="only run these commands. can be repeated")
+@click.option("--latency", default=0.0, show_default=True, help="seconds the server delays each response")
+@click.option("--timeout", default=600, show_default=True, help="seconds before a command is killed")
+@click.option("--output", type=click.Path(dir_okay=False, writable=True), help="write the results as json")
+@click.option("--baseline", type=click.File("r"), help="json results of an earlier run to compare against")
+@click.option("--threshold", default=1.25, show_default=True, help="ratio over the baseline that is a regression")
+def benchmark(sizes, selected, latency, timeout, output, baseline, threshold):
+    """benchmark canvas_tool commands against local fake canvas fixtures"""
+    results = {}
+    for size in sizes:
+        click.echo(f"building a {size} student fixture")
+        server = FakeCanvasServer(Fixture(size), latency=latency).start()
+        results[str(size)] = {}
+        with tempfile.TemporaryDirectory("canvas_tool.bench") as workdir:
+            ini = os.path.join(workdir, "canvas_tool.ini")
+            with open(ini, "w") as fd:
+                fd.write(server.config_ini())
+            click.echo(f"{'command':24} {'seconds':>9} {'requests':>9} {'throttled':>9} {'peak MB':>8}")
+            for name, args in commands.items():
+                if selected and name not in selected:
+                    continue
+                result = run_command(server, ini, workdir, args, timeout)
+                results[str(size)][name] = result
+                click.echo(f"{name:24} {result['seconds']:9.2f} {result['requests']:9} {result['throttled']:9} "
+                           f"{result['peak_mb'] or 0:8.1f}" + (f"  exit {result['exit']}: {result['error']}"
+                                                                if result['exit'] else ""))
+        server.shutdown()
+        server.server_close()
+    if output:
+        with open(output, "w") as fd:
+            json.dump(results, fd, indent=2)
+    if baseline:
+        regressions = compare(results, json.load(baseline), threshold)
+        for regression in regressions:
+            click.echo(click.style(f"regression: {regression}", fg="red"))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,102 @@
+"""
+benchmark core.count_words and core.count_words_batch against the original word counter on a synthetic
+discussion corpus and check that every count matches.
+
+    python benchmark_words.py --entries 20000
+"""
+import random
+import re
+import string
+import time
+from html.parser import HTMLParser
+
+import click
+
+import core
+
+vocabulary = ["the", "a", "of", "algorithm", "complexity", "recursion", "pointer", "linked", "list", "rhythm", "xyz",
+              "brrr", "queue", "éléphant", "naïve", "straße", "data_structure", "O(n)", "n^2", "2024", "IOU", "aeiou",
+              "strengths", "i", "tree", "hashmap", "it's", "don't", "e.g.", "résumé", "hmm", "shh", "Θ", "log2"]
+markup = ["<p>", "</p>", "<br>", "<b>", "</b>", "&nbsp;", "&amp;", "<a href='x'>", "</a>", "<li>", "\n", "&lt;"]
+
+
+def entry(rng):
+    parts = []
+    for _ in range(rng.randint(0, 200)):
+        parts.append(rng.choice(vocabulary) if rng.random() < 0.8 else rng.choice(markup))
+        if rng.random() < 0.1:
+            parts.append(rng.choice(string.punctuation))
+    return " ".join(parts)
+
+
+# the word counter as it was before it was reworked, kept to check the results still match
+def reference_maybe_a_word(word):
+    if not word.isalpha():
+        return False
+
+    word = word.strip().lower()
+    vowels = [x for x in word if x in "aeiou"]
+    if not vowels:
+        return False
+
+    ratio = round(len(word) / len(vowels), 1)
+    return 1.5 <= ratio <= 8.0
+
+
+class ReferenceWordCounter(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.checked_word_count = 0
+        self.word_count = 0
+
+    def handle_data(self, data):
+        data.translate(str.maketrans('', '', string.punctuation))
+        words = re.findall(r'\w+', data)
+        self.word_count += len(words)
+        self.checked_word_count += len(set([w for w in words if reference_maybe_a_word(w)]))
+
+
+def reference_count_words(content):
+    wc = ReferenceWordCounter()
+    wc.feed(content)
+    return wc.checked_word_count
+
+
+def timed(label, func, baseline=None):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    click.echo(f"{label:28} {elapsed:8.3f}s" + (f"  {baseline / elapsed:5.1f}x" if baseline else ""))
+    return result, elapsed
+
+
+@click.command()
+@click.option("--entries", default=20000, show_default=True, help="number of discussion entries in the corpus")
+@click.option("--processes", type=int, help="processes used by count_words_batch. defaults to the cpu count")
+@click.option("--seed", default=146, show_default=True)
+def benchmark_words(entries, processes, seed):
+    """benchmark the word counter used to grade discussions"""
+    rng = random.Random(seed)
+    corpus = [entry(rng) for _ in range(entries)]
+    click.echo(f"{entries} entries, {sum(len(c) for c in corpus) / 2 ** 20:.1f} MiB")
+    expected, baseline = timed("original", lambda: [reference_count_words(c) for c in corpus])
+    results = {
+        "count_words": timed("count_words", lambda: [core.count_words(c) for c in corpus], baseline)[0],
+        "count_words_batch": timed("count_words_batch", lambda: core.count_words_batch(corpus, processes),
+                                   baseline)[0],
+    }
+    mismatched = False
+    for name, counts in results.items():
+        differences = [i for i, (e, c) in enumerate(zip(expected, counts)) if e != c]
+        if differences or len(counts) != len(expected):
+            mismatched = True
+            click.echo(click.style(f"{name} differs from the original on {len(differences)} entries, "
+                                   f"for example {corpus[differences[0]]!r}" if differences else
+                                   f"{name} returned {len(counts)} counts", fg="red"))
+    if mismatched:
+        raise SystemExit(1)
+    click.echo("all counts match")
+
+
+if __name__ == "__main__":
+    benchmark_words()
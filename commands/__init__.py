@@ -3,6 +3,7 @@ __all__ = [
     "collect_reference_info",
     "download_canvas_course",
     "download_submissions",
+    "export_gradebook",
     "export_letter_grade",
     "grade_discussion",
     "help_me_setup",
@@ -1,5 +1,34 @@
-from core import *
 import glob
+import io
+import shutil
+
+from core import *
+
+def download_course_submissions(course, assignment_name, tempdir, journal, show_progress=True):
+    """ download the submissions of each student into a directory named for them under the course's id in tempdir """
+    assignment = get_assignment(course, assignment_name)
+    usermap = {e.id: e.name for e in get_roster(course)}
+    submissions = list(paginated(assignment.get_submissions()))
+    # progress bars of courses downloaded at the same time would garble each other
+    with click.progressbar(length=len(submissions), label="downloading", item_show_func=lambda x: x,
+                           file=None if show_progress else io.StringIO()) as bar:
+        for sub in submissions:
+            if sub.user_id not in usermap or ("submission", sub.id) in journal:
+                continue
+            # students in different courses can have the same name
+            udir = os.path.join(tempdir, str(course.id), usermap[sub.user_id])
+            os.makedirs(udir, exist_ok=True)
+            bar.update(1, usermap[sub.user_id])
+            for attachment in sub.attachments:
+                aname = f"{udir}/{attachment.filename}"
+                with traced(f"download {attachment.filename}", "transfer"), atomic_open(aname, "wb") as f:
+                    f.write(get_session().get(attachment.url).content)
+                if aname.endswith(".zip"):
+                    with profiled("zip extraction"), zipfile.ZipFile(aname, "r") as zf:
+                        zf.extractall(udir)
+            journal.record("submission", sub.id)
+    info(f"downloaded {len(submissions)} submissions from {course.name}")
+
 
 @canvas_tool.command()
 @click.argument('course_name', metavar='course')
@@ -8,7 +37,9 @@ import glob
 @click.option('--dryrun/--no-dryrun', default=True, show_default=True, help="only show the grade, don't actually set it")
 @click.option('--pause/--no-pause', default=False, show_default=True, help="pause before uploading")
 @click.option('--multiple/--no-multiple', default=False, show_default=True, help="collect submissions from multiple classes")
-def code_similarity(course_name, language, assignment_name, dryrun, pause, multiple):
+@click.option('--resume/--no-resume', default=False, show_default=True,
+              help="continue an interrupted run, keeping the submissions it already downloaded")
+def code_similarity(course_name, language, assignment_name, dryrun, pause, multiple, resume):
     '''
     check submissions for code similarity using stanford MOSS.
     '''
@@ -28,26 +59,17 @@ def code_similarity(course_name, language, assignment_name, dryrun, pause, multi
     moss_userid = parser['MOSS']['userid']
 
     moss = mosspy.Moss(moss_userid, language)
-    with tempfile.TemporaryDirectory("canvas_tool.attach") as tempdir:
-        for course in courses:
-            assignment = get_assignment(course, assignment_name)
-            usermap = {u.id: u.name for u in course.get_users()}
-            submissions = list(assignment.get_submissions())
-            with click.progressbar(length=len(submissions), label="downloading", item_show_func=lambda x: x) as bar:
-                for sub in assignment.get_submissions():
-                    if sub.user_id not in usermap:
-                        continue
-                    udir = f"{tempdir}/{usermap[sub.user_id]}"
-                    os.makedirs(udir)
-                    bar.update(1, usermap[sub.user_id])
-                    for attachment in sub.attachments:
-                        aname = f"{udir}/{attachment.filename}"
-                        with open(aname, "wb") as f:
-                            f.write(requests.get(attachment.url).content)
-                        if aname.endswith(".zip"):
-                            with zipfile.ZipFile(aname, "r") as zf:
-                                zf.extractall(udir)
-        files_to_upload = [x for x in glob.glob(f"{tempdir}/**/*.{language}") if '/__MACOSX/' not in x]
+    with Journal("code-similarity", *[c.id for c in courses], assignment_name, resume=resume) as journal:
+        # downloads are kept under data_dir rather than a temporary directory so an interrupted run can resume
+        tempdir = os.path.join(data_dir, "code_similarity", journal.name)
+        if not journal.done and os.path.exists(tempdir):
+            shutil.rmtree(tempdir)
+        os.makedirs(tempdir, exist_ok=True)
+        _, failures = for_each_course(courses, lambda course: download_course_submissions(
+            course, assignment_name, tempdir, journal, show_progress=len(courses) == 1))
+        # the downloads that finished are journaled, so --resume only fetches the failed courses again
+        exit_on_course_failures(courses, failures)
+        files_to_upload = [x for x in glob.glob(f"{tempdir}/**/*.{language}", recursive=True) if '/__MACOSX/' not in x]
         info(f"uploading {files_to_upload}")
 
         if pause:
@@ -62,3 +84,4 @@ def code_similarity(course_name, language, assignment_name, dryrun, pause, multi
                 moss_url = moss.send(on_send=lambda fp, dn: bar.update(1, dn))
             info(f"results at {moss_url}")
             info(f"download with: wget -k -e robots=off -np -r {moss_url}")
+        shutil.rmtree(tempdir)
@@ -1,5 +1,68 @@
 from core import *
 
+grades_fields = """
+    nodes { currentScore enrollment { user { name } } }
+    pageInfo { hasNextPage endCursor }
+"""
+
+grades_query = """
+query grades($courseid: ID!, $cursor: String, $first: Int) {
+    course(id: $courseid) {
+        assignmentGroupsConnection(first: $first, after: $cursor) {
+            nodes { id name gradesConnection(first: $first) { """ + grades_fields + """ } }
+            pageInfo { hasNextPage endCursor }
+        }
+    }
+}
+"""
+
+grades_nested = {"gradesConnection": GraphQLConnection(
+    "assignmentGroup(id: $id) { gradesConnection(first: $first, after: $cursor) { " + grades_fields + " } }",
+    "gradesConnection")}
+
+def open_grade_archive():
+    """ final assignment group scores of finished courses. their grades don't change, so each is fetched once """
+    db = open_database("grade_archive")
+    db.executescript("""
+        create table if not exists courses (course_id integer primary key, name text, archived_at text);
+        create table if not exists grades (course_id integer, student text, category text, score real);
+        create index if not exists grades_by_student on grades (course_id, student);
+        create virtual table if not exists students using fts5 (student, course_id unindexed);
+    """)
+    return db
+
+
+def fetch_course_grades(canvas, course):
+    info(f"archiving grades of {course.name}")
+    rows = []
+    for assignment_group in graphql_nodes(canvas, grades_query, "course.assignmentGroupsConnection",
+                                          {"courseid": course.id}, nested=grades_nested):
+        for grade in assignment_group['gradesConnection']['nodes']:
+            if grade['currentScore'] is not None:
+                rows.append((course.id, grade['enrollment']['user']['name'], assignment_group['name'],
+                             grade['currentScore']))
+    return rows
+
+
+def archive_course(db, course, rows):
+    with db:
+        db.executemany("insert into grades values (?, ?, ?, ?)", rows)
+        db.executemany("insert into students values (?, ?)", [(name, course.id) for name in
+                                                               dict.fromkeys(r[1] for r in rows)])
+        db.execute("insert into courses values (?, ?, ?)",
+                   (course.id, course.name, datetime.datetime.now(datetime.timezone.utc).isoformat()))
+
+
+def search_students(db, student, course_ids):
+    """ the (course_id, student) pairs whose name has words starting with each of the words in student """
+    words = re.findall(r'\w+', student)
+    if not words:
+        return []
+    match = " ".join('"' + w.replace('"', '""') + '"*' for w in words)
+    return [(c, name) for name, c in db.execute("select student, course_id from students where students match ?",
+                                                (match,)) if c in course_ids]
+
+
 @canvas_tool.command()
 @click.argument("course")
 @click.option('-t', 'thresholds', metavar='threshold', multiple=True, default=[84, 90, 95], show_default=True,
@@ -12,34 +75,56 @@ from core import *
               show_default=True, help="""
               assignment groups with the listed keywords will not be collected.
               """)
-def collect_reference_info(course, thresholds, skip):
-    '''collect high level information about students of previous classes to help writing reference letters'''
+@click.option('--student', help="only show students with names containing words that start with these words")
+@click.option('--offline/--no-offline', default=False, show_default=True,
+              help="only use courses already in the local grade archive without accessing canvas")
+def collect_reference_info(course, thresholds, skip, student, offline):
+    '''
+    collect high level information about students of previous classes to help writing reference letters
+
+    grades of finished courses are kept in a local archive, so each course is only fetched from canvas once.
+    '''
     Grade = namedtuple('Grade', ['category', 'grade'])
-    canvas = get_canvas_object()
-    for course in get_courses(canvas, course, is_active=False, is_finished=True):
-        results = canvas.graphql('query { course(id: "' + str(course.id) + '''") {
-              assignmentGroupsConnection {
-                  nodes { name
-                          gradesConnection {
-                              edges { node { currentScore
-                                             enrollment { user { name } }
-                                           } } } } } } }''')
-        grades_by_student = defaultdict(list)
+    db = open_grade_archive()
+    if offline:
+        courses = [(course_id, name) for course_id, name in db.execute("select course_id, name from courses")
+                   if course in name]
+    else:
+        canvas = get_canvas_object()
+        archived = {course_id for course_id, in db.execute("select course_id from courses")}
+        finished = get_courses(canvas, course, is_active=False, is_finished=True)
+        to_archive = [c for c in finished if c.id not in archived]
+        # each course is archived as it arrives, so a course that fails doesn't cost the others
+        _, failures = for_each_course(to_archive, lambda c: fetch_course_grades(canvas, c),
+                                      on_result=lambda c, rows: archive_course(db, c, rows))
+        courses = [(c.id, c.name) for c in finished]
 
-        for assignment_group in results['data']['course']['assignmentGroupsConnection']['nodes']:
-            category = assignment_group['name']
+    selected = defaultdict(list)
+    if student:
+        for course_id, name in search_students(db, student, {c for c, _ in courses}):
+            selected[course_id].append(name)
+    for course_id, course_name in courses:
+        if student:
+            rows = [row for name in selected[course_id] for row in db.execute(
+                "select student, category, score from grades where course_id = ? and student = ? order by rowid",
+                (course_id, name))]
+        else:
+            rows = db.execute("select student, category, score from grades where course_id = ? order by rowid",
+                              (course_id,))
+        grades_by_student = defaultdict(list)
+        for name, category, score in rows:
             if any(x in category.lower() for x in skip):
                 continue
-            for grade in assignment_group['gradesConnection']['edges']:
-                score = grade['node']['currentScore']
-                name = grade['node']['enrollment']['user']['name']
-                if score:
-                    pluses = to_plus(score, thresholds)
-                    if pluses:
-                        grades_by_student[name].append(Grade(category, pluses))
+            if score:
+                pluses = to_plus(score, thresholds)
+                if pluses:
+                    grades_by_student[name].append(Grade(category, pluses))
         for i in grades_by_student.items():
-            label = f'{i[0]}@{format_course_name(course.name)}'
+            label = f'{i[0]}@{format_course_name(course_name)}'
             output(f'{label} {" ".join([g.category + ":" + g.grade for g in i[1]])}')
+    db.close()
+    if not offline:
+        exit_on_course_failures(to_archive, failures)
 
 def to_plus(grade, levels):
     """ convert a score to a list of pluses based on grade """
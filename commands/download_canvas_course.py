@@ -1,21 +1,39 @@
+import io
+
 from commands.upload_canvas_course import page_name_to_url
 from core import *
 from md2fhtml import *
 
 
-def download_modules(course, target, dryrun):
+def write_content(path, content, journal, unit):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with atomic_open(path) as fd:
+        fd.write(content)
+    journal.record(*unit)
+
+
+def download_file(file, target, journal):
+    # download next to the target and move it into place so a partial file is never left behind
+    part = f"{target}.part"
+    with traced(f"download {file}", "transfer", size=getattr(file, "size", None)):
+        file.download(part)
+    os.replace(part, target)
+    journal.record("file", file.id)
+
+
+@traced("download_modules")
+def download_modules(course, target, dryrun, journal, plan):
     def base_inner_module_to_str(module_item):
         return f'{"  " * (module_item.indent + 1)}* {sanitize(module_item.title)}; {module_item.type}{"" if module_item.published else "; published=False"}'
 
     def named_inner_module_to_str(module_item):
-        module_item_target_name = None
         if hasattr(module_item, 'content_id'):
-            module_item_target_name = rr4id[module_item.type + str(module_item.content_id)].name
+            rr = rr4id.get(module_item.type + str(module_item.content_id))
         else:
-            module_item_target_name = rr4url[module_item.page_url].name
-
-        if module_item_target_name == module_item.title:
-            module_item_target_name = None
+            rr = rr4url.get(module_item.page_url)
+        if not rr:
+            warn(f"could not find the {module_item.type} for {module_item.title}, using the item title")
+        module_item_target_name = rr.name if rr and rr.name != module_item.title else None
 
         return f'{base_inner_module_to_str(module_item)}{f"; target={module_item_target_name}" if module_item_target_name else ""}'
 
@@ -33,52 +51,63 @@ def download_modules(course, target, dryrun):
         "ExternalTool": external_tool,
     }
 
-    top_modules = []
+    if ("modules", target) in journal:
+        return
     id2name = {}
-    output = ''
-    for module in course.get_modules():
-        id2name[module.id] = module.name
-        ms = f"# {module.name}"
-        if module.unlock_at:
-            ms += f"; unlock={module.unlock_at}"
-        if module.require_sequential_progress:
-            ms += f"; sequential"
-        if module.prerequisite_module_ids:
-            ms += f"; prereqs={','.join([id2name[id] for id in module.prerequisite_module_ids])}"
-        if hasattr(module, "completed_at") and module.completed_at:
-            ms += f"; completed={module.completed_at}"
-        if not module.published:
-            ms += f"; published=False"
-        output += ms + '\n'
-        for item in module.get_module_items():
-            if item.type in module_renderers:
-                output += module_renderers[item.type](item) + '\n'
-            else:
-                warn(f"cannot render {item.__dict__}")
-
-    if dryrun:
-        info(f"would have written:\n{output}to {target}")
-    else:
-        with open(target, "w") as fd:
-            fd.write(output)
+    items_counts = {}
+    with (io.StringIO() if dryrun else atomic_open(target)) as fd:
+        for module in get_modules_with_items(course):
+            id2name[module.id] = module.name
+            items_counts[module.name] = module.items_count
+            ms = f"# {module.name}"
+            if module.unlock_at:
+                ms += f"; unlock={module.unlock_at}"
+            if module.require_sequential_progress:
+                ms += f"; sequential"
+            if module.prerequisite_module_ids:
+                ms += f"; prereqs={','.join([id2name.get(id, str(id)) for id in module.prerequisite_module_ids])}"
+            if hasattr(module, "completed_at") and module.completed_at:
+                ms += f"; completed={module.completed_at}"
+            if not module.published:
+                ms += f"; published=False"
+            fd.write(ms + '\n')
+            for item in module_items(module):
+                if item.type in module_renderers:
+                    fd.write(module_renderers[item.type](item) + '\n')
+                else:
+                    warn(f"cannot render {item.__dict__}")
+        if dryrun:
+            info(f"would have written:\n{fd.getvalue()}to {target}")
+            if plan is not None:
+                plan.add("write", path=target, content=fd.getvalue(), unit=["modules", target])
+                plan.depends_on("Modules", list(items_counts))
+                for name, items_count in items_counts.items():
+                    plan.depends_on(f"Module {name}", items_count)
+    journal.record("modules", target)
 
 
-def download_discussions(course, target, dryrun):
+@traced("download_discussions")
+def download_discussions(course, target, dryrun, journal, plan):
     os.makedirs(target, exist_ok=True)
-    for discussion in course.get_discussion_topics():
+    for discussion in paginated(course.get_discussion_topics()):
         # windows can't have : in the filename :'(
         target_file = os.path.join(target, discussion.title.strip().replace("\\", "-").replace(":", ";") + ".md")
+        if ("discussion", discussion.id) in journal:
+            continue
         if os.path.exists(target_file):
             info(f"{target_file} already exists for {discussion.title}")
         else:
             if dryrun:
                 info(f"would download {target_file} for {discussion.title}")
+                if plan is not None:
+                    plan.add("write", path=target_file, content=f"# {discussion.title}\n" + html2mdstr(discussion.message),
+                             unit=["discussion", discussion.id])
+                    plan.depends_on(f"Discussion {discussion.title}", getattr(discussion, "updated_at", None))
             else:
                 info(f"downloading {target_file} for {discussion.title}")
-                with open(target_file, "w+") as fd:
-                    fd.write(f"# {discussion.title}\n")
-                    # todo: we need to fix up the links based on the rr maps
-                    fd.write(html2mdstr(discussion.message))
+                # todo: we need to fix up the links based on the rr maps
+                write_content(target_file, f"# {discussion.title}\n" + html2mdstr(discussion.message), journal,
+                              ["discussion", discussion.id])
 
 
 def download_assignments(course, target, dryrun):
@@ -90,33 +119,43 @@ def fix_links(text):
     return re.sub(r"\(https://\w+.instructure.com/courses/\w+/pages/([^ )]+)( [^\)]*)\)", r"(\1)", text)
 
 
-def download_pages(course, target, dryrun):
+def page_markdown(page):
+    lines = f"published: {page.published}\n"
+    if page.publish_at:
+        lines += f"publish_at: {page.publish_at}\n"
+    if page.front_page:
+        lines += f"front_page: {page.front_page}\n"
+    return lines + f"title: {page.title}\n" + fix_links(html2mdstr(page.body))
+
+
+@traced("download_pages")
+def download_pages(course, target, dryrun, journal, plan):
     os.makedirs(target, exist_ok=True)
-    for page in course.get_pages(include=["body"]):
+    for page in paginated(course.get_pages(include=["body"])):
+        if ("page", page.page_id) in journal:
+            continue
         url = page_name_to_url(page.title)
         if page.url != url:
             warn(f"calculated page url for {page.title} ({url}) does not equal {page.url}")
         if dryrun:
             info(f"would download {page.title} to {url}")
+            if plan is not None:
+                plan.add("write", path=os.path.join(target, url) + ".md", content=page_markdown(page),
+                         unit=["page", page.page_id])
+                plan.depends_on(f"Page {page.title}", getattr(page, "updated_at", None))
         else:
-            with open(os.path.join(target, url) + ".md", "w+") as fd:
-                fd.write(f"published: {page.published}\n")
-                if page.publish_at:
-                    fd.write(f"publish_at: {page.publish_at}\n")
-                if page.front_page:
-                    fd.write(f"front_page: {page.front_page}\n")
-                fd.write(f"title: {page.title}\n")
-                fd.write(fix_links(html2mdstr(page.body)))
+            write_content(os.path.join(target, url) + ".md", page_markdown(page), journal, ["page", page.page_id])
 
 
-def download_files(course, target, dryrun):
+@traced("download_files")
+def download_files(course, target, dryrun, journal, plan):
     class ToDownload(NamedTuple):
         file: canvasapi.file.File
         target: str
 
     error_seen = False
     to_download = []
-    for folder in course.get_folders():
+    for folder in paginated(course.get_folders()):
         target_dir = os.path.join(target, str(folder))
         if os.path.exists(target_dir):
             if not os.path.isdir(target_dir):
@@ -129,11 +168,17 @@ def download_files(course, target, dryrun):
             else:
                 os.makedirs(target_dir)
 
-        for file in folder.get_files():
+        for file in paginated(folder.get_files()):
+            if ("file", file.id) in journal:
+                continue
             full_name = os.path.join(str(folder), str(file))
             target_file = os.path.join(target_dir, str(file))
             if dryrun:
                 info(f"would download {full_name} to {target_file}")
+                if plan is not None and not os.path.exists(target_file):
+                    plan.add("download", file_id=file.id, url=file.url, name=str(file), size=file.size,
+                             path=target_file, unit=["file", file.id])
+                    plan.depends_on(f"File {full_name}".replace("\\", "/"), getattr(file, "updated_at", None))
             else:
                 if os.path.exists(target_file):
                     warn(f"{target_file} already exists. skipping")
@@ -144,7 +189,7 @@ def download_files(course, target, dryrun):
         with click.progressbar(to_download, label="downloading",
                                item_show_func=lambda i: str(i.file) if i else "") as tds:
             for td in tds:
-                td.file.download(td.target)
+                download_file(td.file, td.target, journal)
     if error_seen:
         exit(2)
 
@@ -153,6 +198,27 @@ def download_announcements(course, target, dryrun):
     pass
 
 
+def apply_download_plan(course, plan, dryrun, journal):
+    steps = [step for step in plan.steps if step["unit"] not in journal]
+    if dryrun:
+        for step in steps:
+            info(f"would write {step['path']}" if step["action"] == "write" else
+                 f"would download {step['name']} to {step['path']}")
+        return
+    for step in steps:
+        if step["action"] == "write":
+            info(f"writing {step['path']}")
+            write_content(step["path"], step["content"], journal, step["unit"])
+    downloads = [step for step in steps if step["action"] == "download"]
+    if downloads:
+        with click.progressbar(downloads, label="downloading", item_show_func=lambda s: s["name"] if s else "") as bar:
+            for step in bar:
+                os.makedirs(os.path.dirname(step["path"]), exist_ok=True)
+                file = canvasapi.file.File(course._requester, {"id": step["file_id"], "url": step["url"],
+                                                               "display_name": step["name"], "size": step["size"]})
+                download_file(file, step["path"], journal)
+
+
 @canvas_tool.command()
 @click.argument('course_name', metavar='course')
 @click.option('--dryrun/--no-dryrun', default=True, show_default=True, help="show what would happen, but don't do it.")
@@ -171,12 +237,28 @@ def download_announcements(course, target, dryrun):
 @click.option('--all/--no-all', default=False, show_default=True,
               help="download all content to corresponding directories")
 @click.option("--target", default='.', show_default=True, help="download content parent directory.")
+@click.option("--resume/--no-resume", default=False, show_default=True,
+              help="continue an interrupted download, skipping what it finished")
+@click.option("--plan-out", type=click.Path(dir_okay=False),
+              help="with --dryrun, save what would be written, already converted, to this file")
+@click.option("--apply", "plan_file", type=click.Path(exists=True, dir_okay=False),
+              help="write what was saved by --plan-out, if the pages and files haven't changed since")
 def download_course_content(course_name, dryrun, modules, discussions, assignments, pages, files, announcements, all,
-                            target):
+                            target, resume, plan_out, plan_file):
     """download course content from local files"""
+    check_plan_options(dryrun, plan_out, plan_file)
     canvas = get_canvas_object()
     course = get_course(canvas, course_name, is_active=False)
     output(f"found {course.name}")
+
+    if plan_file:
+        plan = Plan.load(plan_file, "download-course-content", course.id, os.path.abspath(target))
+        plan.check(content_versions(course, plan.versions))
+        with Journal("download-course-content", course.id, os.path.abspath(target), resume=resume,
+                     dryrun=dryrun) as journal:
+            apply_download_plan(course, plan, dryrun, journal)
+        return
+
     map_course_resource_records(course)
 
     if all:
@@ -186,15 +268,20 @@ def download_course_content(course_name, dryrun, modules, discussions, assignmen
         error("nothing selected to download")
         exit(1)
 
-    if modules:
-        download_modules(course, os.path.join(target, 'modules'), dryrun)
-    if discussions:
-        download_discussions(course, os.path.join(target, 'discussions'), dryrun)
-    if assignments:
-        download_assignments(course, os.path.join(target, 'assignments'), dryrun)
-    if pages:
-        download_pages(course, os.path.join(target, 'pages'), dryrun)
-    if files:
-        download_files(course, os.path.join(target, 'files'), dryrun)
-    if announcements:
-        download_announcements(course, os.path.join(target, 'announcements'), dryrun)
+    plan = Plan("download-course-content", course.id, os.path.abspath(target)) if plan_out else None
+    with Journal("download-course-content", course.id, os.path.abspath(target), resume=resume,
+                 dryrun=dryrun) as journal:
+        if modules:
+            download_modules(course, os.path.join(target, 'modules'), dryrun, journal, plan)
+        if discussions:
+            download_discussions(course, os.path.join(target, 'discussions'), dryrun, journal, plan)
+        if assignments:
+            download_assignments(course, os.path.join(target, 'assignments'), dryrun)
+        if pages:
+            download_pages(course, os.path.join(target, 'pages'), dryrun, journal, plan)
+        if files:
+            download_files(course, os.path.join(target, 'files'), dryrun, journal, plan)
+        if announcements:
+            download_announcements(course, os.path.join(target, 'announcements'), dryrun)
+    if plan is not None:
+        plan.save(plan_out)
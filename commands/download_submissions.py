@@ -1,13 +1,71 @@
 from core import *
 
+comments_fields = """
+    nodes { _id comment attachments { _id url displayName } }
+    pageInfo { hasNextPage endCursor }
+"""
+
+submissions_query = """
+query submissions($assignmentid: ID!, $cursor: String, $first: Int, $since: DateTime) {
+    assignment(id: $assignmentid) {
+        submissionsConnection(first: $first, after: $cursor, filter: {updatedSince: $since}) {
+            nodes { id submittedAt updatedAt attachments { _id url displayName } user { name }
+                    commentsConnection(first: $first) { """ + comments_fields + """ }
+            }
+            pageInfo { hasNextPage endCursor }
+        }
+    }
+}
+"""
+
+submissions_nested = {"commentsConnection": GraphQLConnection(
+    "node(id: $id) { ... on Submission { commentsConnection(first: $first, after: $cursor) { " + comments_fields + " } } }",
+    "commentsConnection")}
+
+
+def load_sync_cursor(path, target):
+    """
+    the sync cursor of the last --since-last run: the newest updatedAt it saw, and for each submission its
+    submittedAt, updatedAt and the files it was written to, mapped to the attachment or comment in each.
+    """
+    if os.path.exists(path):
+        with open(path) as fd:
+            cursor = json.load(fd)
+        if cursor["target"] == target:
+            return cursor
+        info(f"the last run downloaded to {cursor['target']}: downloading everything")
+    return {"target": target, "since": None, "submissions": {}}
+
+
+def submission_files(s):
+    """ the files a submission is written to, mapped to the key of the attachment or comment each one holds """
+    files = {}
+    for count, a in enumerate(s['attachments'], 1):
+        files[f"submission{count}{os.path.splitext(a['displayName'])[1]}"] = (f"attachment {a['_id']}", a)
+    for count, c in enumerate(s['commentsConnection']['nodes'], 1):
+        files[f"comment{count}.txt"] = (f"comment {c['_id']}", c)
+        for subcount, ca in enumerate(c['attachments'], 1):
+            files[f"comment{count}attachment{subcount}{os.path.splitext(ca['displayName'])[1]}"] = \
+                (f"attachment {ca['_id']}", ca)
+    return files
+
+
 @canvas_tool.command()
 @click.argument('course_name', metavar='course')
 @click.argument('assignment_name', metavar='assignment', default='')
 @click.option('--dryrun/--no-dryrun', default=True, show_default=True,
               help="only show the grade, don't actually set it")
-def download_submissions(course_name, assignment_name, dryrun):
+@click.option('--resume/--no-resume', default=False, show_default=True,
+              help="continue an interrupted download, skipping the submissions it finished")
+@click.option('--since-last/--no-since-last', default=False, show_default=True,
+              help="only fetch the submissions that changed since the last --since-last run and only download "
+                   "new attachments")
+def download_submissions(course_name, assignment_name, dryrun, resume, since_last):
     '''
     download submissions for an assignment.
+
+    with --since-last, the files of a resubmission replace the ones of the attempt it replaces, so the
+    directory ends up the same as downloading everything again.
     '''
 
     canvas = get_canvas_object()
@@ -16,53 +74,74 @@ def download_submissions(course_name, assignment_name, dryrun):
 
     assignment = get_assignment(course, assignment_name)
 
-    query = """
-    query submissions($assignmentid: ID!) {
-        assignment(id: $assignmentid) { submissionsConnection {
-            nodes { attachments { url displayName } user { name }
-                    commentsConnection { nodes { comment attachments { url displayName}}}
-            }
-        }}
-    }
-    """
-    result = canvas.graphql(query, {"assignmentid": assignment.id})
-    submissions = result['data']['assignment']['submissionsConnection']['nodes']
-
-    if dryrun:
-        info(f"{len(submissions)} submissions to download")
-        sys.exit(0)
-
-    with click.progressbar(length=len(submissions), label="downloading submission", show_pos=True) as bar:
-        for s in submissions:
-            count = 1
-            name = s['user']['name']
-            dir = os.path.join(assignment_name, name.replace(' ', '-'))
-            os.makedirs(dir, exist_ok=True)
-            for a in s['attachments']:
-                download_attachment(f'{dir}/submission{count}', a)
-                count += 1
-            count = 1
-            for c in s['commentsConnection']['nodes']:
-                with open(os.path.join(dir, f"comment{count}.txt"), 'w') as fd:
-                    fd.write(c['comment'])
-                subcount = 1
-                for ca in c['attachments']:
-                    download_attachment(f'{dir}/comment{count}attachment{subcount}', ca)
-                    subcount += 1
-                count += 1
-            bar.update(1)
-
-
-
-def download_attachment(basename, a):
-    fname = a['displayName']
-    suffix = os.path.splitext(fname)[1]
+    cursor_path = os.path.join(data_dir, "download_submissions", f"{canvas_host()}-{course.id}-{assignment.id}.json")
+    cursor = load_sync_cursor(cursor_path, os.path.abspath(assignment_name)) if since_last else None
+    since = cursor["since"] if cursor else None
+
+    submissions = list(graphql_nodes(canvas, submissions_query, "assignment.submissionsConnection",
+                                     {"assignmentid": assignment.id, "since": since}, nested=submissions_nested))
+    if since_last:
+        # submissions seen at the cursor time come back again, so leave out the ones that didn't change
+        submissions = [s for s in submissions
+                       if s['updatedAt'] != cursor["submissions"].get(s['id'], {}).get("updated_at")]
+
+    with Journal("download-submissions", course.id, assignment.id, os.path.abspath(assignment_name), resume=resume,
+                 dryrun=dryrun) as journal:
+        submissions = [s for s in submissions if ("submission", s['id']) not in journal]
+        if dryrun:
+            info(f"{len(submissions)} submissions to download")
+            sys.exit(0)
+
+        synced = []
+        try:
+            with click.progressbar(length=len(submissions), label="downloading submission", show_pos=True) as bar:
+                for s in submissions:
+                    downloaded = True
+                    name = s['user']['name']
+                    dir = os.path.join(assignment_name, name.replace(' ', '-'))
+                    os.makedirs(dir, exist_ok=True)
+                    previous = cursor["submissions"].get(s['id'], {}).get("files", {}) if cursor else {}
+                    files = submission_files(s)
+                    for file, (key, item) in files.items():
+                        path = os.path.join(dir, file)
+                        if previous.get(file) == key and os.path.exists(path):
+                            continue
+                        if key.startswith("comment"):
+                            with atomic_open(path) as fd:
+                                fd.write(item['comment'])
+                        else:
+                            downloaded &= download_attachment(path, item)
+                    for file in set(previous) - set(files):
+                        # left over from an attempt that has been replaced
+                        if os.path.exists(os.path.join(dir, file)):
+                            os.remove(os.path.join(dir, file))
+                    # a submission with a failed download is tried again on resume
+                    if downloaded:
+                        journal.record("submission", s['id'])
+                        synced.append(s)
+                        if cursor:
+                            cursor["submissions"][s['id']] = {
+                                "submitted_at": s['submittedAt'], "updated_at": s['updatedAt'],
+                                "files": {file: key for file, (key, _) in files.items()}}
+                    bar.update(1)
+            if cursor and len(synced) == len(submissions):
+                # a submission with a failed download keeps the cursor where it was, so the next run fetches it again
+                cursor["since"] = max([since or ""] + [s['updatedAt'] or "" for s in synced]) or None
+        finally:
+            if cursor:
+                os.makedirs(os.path.dirname(cursor_path), exist_ok=True)
+                with atomic_open(cursor_path) as fd:
+                    json.dump(cursor, fd)
+
+
+def download_attachment(filename, a):
     durl = a['url']
     info(f'downloading {a}')
-    with requests.get(durl) as response:
+    with traced(f"download {a['displayName']}", "transfer"), get_session().get(durl) as response:
         if response.status_code != 200:
             error(f'error {response.status_code} fetching {durl}')
-            return
-        with open(f"{basename}{suffix}", "wb") as fd:
+            return False
+        with atomic_open(filename, "wb") as fd:
             for chunk in response.iter_content():
                 fd.write(chunk)
+    return True
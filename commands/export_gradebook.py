@@ -0,0 +1,101 @@
+import csv
+
+from core import *
+
+gradebook_fields = ["user_id", "student", "sis_user_id", "assignment_id", "assignment", "points_possible", "score",
+                    "grade", "submitted_at", "graded_at", "late", "missing", "excused", "seconds_late",
+                    "workflow_state"]
+
+
+def gradebook_rows(course):
+    """ yield a row of gradebook_fields for each student and assignment, a page of students at a time """
+    assignments = {a.id: a for a in paginated(course.get_assignments())}
+    for student in paginated(course.get_multiple_submissions(student_ids=["all"], grouped=True), stream=True):
+        entry = get_roster_entry(course, student.user_id)
+        for s in student.submissions:
+            assignment = assignments.get(s.assignment_id)
+            yield [s.user_id, entry.name if entry else None, entry.sis_user_id if entry else None, s.assignment_id,
+                   getattr(assignment, "name", None), getattr(assignment, "points_possible", None),
+                   getattr(s, "score", None), getattr(s, "grade", None), getattr(s, "submitted_at", None),
+                   getattr(s, "graded_at", None), bool(getattr(s, "late", False)),
+                   bool(getattr(s, "missing", False)), bool(getattr(s, "excused", False)),
+                   getattr(s, "seconds_late", None), getattr(s, "workflow_state", None)]
+
+
+def write_csv(rows, output_file):
+    with click.open_file(output_file, "w") as fd:
+        writer = csv.writer(fd)
+        writer.writerow(gradebook_fields)
+        count = 0
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_parquet(rows, output_file, batch_size=10000):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        error("parquet output needs pyarrow. install it with: pip install pyarrow")
+        sys.exit(2)
+
+    timestamp = pa.timestamp("s", tz="UTC")
+    schema = pa.schema([("user_id", pa.int64()), ("student", pa.string()), ("sis_user_id", pa.string()),
+                        ("assignment_id", pa.int64()), ("assignment", pa.string()),
+                        ("points_possible", pa.float64()), ("score", pa.float64()), ("grade", pa.string()),
+                        ("submitted_at", timestamp), ("graded_at", timestamp), ("late", pa.bool_()),
+                        ("missing", pa.bool_()), ("excused", pa.bool_()), ("seconds_late", pa.int64()),
+                        ("workflow_state", pa.string())])
+
+    def parse_date(value):
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")) if value else None
+
+    def write_batch(writer, batch):
+        columns = [list(c) for c in zip(*batch)]
+        for i in (gradebook_fields.index("submitted_at"), gradebook_fields.index("graded_at")):
+            columns[i] = [parse_date(v) for v in columns[i]]
+        writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+
+    count = 0
+    with pq.ParquetWriter(output_file, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                write_batch(writer, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            write_batch(writer, batch)
+            count += len(batch)
+    return count
+
+
+@canvas_tool.command()
+@click.argument("course")
+@click.argument("output_file", type=click.Path(dir_okay=False, allow_dash=True))
+@click.option("--format", "output_format", type=click.Choice(["csv", "parquet"]),
+              help="output format. defaults to parquet for .parquet files and csv otherwise")
+def export_gradebook(course, output_file, output_format):
+    '''
+    export every student's submission to every assignment.
+
+    there is a row for each student and assignment with the score, grade, late and missing flags, and
+    submission times. rows are written as the submissions are fetched, and only a page of submissions is
+    held at a time. what grows with the size of the course is just the roster of names and ids.
+    an output file name of - will go to stdout.
+    '''
+    canvas = get_canvas_object()
+    course = get_course(canvas, course)
+    if not output_format:
+        output_format = "parquet" if output_file.endswith(".parquet") else "csv"
+    if output_format == "parquet" and output_file == "-":
+        error("parquet output needs a file name")
+        sys.exit(2)
+
+    rows = gradebook_rows(course)
+    count = write_parquet(rows, output_file) if output_format == "parquet" else write_csv(rows, output_file)
+    if output_file != "-":
+        info(f"{count} records written to {output_file}")
@@ -1,3 +1,5 @@
+import csv
+
 from core import *
 
 @canvas_tool.command()
@@ -22,12 +24,23 @@ def export_letter_grade(course, csv_output_file):
         exit(2)
 
     count = 0
-    csv_output_file.write("Student ID,Grade\n")
-    for submission in rlg_assignment.get_submissions():
-        user = course.get_user(submission.user_id)
-        if user.sis_user_id:
-            csv_output_file.write(f"{user.sis_user_id}, {submission.grade}\n")
-            count += 1
+    writer = csv.writer(csv_output_file)
+    writer.writerow(["Student ID", "Grade"])
+    for submission in paginated(rlg_assignment.get_submissions()):
+        student = get_roster_entry(course, submission.user_id)
+        if not student:
+            # users whose enrollment was deleted are not in even a fresh roster
+            try:
+                student = course.get_user(submission.user_id)
+            except CanvasException:
+                warn(f"leaving out the grade of user {submission.user_id}: they are not in the course")
+                continue
+        sis_user_id = getattr(student, "sis_user_id", None)
+        if not sis_user_id:
+            warn(f"leaving out the grade of {student.name} ({submission.user_id}): they don't have a student id")
+            continue
+        writer.writerow([sis_user_id, submission.grade])
+        count += 1
 
     info(f"{count} records written to {csv_output_file.name}")
 
@@ -1,5 +1,170 @@
+from canvasapi.submission import Submission
+
 from core import *
 
+def fetch_view(course, topic_id, retries=4, delay=1.0):
+    """
+    fetch the full view of a discussion topic, which has every entry and reply in one payload. canvas answers
+    503 while it builds the cached view, so wait for it a few times and return None if it never shows up.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return course._requester.request("GET", f"courses/{course.id}/discussion_topics/{topic_id}/view").json()
+        except CanvasException as e:
+            if "status code 503" not in str(e):
+                raise
+        if attempt < retries:
+            info(f"the full view of discussion {topic_id} is being built, retrying in {delay * 2 ** attempt:.0f}s")
+            time.sleep(delay * 2 ** attempt)
+    return None
+
+
+def view_entries(view):
+    """ yield (entry, is_reply) for each entry and reply in the full view of a discussion topic """
+    def walk(entry, is_reply):
+        if not entry.get("deleted") and "user_id" in entry:
+            yield entry, is_reply
+        for reply in entry.get("replies", []):
+            yield from walk(reply, True)
+
+    for entry in view.get("view", []):
+        yield from walk(entry, False)
+
+
+def load_grading_state(path, options):
+    """
+    the state of the last grading run: the entries already counted and the grades already posted.
+    entries map an entry id to [user_id, is_reply, updated_at, words], where words is None for late entries.
+    students map a user id to [computed grade, posted grade].
+    """
+    if path and os.path.exists(path):
+        with open(path) as fd:
+            state = json.load(fd)
+        if state["options"] == options:
+            return state
+        info("grading options changed since the last run: regrading everyone")
+        students = {k: [None, posted] for k, (_, posted) in state["students"].items()} if state["students"] else None
+        return {**state, "options": options, "entries": {}, "students": students}
+    return {"options": options, "entries": {}, "students": None, "synced_at": None}
+
+
+def grading_state_path(course, assignment):
+    return os.path.join(data_dir, "grade_discussion", f"{canvas_host()}-{course.id}-{assignment.id}.json")
+
+
+def assignment_key(assignment):
+    return f"assignment {assignment.name} ({assignment.id})"
+
+
+def assignment_version(assignment):
+    """ the assignment's updated_at and the last reply to its discussion, which change when its grades could """
+    return [getattr(assignment, "updated_at", None),
+            (getattr(assignment, "discussion_topic", None) or {}).get("last_reply_at")]
+
+
+def post_grades(course, assignment, step):
+    """ post the grades of a plan step, then save the grading state that goes with them """
+    grades = step["grades"]
+    if step["bulk"]:
+        if grades:
+            progress = assignment.submissions_bulk_update(
+                grade_data={int(user_id): {"posted_grade": grade} for user_id, grade in grades.items()})
+            wait_for_progress(progress)
+        info(f"posted {len(grades)} grades")
+    else:
+        with click.progressbar(grades.items(), label="updating grades", show_pos=True) as bar:
+            for user_id, grade in bar:
+                Submission(course._requester, {"course_id": course.id, "assignment_id": assignment.id,
+                                               "user_id": user_id}).edit(submission={'posted_grade': grade})
+
+    state = step.get("state")
+    if state:
+        for user_id, grade in grades.items():
+            state["students"][user_id][1] = grade
+        state["synced_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        path = grading_state_path(course, assignment)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fd:
+            json.dump(state, fd)
+
+
+def grade_from_view(course, assignment, view, due_at_date, dryrun, min_words, points_comment, max_points,
+                    incremental, plan):
+    path = grading_state_path(course, assignment)
+    state = load_grading_state(path if incremental else None, [min_words, points_comment, max_points])
+    entries = state["entries"]
+
+    # only entries that are new or edited since the last run need their words counted
+    seen = set()
+    changed = []
+    for entry, is_reply in view_entries(view):
+        key = str(entry["id"])
+        seen.add(key)
+        updated_at = entry.get("updated_at") or entry["created_at"]
+        if key not in entries or entries[key][2] != updated_at:
+            changed.append((entry, is_reply, updated_at))
+    affected = {entries[key][0] for key in set(entries) - seen}
+    for key in set(entries) - seen:
+        del entries[key]
+
+    on_time = []
+    for entry, is_reply, updated_at in changed:
+        created_at_date = DiscussionEntry(None, entry).created_at_date
+        entries[str(entry["id"])] = [entry["user_id"], is_reply, updated_at, None]
+        affected.add(entry["user_id"])
+        if created_at_date > due_at_date:
+            info(f"skipping discussion from {entry['user_id']} submitted at {created_at_date} but due {due_at_date}")
+        else:
+            on_time.append(entry)
+    for entry, words in zip(on_time, count_words_batch(e.get("message") or "" for e in on_time)):
+        entries[str(entry["id"])][3] = words
+
+    table = defaultdict(lambda: [0, 0])
+    for user_id, is_reply, _, words in entries.values():
+        if words is not None and words >= min_words:
+            table[user_id][is_reply] += 1
+
+    students = state["students"]
+    if students is None:
+        # nothing has been posted by this tool yet, so start from the grades that are in canvas
+        students = {str(s.user_id): [None, s.score] for s in paginated(assignment.get_submissions())}
+    roster = get_roster(course)
+    posters = {user_id for user_id, _, _, _ in entries.values()}
+    if posters - set(roster.by_id) and not roster.fresh:
+        # students who enrolled since the roster was saved
+        roster = get_roster(course, max_age=0)
+    for user_id in sorted(posters - set(roster.by_id)):
+        warn(f"not grading the entries of user {user_id}: they are not in the course roster")
+    roster = [e for e in roster if e.active_student]
+    to_post = {}
+    for student in roster:
+        computed, posted = students.get(str(student.id), [None, None])
+        if computed is None or student.id in affected:
+            posts, replies = table[student.id]
+            computed = min(points_comment * (min(posts, 1) + min(replies, 1)), max_points)
+        students[str(student.id)] = [computed, posted]
+        if computed != posted:
+            to_post[student] = computed
+
+    info(f"{len(changed)} new or edited entries, {len(to_post)} of {len(roster)} grades changed.")
+
+    if incremental:
+        state["students"] = students
+    plan.add("post", assignment_id=assignment.id, bulk=True,
+             grades={str(student.id): grade for student, grade in to_post.items()},
+             state=state if incremental else None)
+    plan.depends_on(assignment_key(assignment), assignment_version(assignment))
+
+    if dryrun:
+        info("would have posted:")
+        for student, grade in to_post.items():
+            posts, replies = table[student.id]
+            info(f"    {student.name} ({student.id}) {grade}: {posts} posts, {replies} replies")
+        return
+
+    post_grades(course, assignment, plan.steps[-1])
+
+
 @canvas_tool.command()
 @click.argument('course_name', metavar='course')
 @click.argument('assignment_name', metavar='assignment', default='')
@@ -8,12 +173,22 @@ from core import *
 @click.option('--min-words', default=5, show_default=True, help="the minimum number of valid words to get credit")
 @click.option('--points-comment', default=1, show_default=True, help="number of points for posting a comment")
 @click.option('--max-points', default=2, show_default=True, help="maximum number of points to give")
-def grade_discussion(course_name, assignment_name, dryrun, min_words, points_comment, max_points):
+@click.option('--full-view/--no-full-view', default=True, show_default=True,
+              help="grade from one fetch of the whole discussion rather than the entries of each submission")
+@click.option('--incremental/--no-incremental', default=True, show_default=True,
+              help="with --full-view, only count entries that are new since the last run and only post grades "
+                   "that changed")
+@click.option("--plan-out", type=click.Path(dir_okay=False), help="with --dryrun, save the grades to post to this file")
+@click.option("--apply", "plan_file", type=click.Path(exists=True, dir_okay=False),
+              help="post the grades saved by --plan-out, if the discussions haven't changed since")
+def grade_discussion(course_name, assignment_name, dryrun, min_words, points_comment, max_points, full_view,
+                     incremental, plan_out, plan_file):
     '''
     grade a discussion assignment based on participation.
 
     one point is added for a post and another for a reply for a total of 2.
     this tool assumes that the student must post first to reply.
+    with --no-full-view, each entry gets a point, since posts and replies can't be told apart.
 
     course_name - any part of an active course name. for example, 249 will match CS249.
     the course must active (it has not passed the end date) to be eligible for matching.
@@ -23,10 +198,25 @@ def grade_discussion(course_name, assignment_name, dryrun, min_words, points_com
     match will be used.
     '''
 
+    check_plan_options(dryrun, plan_out, plan_file)
     canvas = get_canvas_object()
 
     course = get_course(canvas, course_name)
 
+    if plan_file:
+        plan = Plan.load(plan_file, "grade-discussion", course.id, assignment_name)
+        assignments = {step["assignment_id"]: course.get_assignment(step["assignment_id"]) for step in plan.steps}
+        plan.check({assignment_key(a): assignment_version(a) for a in assignments.values()})
+        for step in plan.steps:
+            assignment = assignments[step["assignment_id"]]
+            if dryrun:
+                info(f"would post {len(step['grades'])} grades to {assignment.name}")
+            else:
+                info(f"grading {assignment.name}")
+                post_grades(course, assignment, step)
+        return
+
+    plan = Plan("grade-discussion", course.id, assignment_name)
     now = datetime.datetime.now(datetime.timezone.utc)
     assignments = get_assignments(course, assignment_name)
     for assignment_data in assignments:
@@ -36,7 +226,18 @@ def grade_discussion(course_name, assignment_name, dryrun, min_words, points_com
         if due_at_date > now:
             warn(f"{assignment_data['title']} not due: skipping")
             continue
-        submissions = assignment.get_submissions()
+        topic = getattr(assignment, "discussion_topic", None)
+        if full_view and topic and topic.get("group_category_id"):
+            # the entries of a group discussion are in the topics of each group, not in the course level view
+            info(f"{assignment.name} is a group discussion: grading from the entries of each submission")
+        elif full_view and topic:
+            view = fetch_view(course, topic["id"])
+            if view is not None:
+                grade_from_view(course, assignment, view, due_at_date, dryrun, min_words, points_comment,
+                                max_points, incremental, plan)
+                continue
+            warn(f"the full view of {assignment.name} isn't ready: grading from the entries of each submission")
+        submissions = paginated(assignment.get_submissions())
         grades = {}
         skipped = 0
         processed = 0
@@ -58,7 +259,7 @@ def grade_discussion(course_name, assignment_name, dryrun, min_words, points_com
                     info(
                         f"skipping discussion from {s.user_id} submitted at {entry.created_at_date} but due {due_at_date}")
                     continue
-                if count_words(entry.message) > 5:
+                if count_words(entry.message) >= min_words:
                     grade = min(grade + points_comment, max_points)
 
             grades[s] = grade
@@ -69,12 +270,16 @@ def grade_discussion(course_name, assignment_name, dryrun, min_words, points_com
 
         info(f"processed {processed}, skipped {skipped}.")
 
+        plan.add("post", assignment_id=assignment.id, bulk=False,
+                 grades={str(s.user_id): grade for s, grade in grades.items()})
+        plan.depends_on(assignment_key(assignment), assignment_version(assignment))
+
         if dryrun:
             info("would have posted:")
             for i in grades.items():
                 info(f"    {i[0]} {i[1]}")
         else:
-            with click.progressbar(length=len(grades), label="updating grades", show_pos=True) as bar:
-                for i in grades.items():
-                    i[0].edit(submission={'posted_grade': i[1]})
-                    bar.update(1)
+            post_grades(course, assignment, plan.steps[-1])
+
+    if plan_out:
+        plan.save(plan_out)
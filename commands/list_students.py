@@ -1,5 +1,16 @@
 from core import *
 
+students_query = """
+query students($courseid: ID!, $emails: Boolean!, $cursor: String, $first: Int) {
+    course(id: $courseid) {
+        enrollmentsConnection(first: $first, after: $cursor) {
+            nodes { user { name email @include(if: $emails) } }
+            pageInfo { hasNextPage endCursor }
+        }
+    }
+}
+"""
+
 @canvas_tool.command()
 @click.argument('course')
 @click.option('--active/--inactive', default=True, help="show only active courses")
@@ -9,11 +20,8 @@ def list_students(course, active, emails):
     canvas = get_canvas_object()
     course = get_course(canvas, course, active)
     output(f"found {course.name}")
-    info_keys = "name" + (" email" if emails else "")
-    results = canvas.graphql('query { course(id: "' + str(course.id) + '''") {
-               enrollmentsConnection { nodes { user {''' + info_keys + '''} } }
-           } }''')
-    for r in results['data']['course']['enrollmentsConnection']['nodes']:
+    for r in graphql_nodes(canvas, students_query, "course.enrollmentsConnection",
+                           {"courseid": course.id, "emails": emails}):
         user = r['user']
         if emails:
             output(f"    {user['email']} {user['name']} ")
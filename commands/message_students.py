@@ -1,5 +1,35 @@
 from core import *
 
+def running_batch_ids(canvas):
+    return {b['id'] for b in canvas.conversations_get_running_batches()}
+
+
+def wait_for_conversation_batch(canvas, subject, before, poll=1.0, timeout=600, start_timeout=10):
+    """
+    wait for the async conversation batch sending subject to finish.
+
+    batches don't say what they are sending, so the batch is the one that wasn't in before, the ids of the
+    batches running when it was started. it can take a moment to be listed, so it is waited for up to
+    start_timeout seconds. one that isn't listed by then is taken to have already finished.
+    """
+    start_deadline = time.time() + start_timeout
+    deadline = time.time() + timeout
+    seen = False
+    while True:
+        batches = [b for b in canvas.conversations_get_running_batches() if b['id'] not in before]
+        failed = [b for b in batches if b.get('workflow_state') == 'error']
+        if failed:
+            raise CanvasException(f"sending {subject} failed with {failed[0].get('completion')} complete")
+        running = [b for b in batches if b.get('workflow_state') != 'completed']
+        seen = seen or bool(batches)
+        if not running and (seen or time.time() > start_deadline):
+            return
+        if time.time() > deadline:
+            warn(f"{subject} is still being sent: {', '.join(str(b.get('completion')) for b in running)} complete")
+            return
+        time.sleep(poll)
+
+
 @canvas_tool.command()
 @click.argument('course')
 @click.argument('subject')
@@ -7,8 +37,10 @@ from core import *
               help='include the course name in []s in the subject line')
 @click.option('--message', help="message to send")
 @click.option('--from-file', help="file containing message to send (- for stdin)", type=click.File('r'))
+@click.option('--bulk/--no-bulk', default=True, show_default=True,
+              help='send to all the students in one background batch rather than one message at a time')
 @click.argument('students', nargs=-1, required=True)
-def message_students(course, subject, message, course_in_subject, from_file, students):
+def message_students(course, subject, message, course_in_subject, from_file, bulk, students):
     '''message students in a course'''
     canvas = get_canvas_object()
     course = get_course(canvas, course)
@@ -29,20 +61,52 @@ def message_students(course, subject, message, course_in_subject, from_file, stu
 
     found_error = False
     to_message = []
+    roster = get_roster(course)
     for student in students:
-        users = list(course.get_users(search_term=student))
+        users = roster.search(student, students_only=True)
+        if not len(users) and not roster.fresh:
+            # the student may have been added since the roster was saved
+            roster = get_roster(course, max_age=0)
+            users = roster.search(student, students_only=True)
         if not len(users):
             error(f"could not find {student}")
             found_error = True
             continue
-        elif len(users) > 1:
-            error(f"multiple matches for {student}: {', '.join([str(u) for u in users])}")
+        exact = [u for u in users if u.name.lower() == student.lower()]
+        if len(exact) == 1:
+            users = exact
+        if len(users) > 1:
+            error(f"multiple matches for {student}: {', '.join([f'{u.name} ({u.id})' for u in users])}")
             found_error = True
             continue
-        to_message.append(users[0])
+        if users[0] not in to_message:
+            to_message.append(users[0])
     if found_error:
         sys.exit(2)
 
-    for user in to_message:
+    if bulk and len(to_message) > 1:
+        before = running_batch_ids(canvas)
+        try:
+            # bulk_message sends each recipient their own conversation, and async sends them as a background batch
+            canvas.create_conversation([user.id for user in to_message], message_to_send, subject=subject,
+                                       group_conversation=True, bulk_message=True, mode='async')
+        except CanvasException as e:
+            warn(f"bulk send failed ({e}), sending one at a time")
+        else:
+            try:
+                wait_for_conversation_batch(canvas, subject, before)
+            except CanvasException as e:
+                # canvas doesn't say which messages of a failed batch went out
+                error(f"{e}. some of these students may not have gotten it:")
+                for user in to_message:
+                    error(f"    {user.name} ({user.id})")
+                sys.exit(2)
+            info(f"sent {subject} to {len(to_message)} students")
+            return
+
+    def send(user):
         # we set group_conversation to true to make sure it shows up as a new conversation
-        canvas.create_conversation([user.id], message_to_send, subject=subject, group_conversation=True)
\ No newline at end of file
+        canvas.create_conversation([user.id], message_to_send, subject=subject, group_conversation=True)
+
+    for user, _ in concurrently(send, to_message):
+        info(f"sent {subject} to {user.name}")
\ No newline at end of file
@@ -1,3 +1,6 @@
+import csv
+import heapq
+
 import click
 
 from core import *
@@ -54,6 +57,102 @@ def get_question_group(quiz, question_groups, group_id):
     return question_groups[group_id]
 
 
+def open_event_store():
+    db = open_database("quiz_events")
+    db.execute("""create table if not exists events (
+                      quiz_id integer, submission_id integer, attempt integer, event_id integer,
+                      event_type text, created_at text, event_data text,
+                      primary key (quiz_id, submission_id, attempt, event_id))""")
+    # attempts whose events are all in the events table. attempts still in progress are never added
+    db.execute("""create table if not exists attempts (
+                      quiz_id integer, submission_id integer, attempt integer,
+                      primary key (quiz_id, submission_id, attempt))""")
+    return db
+
+
+def fetch_events(submission):
+    return [(getattr(e, 'id', i), e.event_type, getattr(e, 'created_at', None), json.dumps(e.event_data))
+            for i, e in enumerate(paginated(submission.get_submission_events(attempt=submission.attempt)))]
+
+
+def sync_events(db, quiz, submissions):
+    """ fetch the events of the submission attempts that are not already in the event store """
+    stored = {(s, a) for s, a in db.execute("select submission_id, attempt from attempts where quiz_id = ?",
+                                             (quiz.id,))}
+    missing = [s for s in submissions if (s.id, s.attempt) not in stored]
+    if missing:
+        with click.progressbar(length=len(missing), label="fetching events", file=sys.stderr) as bar:
+            for s, events in concurrently(fetch_events, missing):
+                with db:
+                    db.execute("delete from events where quiz_id = ? and submission_id = ? and attempt = ?",
+                               (quiz.id, s.id, s.attempt))
+                    db.executemany("insert into events values (?, ?, ?, ?, ?, ?, ?)",
+                                   [(quiz.id, s.id, s.attempt) + e for e in events])
+                    if getattr(s, 'workflow_state', None) in ('complete', 'pending_review'):
+                        db.execute("insert or replace into attempts values (?, ?, ?)", (quiz.id, s.id, s.attempt))
+                bar.update(1)
+
+
+def stored_events(db, quiz, submission):
+    """ yield (event_type, created_at, event_data) for the stored events of a submission attempt in order """
+    for event_type, created_at, event_data in db.execute(
+            """select event_type, created_at, event_data from events
+               where quiz_id = ? and submission_id = ? and attempt = ? order by event_id""",
+            (quiz.id, submission.id, submission.attempt)):
+        yield event_type, created_at, json.loads(event_data)
+
+
+def answered_questions(db, quiz, submission, questions, question_groups):
+    """ yield (position, answered_at, answer, question) for each answer in a submission in the order given """
+    for event_type, created_at, event_data in stored_events(db, quiz, submission):
+        if event_type != 'question_answered':
+            continue
+        if not type(event_data) is list:
+            event_data = [event_data]
+        for e in event_data:
+            if e['answer']:
+                question = questions[int(e['quiz_question_id'])]
+                if question.quiz_group_id:
+                    position = f"{get_question_group(quiz, question_groups, question.quiz_group_id).position:2}.{question.position:2}"
+                else:
+                    position = f"{question.position:5}"
+                yield position, created_at, dehtml(e['answer']), question.question_text
+
+
+def summarized_answers(answers, summarize, final_answer):
+    """
+    the streaming version of the --summarize and --final-answer filtering for the answers of one submission.
+
+    only the latest answer to each question is held, and it is dropped if the next answer to the question
+    doesn't evolve from it. whatever is left when the submission ends are the final answers.
+    """
+    pending = {}
+    for answer in answers:
+        prev = pending.get(answer[0])
+        if prev and (not summarize or evolves(answer[2], prev[2])):
+            yield prev
+        pending[answer[0]] = answer
+    if not final_answer:
+        yield from pending.values()
+
+
+def externally_sorted(rows, key, chunk_size=10000):
+    """ sort json serializable rows using temporary files for runs of chunk_size rows so memory stays bounded """
+    with contextlib.ExitStack() as stack:
+        runs = []
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                run = stack.enter_context(tempfile.TemporaryFile("w+"))
+                run.writelines(json.dumps(r) + "\n" for r in sorted(chunk, key=key))
+                run.seek(0)
+                runs.append(map(json.loads, run))
+                chunk = []
+        chunk.sort(key=key)
+        yield from heapq.merge(*runs, chunk, key=key)
+
+
 @canvas_tool.command()
 @click.argument('course_name', metavar='course')
 @click.argument('quiz_name', metavar='quiz', default='')
@@ -64,7 +163,10 @@ def get_question_group(quiz, question_groups, group_id):
               help='show only completed answers. skip answers that are a prefix of subsequent answers')
 @click.option('--final-answer/--no-final-answer', default=True, show_default=True,
               help='show the final answer, if --no-final-answer, the final answers will be skipped')
-def quiz(course_name, quiz_name, show_question, for_student, summarize, final_answer):
+@click.option('--format', 'output_format', type=click.Choice(['text', 'jsonl', 'csv']), default='text',
+              show_default=True, help='jsonl and csv stream the log one submission at a time in bounded memory')
+@click.option('--output', type=click.File('w'), default='-', help='file to write the log to')
+def quiz(course_name, quiz_name, show_question, for_student, summarize, final_answer, output_format, output):
     '''
     get quiz logs for a student
     '''
@@ -74,12 +176,12 @@ def quiz(course_name, quiz_name, show_question, for_student, summarize, final_an
 
     students = [s.lower() for s in for_student]
 
-    users = {u.id : u.name for u in course.get_users() if len(students) == 0 or [s for s in students if s in u.name.lower()]}
+    users = {e.id : e.name for e in get_roster(course) if e.active_student and (len(students) == 0 or [s for s in students if s in e.name.lower()])}
     if len(users) == 0:
         error(f"no students matched {students}")
         exit(2)
 
-    quiz = [q for q in course.get_quizzes() if quiz_name in q.title]
+    quiz = [q for q in paginated(course.get_quizzes()) if quiz_name in q.title]
     if len(quiz) == 0:
         error(f"no quizzes matched {quiz_name}")
         exit(2)
@@ -93,28 +195,40 @@ def quiz(course_name, quiz_name, show_question, for_student, summarize, final_an
 
     answers = []
 
-    questions = {q.id: q for q in quiz.get_questions()}
+    questions = {q.id: q for q in paginated(quiz.get_questions())}
     question_groups = {}
-    for s in quiz.get_submissions():
-        if s.user_id not in users:
-            continue
-        prev = None
-        for es in s.get_submission_events():
-            time_spent = int(s.time_spent)
-            if es.event_type != 'question_answered':
-                continue
-            event_data = es.event_data
-            if not type(event_data) is list:
-                event_data = [event_data]
-            for e in event_data:
-                if e['answer']:
-                    question = questions[int(e['quiz_question_id'])]
-                    if question.quiz_group_id:
-                        position = f"{get_question_group(quiz, question_groups, question.quiz_group_id).position:2}.{question.position:2}"
-                    else:
-                        position = f"{question.position:5}"
-                    data = (users[s.user_id], position, f"{time_spent//60:02}:{time_spent%60:02}", dehtml(e['answer']), question.question_text)
-                    answers.append(data)
+    submissions = [s for s in paginated(quiz.get_submissions()) if s.user_id in users]
+    db = open_event_store()
+    sync_events(db, quiz, submissions)
+
+    if output_format != 'text':
+        def rows():
+            for s in submissions:
+                time_spent = int(s.time_spent)
+                answered = answered_questions(db, quiz, s, questions, question_groups)
+                if summarize or final_answer:
+                    answered = summarized_answers(answered, summarize, final_answer)
+                for position, answered_at, answer, question_text in answered:
+                    yield [users[s.user_id], position.strip(), f"{time_spent//60:02}:{time_spent%60:02}", answered_at,
+                           answer, dehtml(question_text) if show_question else None]
+
+        fields = ['student', 'position', 'time_spent', 'answered_at', 'answer', 'question']
+        writer = csv.writer(output) if output_format == 'csv' else None
+        if writer:
+            writer.writerow(fields)
+        for row in externally_sorted(rows(), key=lambda r: (r[3] or '', r[0], r[1])):
+            if writer:
+                writer.writerow(row)
+            else:
+                output.write(json.dumps(dict(zip(fields, row))) + "\n")
+        db.close()
+        return
+
+    for s in submissions:
+        time_spent = int(s.time_spent)
+        for position, answered_at, answer, question_text in answered_questions(db, quiz, s, questions, question_groups):
+            answers.append((users[s.user_id], position, f"{time_spent//60:02}:{time_spent%60:02}", answer, question_text))
+    db.close()
 
     if summarize or final_answer:
         answers.sort(reverse=True)
@@ -137,4 +251,4 @@ def quiz(course_name, quiz_name, show_question, for_student, summarize, final_an
 
     answers.sort(key=lambda x: x[2])
     for a in answers:
-        print(f"{a[1]} {a[2]} {a[0]} {a[3]} {a[4] if show_question else ''}")
+        print(f"{a[1]} {a[2]} {a[0]} {a[3]} {a[4] if show_question else ''}", file=output)
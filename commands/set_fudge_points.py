@@ -1,5 +1,83 @@
+import csv
+
 from core import *
 
+
+def read_fudge_points_csv(course, csv_file):
+    """
+    read student,points rows and return {user_id: points}. students can be given by user id, SIS id, or name.
+    exits if any student can't be resolved to exactly one person in the course.
+    """
+    roster = get_roster(course)
+    by_sis_id = {e.sis_user_id.lower(): e for e in roster if e.sis_user_id}
+    targets = {}
+    found_error = False
+    for line, row in enumerate(csv.reader(csv_file), 1):
+        if not row or not "".join(row).strip():
+            continue
+        if len(row) < 2:
+            error(f"line {line}: expected student,points but got {','.join(row)}")
+            found_error = True
+            continue
+        student, points = row[0].strip(), row[1].strip()
+        try:
+            points = float(points)
+        except ValueError:
+            if line > 1:
+                error(f"line {line}: {points} is not a number")
+                found_error = True
+            # otherwise it is the header
+            continue
+        if student.isdigit() and roster.get(int(student)):
+            matches = [roster.get(int(student))]
+        elif student.lower() in by_sis_id:
+            matches = [by_sis_id[student.lower()]]
+        else:
+            matches = roster.search(student)
+            exact = [e for e in matches if e.name.lower() == student.lower()]
+            if len(exact) == 1:
+                matches = exact
+        if not matches:
+            error(f"line {line}: could not find {student}")
+            found_error = True
+        elif len(matches) > 1:
+            error(f"line {line}: multiple matches for {student}: {', '.join([f'{e.name} ({e.id})' for e in matches])}")
+            found_error = True
+        else:
+            targets[matches[0].id] = points
+    if found_error:
+        sys.exit(2)
+    return targets
+
+
+def submission_key(s):
+    return f"quiz submission {s.id} of {s.user_id}"
+
+
+def plan_fudge_points(course, quiz, submissions, points, targets, decrease):
+    """ work out the new fudge points of each submission, either points for everyone or the points in targets """
+    plan = Plan("set-fudge-points", course.id, quiz.id)
+    for s in submissions:
+        if targets is None:
+            new_points = points
+        elif s.user_id in targets:
+            new_points = targets.pop(s.user_id)
+        else:
+            continue
+        current = s.fudge_points or 0
+        if current == new_points:
+            continue
+        if not decrease and current > new_points:
+            info(f"skipping {s.user_id} with {s.fudge_points} points")
+        else:
+            plan.add("fudge", submission_id=s.id, user_id=s.user_id, points=new_points)
+            # a new attempt or someone else changing the points makes the step stale
+            plan.depends_on(submission_key(s), [s.attempt, s.fudge_points])
+    for user_id in targets or {}:
+        warn(f"{get_roster_entry(course, user_id).name} ({user_id}) has no submission for {quiz.title}")
+    return plan
+
+
 @canvas_tool.command()
 @click.argument('course_name')
 @click.argument('quiz_name', default='')
@@ -8,7 +86,13 @@ from core import *
               help="only show the grade, don't actually set it")
 @click.option('--decrease/--no-decrease', default=False, show_default=True,
               help='If not true, the fudge points will not be updated if new points < old points.')
-def set_fudge_points(course_name, quiz_name, points, dryrun, decrease):
+@click.option('--from-csv', type=click.File('r'),
+              help='CSV of student,points rows to set different points per student. '
+                   'the student can be a name, SIS id, or canvas user id')
+@click.option("--plan-out", type=click.Path(dir_okay=False), help="with --dryrun, save the updates to make to this file")
+@click.option("--apply", "plan_file", type=click.Path(exists=True, dir_okay=False),
+              help="make the updates saved by --plan-out, if the submissions haven't changed since")
+def set_fudge_points(course_name, quiz_name, points, dryrun, decrease, from_csv, plan_out, plan_file):
     '''
     set the fudge points for a quiz.
 
@@ -20,11 +104,12 @@ def set_fudge_points(course_name, quiz_name, points, dryrun, decrease):
     points will not be set.
     '''
 
+    check_plan_options(dryrun, plan_out, plan_file)
     canvas = get_canvas_object()
 
     course = get_course(canvas, course_name)
 
-    quizzes = list(course.get_quizzes())
+    quizzes = list(paginated(course.get_quizzes()))
     selected_quizzes = [q for q in quizzes if quiz_name in q.title]
 
     if not selected_quizzes:
@@ -32,16 +117,45 @@ def set_fudge_points(course_name, quiz_name, points, dryrun, decrease):
     elif len(selected_quizzes) > 1:
         error(f"multiple matches for {quiz_name}: {', '.join([q.title for q in selected_quizzes])}")
     else:
-        for s in selected_quizzes[0].get_submissions():
-            if points == -666:
+        quiz = selected_quizzes[0]
+        targets = read_fudge_points_csv(course, from_csv) if from_csv and not plan_file else None
+        submissions = list(paginated(quiz.get_submissions()))
+        if points == -666 and targets is None and not plan_file:
+            for s in submissions:
                 info(f"{s.user_id} {s.fudge_points}")
+            return
+
+        if plan_file:
+            plan = Plan.load(plan_file, "set-fudge-points", course.id, quiz.id)
+            plan.check({submission_key(s): [s.attempt, s.fudge_points] for s in submissions})
+        else:
+            plan = plan_fudge_points(course, quiz, submissions, points, targets, decrease)
+
+        by_id = {s.id: s for s in submissions}
+        to_update = [(by_id[step["submission_id"]], step["points"]) for step in plan.steps]
+        if dryrun:
+            for s, new_points in to_update:
+                info(f"would update fudge points for {s.user_id} from {s.fudge_points} to {new_points}")
+            if plan_out:
+                plan.save(plan_out)
+            to_update = []
+
+        def update(item):
+            s, new_points = item
+            try:
+                s.update_score_and_comments(quiz_submissions=[{"attempt": s.attempt, 'fudge_points': new_points}])
+            except CanvasException as e:
+                return e
+
+        failed = 0
+        for (s, new_points), e in concurrently(update, to_update):
+            name = getattr(get_roster_entry(course, s.user_id), "name", s.user_id)
+            if e:
+                failed += 1
+                error(f"failed to update fudge points for {name} ({s.user_id}): {e}")
             else:
-                if not decrease and s.fudge_points > points:
-                    info(f"skipping {s.user_id} with {s.fudge_points} points")
-                else:
-                    if dryrun:
-                        info(f"would update fudge points for {s.user_id} from {s.fudge_points} to {points}")
-                    else:
-                        info(f"updating fudge points for {s.user_id} from {s.fudge_points} to {points}")
-                        # s.update_score_and_comments(fudge_points=points)
-                        s.update_score_and_comments(quiz_submissions=[{"attempt": s.attempt, 'fudge_points': points}])
\ No newline at end of file
+                info(f"updated fudge points for {name} ({s.user_id}) from {s.fudge_points} to {new_points}")
+        if to_update:
+            info(f"updated {len(to_update) - failed} of {len(to_update)} submissions")
+        if failed:
+            sys.exit(1)
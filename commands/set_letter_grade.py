@@ -1,11 +1,48 @@
+from canvasapi.submission import Submission
+
 from core import *
 
+
+def final_score_key(user):
+    return f"final score of {user['name']} ({user['id']})"
+
+
+def plan_letter_grades(course, rlg_assignment, round, skip_mismatch):
+    """ work out the letter grade for each student with a Reported Letter Grade submission """
+    plan = Plan("set-letter-grade", course.id, rlg_assignment.id)
+    user_to_grade = {}
+    for enrollment in paginated(course.get_enrollments(include=['grades'])):
+        if hasattr(enrollment, "grades"):
+            current_score = enrollment.grades['current_score']
+            final_score = enrollment.grades['final_score']
+            if current_score != final_score:
+                mess = f"current_score of {current_score} != {final_score} for {enrollment.user['name']} "
+                if skip_mismatch:
+                    warn(mess + "SKIPPED")
+                    continue
+                else:
+                    warn(mess + "NOT SKIPPED")
+            letter = points_to_letter(enrollment.grades['final_score'], round)
+            user_to_grade[enrollment.user['id']] = (enrollment.user, letter, enrollment.grades['final_score'])
+
+    for submission in paginated(rlg_assignment.get_submissions()):
+        if submission.user_id in user_to_grade:
+            (user, letter, score) = user_to_grade[submission.user_id]
+            plan.add("grade", user_id=user['id'], name=user['name'], letter=letter, score=score)
+            # the letter is stale if the final score it came from changed
+            plan.depends_on(final_score_key(user), score)
+    return plan
+
+
 @canvas_tool.command()
 @click.argument("course")
 @click.option("--round", default=0.0, help="points to add to the final score before calculating the letter grade.")
 @click.option("--dryrun/--no-dryrun", default=True)
 @click.option("--skip-mismatch/--no-skip-mismatch", default=True, help="do not set letter grade for current grades that don't match total")
-def set_letter_grade(course, round, dryrun, skip_mismatch):
+@click.option("--plan-out", type=click.Path(dir_okay=False), help="with --dryrun, save the grades to set to this file")
+@click.option("--apply", "plan_file", type=click.Path(exists=True, dir_okay=False),
+              help="set the grades saved by --plan-out, if the final scores haven't changed since")
+def set_letter_grade(course, round, dryrun, skip_mismatch, plan_out, plan_file):
     ''' calculate the letter grade based on the final score in the class.
 
     the "Reported Letter Grade" assignment must be created in the gradebook as a letter grade assignment
@@ -14,6 +51,7 @@ def set_letter_grade(course, round, dryrun, skip_mismatch):
     based on the final score in the class.
     '''
 
+    check_plan_options(dryrun, plan_out, plan_file)
     canvas = get_canvas_object()
     course = get_course(canvas, course)
 
@@ -22,31 +60,22 @@ def set_letter_grade(course, round, dryrun, skip_mismatch):
         error('the "Reported Letter Grade" assignment hasn\'t been set up')
         exit(2)
 
-    user_to_grade = {}
-    for enrollment in course.get_enrollments(include=['grades']):
-        if hasattr(enrollment, "grades"):
-            current_score = enrollment.grades['current_score']
-            final_score = enrollment.grades['final_score']
-            if current_score != final_score:
-                mess = f"current_score of {current_score} != {final_score} for {enrollment.user['name']} "
-                if skip_mismatch:
-                    warn(mess + "SKIPPED")
-                    continue
-                else:
-                    warn(mess + "NOT SKIPPED")
-            letter = points_to_letter(enrollment.grades['final_score'], round)
-            user_to_grade[enrollment.user['id']] = (enrollment.user, letter, enrollment.grades['final_score'])
+    if plan_file:
+        plan = Plan.load(plan_file, "set-letter-grade", course.id, rlg_assignment.id)
+        plan.check({final_score_key(e.user): e.grades['final_score']
+                    for e in paginated(course.get_enrollments(include=['grades'])) if hasattr(e, "grades")})
+    else:
+        plan = plan_letter_grades(course, rlg_assignment, round, skip_mismatch)
 
     if dryrun:
-        for submission in rlg_assignment.get_submissions():
-            if submission.user_id in user_to_grade:
-                (user, letter, score) = user_to_grade[submission.user_id]
-                info(f"{letter} {score} {user['name']}")
+        for step in plan.steps:
+            info(f"{step['letter']} {step['score']} {step['name']}")
+        if plan_out:
+            plan.save(plan_out)
         warn("This was a dryrun. Nothing has been updated")
     else:
-        with click.progressbar(length=len(user_to_grade), label="updating grades", show_pos=True) as bar:
-            for submission in rlg_assignment.get_submissions():
-                if submission.user_id in user_to_grade:
-                    (user, letter, score) = user_to_grade[submission.user_id]
-                    submission.edit(submission={'posted_grade': letter})
-                    bar.update(1)
+        with click.progressbar(plan.steps, label="updating grades", show_pos=True) as steps:
+            for step in steps:
+                submission = Submission(course._requester, {"course_id": course.id, "assignment_id": rlg_assignment.id,
+                                                            "user_id": step["user_id"]})
+                submission.edit(submission={'posted_grade': step["letter"]})
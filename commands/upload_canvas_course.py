@@ -1,3 +1,6 @@
+from typing import NamedTuple
+
+from canvasapi.module import Module
 from canvasapi.page import Page
 
 from core import *
@@ -55,66 +58,168 @@ def create_page(course, title, body=None):
     return rc
 
 
-def upload_modules(course, source, dryrun):
-    last_module_seen = None
-    last_module_item_names = set()
+class ModuleItemPlan(NamedTuple):
+    title: str
+    type: str
+    indent: int
+    options: dict
+    # the name of the page, assignment, discussion, file or quiz the item points to
+    target: str
+
+    @property
+    def key(self):
+        return f"{self.type}; {self.title}"
+
+
+class ModulePlan(NamedTuple):
+    title: str
+    published: bool
+    items: list
+
+
+def parse_modules_file(source):
+    """ parse a modules file, as written by download-course-content, into a list of ModulePlan """
+    modules = []
     with open(source, "r") as fd:
         for line in fd.readlines():
             m = re.match(r"^((  )+) ?\*\s+([^;]+)(;(.*)$)?", line)
             if line.startswith("# "):
                 parts = line[2:].strip().split(";", 2)
-                title = parts[0]
-                if title in course_modules:
-                    last_module_seen = course_modules[title]
-                    last_module_item_names = set(
-                        [f"{mi.type}; {mi.title}" for mi in course_modules[title].get_module_items()])
-                    info(f"{title} module already present")
-                elif dryrun:
-                    info(f"would create {title} module")
-                else:
-                    info(f"creating {title} module")
-                    last_module_seen = course.create_module({"name": title, "published": boolean_option("published",
-                                                                                                        extract_options(
-                                                                                                            parts[
-                                                                                                                1])) if len(
-                        parts) > 1 else True})
-                    course_modules[title] = last_module_seen
-                    last_module_item_names = set()
-            elif m:
-                indent_level = len(m.group(1)) / 2
+                published = boolean_option("published", extract_options(parts[1])) if len(parts) > 1 else True
+                modules.append(ModulePlan(parts[0], published, []))
+            elif m and modules:
                 item_title = m.group(3)
                 item_parts = m.group(5).split(';', 1)
                 item_options = extract_options(item_parts[1]) if len(item_parts) > 1 else {}
-                item_type = item_parts[0].strip()
-                item_key = f"{item_type}; {item_title}"
-                if item_key in last_module_item_names:
-                    info(f"item {item_key} present in {title}")
-                elif dryrun:
-                    info(f"would create item {item_title} in {title}")
-                else:
-                    info(f"creating {item_title} in {title}")
-                    item_dict = {"title": item_title, "indent": indent_level - 1, "type": item_type}
-                    if "newtab" in item_options:
-                        item_dict["newtab"] = boolean_option("newtab", item_options)
-                    item_name = item_options["target"] if "target" in item_options else item_title
-                    if item_type in ["Assignment", "Discussion", "File", "Quiz"]:
-                        item_name = item_options["target"] if "target" in item_options else item_title
-                        name_key = item_type + item_name
-                        error(f"LOOKING FOR {name_key} in {rr4name}")
-                        item_dict["content_id"] = rr4name[name_key].id if name_key in rr4name else create_stub(course,
-                                                                                                               item_type,
-                                                                                                               item_name).id
-                    elif item_type == "Page":
-                        url = page_name_to_url(item_name)
-                        create_page(course, item_name)
-                        item_dict["page_url"] = url
-                    elif item_type.startswith("External"):
-                        item_dict["external_url"] = item_options["url"]
-                    if item_type == "ExternalTool":
-                        error("ExternalTool creation not currently supported")
-                    else:
-                        last_module_seen.create_module_item(item_dict)
-                        last_module_item_names.add(item_key)
+                modules[-1].items.append(ModuleItemPlan(item_title, item_parts[0].strip(), len(m.group(1)) // 2 - 1,
+                                                        item_options, item_options.get("target", item_title)))
+    return modules
+
+
+def plan_modules(course, modules, planned=frozenset()):
+    """
+    work out what upload_modules needs to do without changing anything in canvas.
+
+    returns the stubs to create as (type, name) in the order first needed, and for each module the items
+    missing from it in file order. planned holds the rr4name keys of content that earlier steps will create.
+    """
+    existing = [course_modules[m.title] for m in modules if m.title in course_modules]
+    present = {}
+    for module, items in concurrently(module_items, existing):
+        present[module.name] = {f"{mi.type}; {mi.title}" for mi in items}
+
+    stubs = []
+    missing_items = []
+    for module in modules:
+        if module.title in course_modules:
+            info(f"{module.title} module already present")
+        items = []
+        for item in module.items:
+            if item.key in present.get(module.title, ()):
+                info(f"item {item.key} present in {module.title}")
+                continue
+            if item.type == "ExternalTool":
+                error("ExternalTool creation not currently supported")
+                continue
+            if item.type in ["Assignment", "Discussion", "File", "Quiz", "Page"] \
+                    and item.type + item.target not in rr4name and item.type + item.target not in planned \
+                    and (item.type, item.target) not in stubs:
+                stubs.append((item.type, item.target))
+            items.append(item)
+        missing_items.append((module, items))
+    return stubs, missing_items
+
+
+def module_item_dict(item):
+    item_dict = {"title": item.title, "indent": item.indent, "type": item.type}
+    if "newtab" in item.options:
+        item_dict["new_tab"] = boolean_option("newtab", item.options)
+    if item.type in ["Assignment", "Discussion", "File", "Quiz"]:
+        item_dict["content_id"] = rr4name[item.type + item.target].id
+    elif item.type == "Page":
+        item_dict["page_url"] = rr4name[item.type + item.target].url
+    elif item.type.startswith("External"):
+        item_dict["external_url"] = item.options["url"]
+    return item_dict
+
+
+@traced("upload_modules")
+def upload_modules(course, source, dryrun, plan):
+    modules = parse_modules_file(source)
+    # pages and discussions planned earlier will exist by the time the module items are added
+    planned = {("Page" if step["action"] == "create_page" else "Discussion") + step["fields"]["title"]
+               for step in plan.steps if step["action"] in ("create_page", "create_discussion")}
+    stubs, missing_items = plan_modules(course, modules, planned)
+
+    # a plan is applied without mapping the course, so it carries the existing modules and targets it refers to
+    targets = {(item.type, item.target) for _, items in missing_items for item in items}
+    for item_type, name in sorted(targets):
+        rr = rr4name.get(item_type + name)
+        if rr:
+            plan.add("resource", type=item_type, name=name, id=rr.id, url=rr.url)
+    for module, items in missing_items:
+        if module.title in course_modules and items:
+            plan.add("module", title=module.title, id=course_modules[module.title].id)
+    for item_type, name in stubs:
+        plan.add("create_stub", type=item_type, name=name, unit=["stub", item_type, name])
+        plan.depends_on(f"{item_type} {name}", None, ["stub", item_type, name])
+    for module, items in missing_items:
+        if module.title not in course_modules:
+            plan.add("create_module", title=module.title, published=module.published, unit=["module", module.title])
+        plan.depends_on(f"Module {module.title}", getattr(course_modules.get(module.title), "items_count", None),
+                        ["module", module.title], *(["item", module.title, item.key] for item in items))
+        for item in items:
+            plan.add("create_module_item", module=module.title, item=list(item), unit=["item", module.title, item.key])
+
+    if dryrun:
+        for item_type, name in stubs:
+            info(f"would create {item_type} {name}")
+        for module, items in missing_items:
+            if module.title not in course_modules:
+                info(f"would create {module.title} module")
+            for item in items:
+                info(f"would create item {item.title} in {module.title}")
+
+
+def run_module_steps(course, steps, journal):
+    for step in steps:
+        if step["action"] == "resource":
+            process_resource_record(ResourceRecord(step["id"], step["url"], step["type"], step["name"], False))
+        elif step["action"] == "module":
+            course_modules[step["title"]] = Module(course._requester, {"id": step["id"], "course_id": course.id,
+                                                                       "name": step["title"]})
+
+    # stubs don't depend on each other, so they can be created at the same time
+    def stub(step):
+        item_type, name = step["type"], step["name"]
+        rc = create_page(course, name) if item_type == "Page" else create_stub(course, item_type, name)
+        journal.record(*step["unit"])
+        return rc
+
+    for step, _ in concurrently(stub, [step for step in steps if step["action"] == "create_stub"]):
+        info(f"created {step['type']} {step['name']}")
+
+    # modules are created one at a time since their position is the order they are created in
+    for step in steps:
+        if step["action"] == "create_module":
+            info(f"creating {step['title']} module")
+            course_modules[step["title"]] = course.create_module({"name": step["title"], "published": step["published"]})
+            journal.record(*step["unit"])
+
+    # the items of a module are created in order, but different modules can be filled in at the same time
+    items = defaultdict(list)
+    for step in steps:
+        if step["action"] == "create_module_item":
+            items[step["module"]].append(step)
+
+    def add_items(title):
+        for step in items[title]:
+            course_modules[title].create_module_item(module_item_dict(ModuleItemPlan(*step["item"])))
+            journal.record(*step["unit"])
+        return len(items[title])
+
+    for title, count in concurrently(add_items, list(items)):
+        info(f"created {count} items in {title}")
 
 
 def page_name_to_url(item_name):
@@ -129,7 +234,8 @@ def extract_options(options):
 DISCUSSION_KEYWORDS = set(["title", "published", "publish_at"])
 
 
-def upload_discussions(course, source, dryrun, force):
+@traced("upload_discussions")
+def upload_discussions(course, source, dryrun, force, plan):
     to_upload = set(
         [os.path.join(d, f)[len(source) + 1:].replace("\\", "/") for (d, sds, fs) in os.walk(source) for f in fs])
     for file in to_upload:
@@ -153,21 +259,16 @@ def upload_discussions(course, source, dryrun, force):
             info(f"discussion {dict['title']} already exists")
         do_upload = not exists if not force else True
         if do_upload:
+            plan.depends_on(f"Discussion {dict['title']}", rr_versions.get(rrkey), ["discussion", file])
             if exists:
                 if dryrun:
                     info(f"would update {dict['title']} from {file}")
-                else:
-                    info(f"updating {dict['title']} from {file}")
-                    dict['title'] = dict['title'] + "blah"
-                    dt = course.get_discussion_topic(rr4name[rrkey].id)
-                    rc = dt.update(**dict)
+                plan.add("update_discussion", id=rr4name[rrkey].id, file=file, unit=["discussion", file],
+                         fields={**dict, 'title': dict['title'] + "blah"})
             else:
                 if dryrun:
                     info(f"would create {dict['title']} from {file}")
-                else:
-                    info(f"creating {dict['title']} from {file}")
-                    rc = course.create_discussion_topic(**dict)
-                    process_resource_record(ResourceRecord(rc.id, base_url(rc.html_url), "Discussion", rc.title, False))
+                plan.add("create_discussion", file=file, unit=["discussion", file], fields=dict)
 
 
 def upload_assignments(course, target, dryrun):
@@ -177,7 +278,8 @@ def upload_assignments(course, target, dryrun):
 PAGE_KEYWORDS = set(["title", "published", "publish_at", "front_page"])
 
 
-def upload_pages(course, source, dryrun, force):
+@traced("upload_pages")
+def upload_pages(course, source, dryrun, force, plan):
     # got to watch out for windows \\ when using join!
     to_upload = set(
         [os.path.join(d, f)[len(source) + 1:].replace("\\", "/") for (d, sds, fs) in os.walk(source) for f in fs])
@@ -201,56 +303,147 @@ def upload_pages(course, source, dryrun, force):
             info(f"page {dict['title']} already exists")
         do_upload = not exists if not force else True
         if do_upload:
+            plan.depends_on(f"Page {dict['title']}", rr_versions.get(rrkey), ["page", file])
             if exists:
                 if dryrun:
                     info(f"would update {dict['title']} from {file}")
-                else:
-                    info(f"updating {dict['title']} from {file}")
-                    dict['title'] = dict['title'] + "blah"
-                    p: Page = course.get_page(rr4name[rrkey].url)
-                    rc = p.edit(**dict)
+                plan.add("update_page", url=rr4name[rrkey].url, file=file, unit=["page", file],
+                         fields={**dict, 'title': dict['title'] + "blah"})
             else:
                 if dryrun:
                     info(f"would create {dict['title']} from {file}")
-                else:
-                    info(f"creating {dict['title']} from {file}")
-                    rc = course.create_page(dict)
-                    process_resource_record(ResourceRecord(rc.page_id, rc.url, "Page", rc.title, False))
-
-
-def upload_files(course, target, dryrun):
+                plan.add("create_page", file=file, unit=["page", file], fields=dict)
+
+
+def run_content_step(course, step):
+    """ create or update the discussion or page of a plan step """
+    fields = step["fields"]
+    if step["action"] == "update_discussion":
+        info(f"updating {fields['title']} from {step['file']}")
+        course.get_discussion_topic(step["id"]).update(**fields)
+    elif step["action"] == "create_discussion":
+        info(f"creating {fields['title']} from {step['file']}")
+        rc = course.create_discussion_topic(**fields)
+        process_resource_record(ResourceRecord(rc.id, base_url(rc.html_url), "Discussion", rc.title, False))
+    elif step["action"] == "update_page":
+        info(f"updating {fields['title']} from {step['file']}")
+        p: Page = course.get_page(step["url"])
+        p.edit(**fields)
+    elif step["action"] == "create_page":
+        info(f"creating {fields['title']} from {step['file']}")
+        rc = course.create_page(fields)
+        process_resource_record(ResourceRecord(rc.page_id, rc.url, "Page", rc.title, False))
+
+
+@traced("upload_files")
+def upload_files(course, target, dryrun, plan):
     # got to watch out for windows \\ when using join!
     to_upload = set(
         [os.path.join(d, f)[len(target) + 1:].replace("\\", "/") for (d, sds, fs) in os.walk(target) for f in fs])
 
     existing_files = set()
-    for folder in course.get_folders():
-        for file in folder.get_files():
+    for folder in paginated(course.get_folders()):
+        for file in paginated(folder.get_files()):
             existing_files.add(os.path.join(str(folder), str(file)).replace("\\", "/"))
     for common in to_upload.intersection(existing_files):
         warn(f"{common} already exists. skipping.")
 
-    uploads = list(to_upload.difference(existing_files))
-    if dryrun:
-        for up in uploads:
-            name = os.path.basename(up)
-            parent = os.path.dirname(up)
-            info(f"would upload {name} to {parent}")
-    else:
-        with click.progressbar(uploads, label="uploading",
-                               item_show_func=lambda i: i if i else "") as ups:
-            for up in ups:
-                name = os.path.basename(up)
-                parent = os.path.dirname(up)
-                filename = os.path.join(target, up)
-                if os.stat(filename).st_size > 0:
-                    course.upload(os.path.join(target, up), parent_folder_path=parent, name=name)
+    for up in to_upload.difference(existing_files):
+        if dryrun:
+            info(f"would upload {os.path.basename(up)} to {os.path.dirname(up)}")
+        plan.add("upload_file", file=up, path=os.path.abspath(os.path.join(target, up)), unit=["file", up])
+        plan.depends_on(f"File {up}", None, ["file", up])
+
+
+def run_file_steps(course, steps, journal):
+    with click.progressbar(steps, label="uploading", item_show_func=lambda s: s["file"] if s else "") as bar:
+        for step in bar:
+            up = step["file"]
+            size = os.stat(step["path"]).st_size
+            if size > 0:
+                with traced(f"upload {up}", "transfer", size=size):
+                    course.upload(step["path"], parent_folder_path=os.path.dirname(up), name=os.path.basename(up))
+            journal.record(*step["unit"])
 
 
 def upload_announcements(course, target, dryrun):
     pass
 
 
+CONTENT_ACTIONS = {"create_discussion", "update_discussion", "create_page", "update_page"}
+MODULE_ACTIONS = {"resource", "module", "create_stub", "create_module", "create_module_item"}
+
+
+@traced("apply_upload_plan")
+def apply_upload_plan(course, plan, dryrun, journal):
+    """ carry out the steps of a plan: discussions and pages in order, then files, then modules """
+    steps = [step for step in plan.steps if "unit" not in step or step["unit"] not in journal]
+    if dryrun:
+        for step in steps:
+            if "unit" in step:
+                info(f"would {step['action'].replace('_', ' ')} {' '.join(step['unit'][1:])}")
+        return
+    for step in steps:
+        if step["action"] in CONTENT_ACTIONS:
+            run_content_step(course, step)
+            journal.record(*step["unit"])
+    file_steps = [step for step in steps if step["action"] == "upload_file"]
+    if file_steps:
+        run_file_steps(course, file_steps, journal)
+    run_module_steps(course, [step for step in steps if step["action"] in MODULE_ACTIONS], journal)
+
+
+# the canvas select[] key for each kind of content --from-course can copy
+COPY_SELECT_KEYS = {"modules": "modules", "discussions": "discussion_topics", "assignments": "assignments",
+                    "pages": "pages", "files": "files", "announcements": "announcements"}
+
+
+def copy_selection(source, kinds):
+    """ the ids of the content of each kind in the source course, keyed by canvas select[] key """
+    listings = {"modules": source.get_modules, "discussions": source.get_discussion_topics,
+                "assignments": source.get_assignments, "pages": source.get_pages, "files": source.get_files,
+                "announcements": lambda: source.get_discussion_topics(only_announcements=True)}
+    select = {}
+    for kind, items in concurrently(lambda kind: list(paginated(listings[kind]())), kinds):
+        select[COPY_SELECT_KEYS[kind]] = [i.page_id if kind == "pages" else i.id for i in items]
+    return select
+
+
+@traced("copy_course")
+def copy_course(course, source, kinds, dryrun, journal):
+    """ copy content from source with a canvas course copy, so nothing passes through this machine """
+    # copying everything doesn't need a selection, and also brings over settings and the syllabus
+    if ("copy", source.id) in journal:
+        info(f"content from {source.name} was already copied")
+        return
+    select = None if set(kinds) == set(COPY_SELECT_KEYS) else copy_selection(source, kinds)
+    if dryrun:
+        if select is None:
+            info(f"would copy all content from {source.name}")
+        for key, ids in (select or {}).items():
+            info(f"would copy {len(ids)} {key.replace('_', ' ')} from {source.name}")
+        return
+
+    settings = {"settings": {"source_course_id": source.id}}
+    if select is not None:
+        settings["select"] = select
+    migration = course.create_content_migration("course_copy_importer", **settings)
+    info(f"copying content from {source.name}")
+    with click.progressbar(length=100, label="copying") as bar:
+        def update(progress):
+            bar.update(int(progress.completion or 0) - bar.pos)
+
+        try:
+            wait_for_progress(migration.get_progress(), on_update=update)
+        except CanvasException as e:
+            error(f"course copy failed: {e}")
+            sys.exit(1)
+        bar.update(100 - bar.pos)
+    journal.record("copy", source.id)
+    for issue in paginated(migration.get_migration_issues()):
+        warn(f"{issue.issue_type}: {issue.description}")
+
+
 @canvas_tool.command()
 @click.argument('course_name', metavar='course')
 @click.option('--dryrun/--no-dryrun', default=True, show_default=True, help="show what would happen, but don't do it.")
@@ -270,12 +463,34 @@ def upload_announcements(course, target, dryrun):
               help="upload all content to corresponding directories")
 @click.option("--source", default='.', show_default=True, help="upload content parent directory.")
 @click.option("--force/--no-force", default=False, show_default=True, help="overwrite existing content")
+@click.option("--from-course", help="copy the selected content from this course on the canvas server, then upload "
+                                    "only the local content the copy didn't bring over.")
+@click.option("--resume/--no-resume", default=False, show_default=True,
+              help="continue an interrupted upload, skipping what it finished")
+@click.option("--plan-out", type=click.Path(dir_okay=False),
+              help="with --dryrun, save what would be uploaded, already converted, to this file")
+@click.option("--apply", "plan_file", type=click.Path(exists=True, dir_okay=False),
+              help="upload what was saved by --plan-out, if the course hasn't changed since")
 def upload_course_content(course_name, dryrun, modules, discussions, assignments, pages, files, announcements, all,
-                          source, force):
+                          source, force, from_course, resume, plan_out, plan_file):
     """upload course content from local files"""
+    check_plan_options(dryrun, plan_out, plan_file)
+    if from_course and (plan_out or plan_file):
+        error("--from-course runs can't be planned ahead since the uploads depend on what the copy brings over")
+        sys.exit(2)
     canvas = get_canvas_object()
     course = get_course(canvas, course_name, is_active=False)
     output(f"found {course.name}")
+
+    if plan_file:
+        plan = Plan.load(plan_file, "upload-course-content", course.id, os.path.abspath(source))
+        with Journal("upload-course-content", course.id, os.path.abspath(source), resume=resume,
+                     dryrun=dryrun) as journal:
+            # what the interrupted run already uploaded has changed since the plan was made
+            plan.check(content_versions(course, plan.versions), journal)
+            apply_upload_plan(course, plan, dryrun, journal)
+        return
+
     map_course_resource_records(course)
 
     if all:
@@ -285,15 +500,36 @@ def upload_course_content(course_name, dryrun, modules, discussions, assignments
         error("nothing selected to upload")
         exit(1)
 
-    if discussions:
-        upload_discussions(course, os.path.join(source, 'discussions'), dryrun, force)
-    if assignments:
-        upload_assignments(course, os.path.join(source, 'assignments'), dryrun)
-    if pages:
-        upload_pages(course, os.path.join(source, 'pages'), dryrun, force)
-    if files:
-        upload_files(course, os.path.join(source, 'files'), dryrun)
-    if announcements:
-        upload_announcements(course, os.path.join(source, 'announcements'), dryrun)
-    if modules:
-        upload_modules(course, os.path.join(source, 'modules'), dryrun)
+    with Journal("upload-course-content", course.id, os.path.abspath(source), resume=resume,
+                 dryrun=dryrun) as journal:
+        if from_course:
+            from_course = get_course(canvas, from_course, is_active=False)
+            selected = {"modules": modules, "discussions": discussions, "assignments": assignments, "pages": pages,
+                        "files": files, "announcements": announcements}
+            copy_course(course, from_course, [kind for kind, chosen in selected.items() if chosen], dryrun, journal)
+            if dryrun:
+                # what the local uploads would do depends on what the copy brings over
+                return
+            map_course_resource_records(course)
+            # the uploads skip content that already exists, so they only fill in what the copy didn't have
+            modules, discussions, assignments, pages, files, announcements = (
+                chosen and os.path.exists(os.path.join(source, kind)) for kind, chosen in selected.items())
+
+        plan = Plan("upload-course-content", course.id, os.path.abspath(source))
+        if discussions:
+            upload_discussions(course, os.path.join(source, 'discussions'), dryrun, force, plan)
+        if assignments:
+            upload_assignments(course, os.path.join(source, 'assignments'), dryrun)
+        if pages:
+            upload_pages(course, os.path.join(source, 'pages'), dryrun, force, plan)
+        if files:
+            upload_files(course, os.path.join(source, 'files'), dryrun, plan)
+        if announcements:
+            upload_announcements(course, os.path.join(source, 'announcements'), dryrun)
+        if modules:
+            upload_modules(course, os.path.join(source, 'modules'), dryrun, plan)
+
+        if not dryrun:
+            apply_upload_plan(course, plan, dryrun, journal)
+        elif plan_out:
+            plan.save(plan_out)
@@ -1,16 +1,27 @@
+import atexit
+import base64
+import contextlib
 import datetime
 import functools
+import gzip
+import hashlib
+import json
 import logging
 import os
+import random
 import re
-import string
+import sqlite3
 import sys
 import tempfile
+import threading
+import time
+import traceback
 import urllib
 import urllib.parse
 import urllib.request
 import zipfile
 from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from configparser import ConfigParser
 from html.parser import HTMLParser
 from typing import NamedTuple
@@ -22,7 +33,11 @@ import requests
 from canvasapi import Canvas
 from canvasapi.course import Course
 from canvasapi.discussion_topic import DiscussionEntry
+from canvasapi.exceptions import CanvasException
+from canvasapi.module import ModuleItem
+from canvasapi.paginated_list import PaginatedList
 from canvasapi.requester import Requester
+from requests.structures import CaseInsensitiveDict
 
 course_name_matcher = r"((\S*): (\S+)\s.*)"
 course_name_formatter = r"\2:\3"
@@ -40,24 +55,426 @@ def introspect(o):
         print(i)
 
 
-# this file has the url and token we will use
-config_ini = click.get_app_dir("canvas_tool.ini")
+# this file has the url and token we will use. CANVAS_TOOL_INI can point somewhere else, like a fake_canvas server
+config_ini = os.environ.get("CANVAS_TOOL_INI", click.get_app_dir("canvas_tool.ini"))
+# local caches and state kept between runs
+data_dir = os.environ.get("CANVAS_TOOL_DATA", click.get_app_dir("canvas_tool"))
+
+
+# when a thread sets lines, messages are collected there instead of printed. see for_each_course
+_buffered = threading.local()
+
+
+def echo(message):
+    lines = getattr(_buffered, "lines", None)
+    if lines is None:
+        click.echo(message)
+    else:
+        lines.append(message)
 
 
 def error(message):
-    click.echo(click.style(message, fg='red'))
+    echo(click.style(message, fg='red'))
 
 
 def info(message):
-    click.echo(click.style(message, fg='blue'))
+    echo(click.style(message, fg='blue'))
 
 
 def warn(message):
-    click.echo(click.style(message, fg='yellow'))
+    echo(click.style(message, fg='yellow'))
 
 
 def output(message):
-    click.echo(message)
+    echo(message)
+
+
+logger = logging.getLogger("canvas_tool")
+
+
+class RateLimitGovernor:
+    """
+    keep the number of canvas requests in flight within what the rate limit bucket allows.
+
+    canvas reports what is left in the per-token bucket with X-Rate-Limit-Remaining and
+    what each request cost with X-Request-Cost. while the bucket is healthy we let more
+    requests run at the same time. as it drains we back off, and requests that get
+    throttled anyway are retried after a jittered exponential backoff. when the headers
+    are missing, each successful request lets one more run at the same time.
+    """
+
+    def __init__(self, max_in_flight=8, high_water=500.0, low_water=150.0, retries=6, backoff=1.0):
+        self.max_in_flight = max_in_flight
+        self.high_water = high_water
+        self.low_water = low_water
+        self.retries = retries
+        self.backoff = backoff
+        self.limit = 1
+        self.in_flight = 0
+        self.remaining = None
+        self.stats = defaultdict(int)
+        self._cond = threading.Condition()
+
+    def _acquire(self):
+        with self._cond:
+            waiting_since = None
+            while self.in_flight >= self.limit:
+                waiting_since = waiting_since or time.perf_counter()
+                self._cond.wait()
+            self.in_flight += 1
+            self.stats['peak_in_flight'] = max(self.stats['peak_in_flight'], self.in_flight)
+        if waiting_since and tracer.enabled:
+            tracer.complete("waiting for a request slot", "governor", waiting_since, time.perf_counter(),
+                            {"limit": self.limit})
+
+    def _release(self, response):
+        with self._cond:
+            self.in_flight -= 1
+            remaining = response.headers.get("X-Rate-Limit-Remaining") if response is not None else None
+            cost = response.headers.get("X-Request-Cost") if response is not None else None
+            if cost:
+                self.stats['cost'] += float(cost)
+            if remaining:
+                self.remaining = float(remaining)
+                if 'min_remaining' not in self.stats or self.remaining < self.stats['min_remaining']:
+                    self.stats['min_remaining'] = self.remaining
+                if self.remaining < self.low_water:
+                    self.limit = max(1, self.limit // 2)
+                elif self.remaining > self.high_water:
+                    self.limit = min(self.max_in_flight, self.limit + 1)
+            elif response is not None and response.status_code < 400:
+                # servers and proxies that don't report the bucket only slow us down by throttling
+                self.limit = min(self.max_in_flight, self.limit + 1)
+            self._cond.notify_all()
+
+    def _throttled(self, response):
+        with self._cond:
+            self.stats['throttled'] += 1
+            self.limit = 1
+
+    @staticmethod
+    def is_throttled(response):
+        return response.status_code == 429 or (
+                response.status_code == 403 and b"Rate Limit Exceeded" in response.content)
+
+    def call(self, func, *args, **kwargs):
+        """ run func, which does one http request, under the governor and return its response """
+        attempt = 0
+        while True:
+            self._acquire()
+            response = None
+            try:
+                # note that for streamed responses we are only holding the slot until the headers arrive
+                response = func(*args, **kwargs)
+            finally:
+                self._release(response)
+            self.stats['requests'] += 1
+            if not self.is_throttled(response) or attempt >= self.retries:
+                return response
+            self._throttled(response)
+            delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.info(f"rate limited (remaining {self.remaining}), retrying in {delay:.1f}s")
+            response.close()
+            with traced("rate limit backoff", "governor", delay=delay, remaining=self.remaining):
+                time.sleep(delay)
+            attempt += 1
+            self.stats['retries'] += 1
+
+    def counters(self):
+        return {**self.stats, 'limit': self.limit, 'in_flight': self.in_flight, 'remaining': self.remaining}
+
+
+governor = RateLimitGovernor()
+
+
+def percentile(values, p):
+    """ values must be sorted """
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+
+class Profiler:
+    """
+    collect per-endpoint call counts, latencies, bytes, and pagination depth along with time spent in local work.
+
+    endpoints are the request paths with the ids replaced by :id, so that a report can point out the
+    endpoints called over and over with different ids (the N+1 pattern) and where they are called from.
+    """
+    n_plus_one_threshold = 10
+
+    def __init__(self):
+        self.enabled = False
+        self.endpoints = defaultdict(lambda: {"latencies": [], "bytes": 0, "ids": set(), "depth": 0, "pages": 0,
+                                              "callers": defaultdict(int)})
+        self.cpu = defaultdict(list)
+        self._next_pages = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def endpoint(method, url, kwargs):
+        path = urllib.parse.urlparse(url).path
+        name = f"{method} {re.sub(r'/[0-9]+(?=/|$)', '/:id', path)}"
+        body = kwargs.get("json")
+        if isinstance(body, dict) and body.get("query"):
+            operation = re.match(r"\s*(?:query|mutation)\s+(\w+)", body["query"])
+            name += f" ({operation.group(1) if operation else 'anonymous'})"
+        return name, path
+
+    def caller(self):
+        """ the innermost frame from this tool that is not part of the request plumbing """
+        if getattr(self._local, "caller", None):
+            return self._local.caller
+        here = os.path.dirname(os.path.abspath(__file__))
+        plumbing = ("request", "call", "paginated", "graphql", "graphql_batch", "graphql_nodes", "_complete_nested",
+                    "attributed", "caller", "record_request", "concurrently")
+        for frame in reversed(traceback.extract_stack()):
+            if frame.filename.startswith(here) and frame.name not in plumbing:
+                return f"{os.path.relpath(frame.filename, here)}:{frame.lineno} {frame.name}"
+        return "canvasapi"
+
+    def attributed(self, func):
+        """ wrap func so requests it makes on another thread are attributed to the current caller """
+        caller = self.caller()
+
+        def run(*args, **kwargs):
+            self._local.caller = caller
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.caller = None
+
+        return run
+
+    def record_request(self, method, url, kwargs, response, elapsed):
+        name, path = self.endpoint(method, url, kwargs)
+        size = int(response.headers.get("Content-Length", 0) or 0) if kwargs.get("stream") else len(response.content)
+        caller = self.caller()
+        with self._lock:
+            stats = self.endpoints[name]
+            stats["latencies"].append(elapsed)
+            stats["bytes"] += size
+            stats["callers"][caller] += 1
+            depth = self._next_pages.pop(url, 0) + 1
+            if depth > 1:
+                stats["pages"] += 1
+            else:
+                stats["ids"].add(path)
+            stats["depth"] = max(stats["depth"], depth)
+            next_link = response.links.get("next")
+            if next_link:
+                self._next_pages[next_link["url"]] = depth
+
+    def record_cpu(self, label, elapsed):
+        with self._lock:
+            self.cpu[label].append(elapsed)
+
+    def report(self):
+        echo = functools.partial(click.echo, err=True)
+        echo(click.style("api calls by endpoint", bold=True))
+        echo(f"{'calls':>6} {'p50ms':>7} {'p90ms':>7} {'p99ms':>7} {'maxms':>7} {'KiB':>9} {'depth':>5}  endpoint")
+        for name, stats in sorted(self.endpoints.items(), key=lambda i: -sum(i[1]["latencies"])):
+            latencies = sorted(stats["latencies"])
+            echo(f"{len(latencies):6} {percentile(latencies, 50) * 1000:7.0f} {percentile(latencies, 90) * 1000:7.0f} "
+                 f"{percentile(latencies, 99) * 1000:7.0f} {latencies[-1] * 1000:7.0f} {stats['bytes'] / 1024:9.1f} "
+                 f"{stats['depth']:5}  {name}")
+        if self.cpu:
+            echo(click.style("local work", bold=True))
+            for label, times in sorted(self.cpu.items(), key=lambda i: -sum(i[1])):
+                echo(f"{len(times):6} calls {sum(times):9.3f}s total  {label}")
+        for name, stats in self.endpoints.items():
+            if len(stats["ids"]) >= self.n_plus_one_threshold:
+                caller = max(stats["callers"].items(), key=lambda i: i[1])[0]
+                echo(click.style(f"possible N+1: {name} was called for {len(stats['ids'])} different ids, "
+                                 f"mostly from {caller}", fg='yellow'))
+
+
+profiler = Profiler()
+
+
+@contextlib.contextmanager
+def profiled(label):
+    """ time local work under label when profiling. works as a decorator too """
+    if not profiler.enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.record_cpu(label, time.perf_counter() - start)
+
+
+class Tracer:
+    """
+    record spans in the chrome trace event format so a run can be opened in chrome://tracing or perfetto.
+
+    every span carries the thread it ran on, so concurrent workers show up as separate tracks.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.threads = {}
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def complete(self, name, category, start, end, args=None):
+        thread = threading.current_thread()
+        event = {"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": thread.native_id,
+                 "ts": (start - self._origin) * 1e6, "dur": (end - start) * 1e6,
+                 "args": {"thread": thread.name, **(args or {})}}
+        with self._lock:
+            self.events.append(event)
+            self.threads[thread.native_id] = thread.name
+
+    def write(self, path):
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                    for tid, name in self.threads.items()]
+        with open(path, "w") as fd:
+            json.dump({"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}, fd)
+        info(f"wrote {len(self.events)} trace events to {path}")
+
+
+tracer = Tracer()
+
+
+@contextlib.contextmanager
+def traced(name, category="phase", **args):
+    """ record a span for the enclosed work when tracing. the yielded dict can be used to add span arguments """
+    if not tracer.enabled:
+        yield args
+        return
+    start = time.perf_counter()
+    try:
+        yield args
+    finally:
+        tracer.complete(name, category, start, time.perf_counter(), args)
+
+
+class Cassette:
+    """
+    record canvas traffic to a directory and replay it later without a network.
+
+    interactions are stored as gzipped json lines keyed by method, url, and a hash of the request body.
+    the host and anything that looks like a credential (the access token, file verifiers, signed url
+    parameters) are scrubbed, so cassettes can be shared and replayed against any configured server.
+    when the same request was recorded more than once, the responses are replayed in recorded order.
+    """
+    file_name = "cassette.jsonl.gz"
+    # stands in for the recorded server in urls, so links like the next page point at the replaying server
+    host_placeholder = "https://recorded-canvas.invalid"
+    secret_params = re.compile(r"token|verifier|signature|x-amz-|expires|policy|key-pair", re.IGNORECASE)
+
+    def __init__(self):
+        self.mode = None
+        # the scheme and host of the configured server
+        self.base_url = None
+        self.secrets = set()
+        self.interactions = defaultdict(list)
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def record(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.mode = "record"
+        # recording starts the cassette over, so replay never serves interactions from an older recording
+        self._fd = gzip.open(os.path.join(directory, self.file_name), "wt", encoding="utf-8")
+        atexit.register(self._fd.close)
+
+    def replay(self, directory):
+        self.mode = "replay"
+        with gzip.open(os.path.join(directory, self.file_name), "rt", encoding="utf-8") as fd:
+            for line in fd:
+                interaction = json.loads(line)
+                self.interactions[interaction["key"]].append(interaction)
+
+    def scrub(self, text):
+        for secret in self.secrets:
+            text = text.replace(secret, "REDACTED")
+        if self.base_url:
+            text = text.replace(self.base_url, self.host_placeholder)
+        return re.sub(r"((?:access_token|verifier)=)[^&\"\s]+", r"\1REDACTED", text)
+
+    def unscrub(self, text):
+        return text.replace(self.host_placeholder, self.base_url) if self.base_url else text
+
+    def key(self, prepared):
+        url = urllib.parse.urlparse(prepared.url)
+        query = [(k, v) for k, v in urllib.parse.parse_qsl(url.query, keep_blank_values=True)
+                 if not self.secret_params.search(k)]
+        path = f"{url.path}?{urllib.parse.urlencode(query)}" if query else url.path
+        body = prepared.body or b""
+        body_hash = hashlib.sha256(body.encode() if isinstance(body, str) else body).hexdigest()[:16]
+        return f"{prepared.method} {path} {body_hash}"
+
+    def save(self, key, response):
+        try:
+            body, encoding = self.scrub(response.content.decode("utf-8")), "text"
+        except UnicodeDecodeError:
+            body, encoding = base64.b64encode(response.content).decode(), "base64"
+        headers = {k: self.scrub(v) for k, v in response.headers.items() if k.lower() not in ("set-cookie",)}
+        line = json.dumps({"key": key, "status": response.status_code, "headers": headers, "encoding": encoding,
+                           "body": body}, separators=(",", ":"))
+        with self._lock:
+            self._fd.write(line + "\n")
+
+    def load(self, key, prepared):
+        with self._lock:
+            recorded = self.interactions.get(key)
+            if not recorded:
+                raise CanvasException(f"no recorded response for {key}")
+            interaction = recorded.pop(0) if len(recorded) > 1 else recorded[0]
+        response = requests.Response()
+        response.status_code = interaction["status"]
+        response.headers = CaseInsensitiveDict({k: self.unscrub(v) for k, v in interaction["headers"].items()})
+        response._content = base64.b64decode(interaction["body"]) if interaction["encoding"] == "base64" else \
+            self.unscrub(interaction["body"]).encode("utf-8")
+        response._content_consumed = True
+        response.encoding = "utf-8"
+        response.url = prepared.url
+        response.request = prepared
+        return response
+
+
+cassette = Cassette()
+
+
+class CanvasSession(requests.Session):
+    """ the session used by the canvasapi Requester and for raw downloads, so all traffic is governed """
+
+    def request(self, method, url, *args, **kwargs):
+        if not profiler.enabled and not tracer.enabled and not cassette.mode:
+            return governor.call(super().request, method, url, *args, **kwargs)
+        start = time.perf_counter()
+        with traced(Profiler.endpoint(method, url, kwargs)[0], "http") as span:
+            response = self._send_or_replay(method, url, *args, **kwargs)
+            span["status"] = response.status_code
+        if profiler.enabled:
+            profiler.record_request(method, url, kwargs, response, time.perf_counter() - start)
+        return response
+
+    def _send_or_replay(self, method, url, *args, **kwargs):
+        if not cassette.mode:
+            return governor.call(super().request, method, url, *args, **kwargs)
+        prepared = self.prepare_request(requests.Request(method, url, params=kwargs.get("params"),
+                                                         data=kwargs.get("data"), json=kwargs.get("json")))
+        key = cassette.key(prepared)
+        if cassette.mode == "replay":
+            return cassette.load(key, prepared)
+        response = governor.call(super().request, method, url, *args, **kwargs)
+        cassette.save(key, response)
+        return response
+
+
+@functools.lru_cache
+def get_session():
+    return CanvasSession()
+
+
+def governed_requester(requester):
+    """ route the requests of a canvasapi Requester through the governed session """
+    requester._session = get_session()
+    return requester
 
 
 @functools.lru_cache
@@ -68,16 +485,233 @@ def get_requester():
         error(f"did not find [SERVER] section in {config_ini}")
         info("try using the help-me-setup command")
         sys.exit(1)
-    return Requester(parser['SERVER']['url'], parser['SERVER']['token'])
+    return governed_requester(Requester(parser['SERVER']['url'], parser['SERVER']['token']))
 
 
 access_token = None
 canvas_url = None
 
+# pagination policy used by paginated(). canvas caps per_page at 100 for most endpoints
+page_size = 100
+prefetch_pages = True
+# seconds a roster saved by get_roster is used before it is fetched again
+roster_ttl = 24 * 60 * 60
+
+
+def paginated(plist, stream=False):
+    """
+    iterate through a canvasapi PaginatedList using the pagination policy.
+
+    the first request asks for page_size elements per page, and if prefetch_pages is set, page N+1 is
+    requested in the background while the caller consumes page N. with stream, pages aren't kept in the
+    PaginatedList once they have been consumed, so going through a long listing takes the memory of a page.
+    """
+    if not isinstance(plist, PaginatedList):
+        yield from plist
+        return
+    if not plist._elements and plist._next_url == plist._first_url:
+        plist._first_params["per_page"] = page_size
+    if not prefetch_pages and not stream:
+        yield from plist
+        return
+    yield from list(plist._elements)
+    # _grow adds each page to the list's elements, _get_next_page just returns it
+    fetch = plist._get_next_page if stream else plist._grow
+    if not prefetch_pages:
+        while plist._has_next():
+            yield from fetch()
+        return
+    fetch = profiler.attributed(fetch) if profiler.enabled else fetch
+    with ThreadPoolExecutor(1, thread_name_prefix="prefetch") as executor:
+        future = executor.submit(fetch) if plist._has_next() else None
+        while future:
+            page = future.result()
+            future = executor.submit(fetch) if plist._has_next() else None
+            yield from page
+
+
+def concurrently(func, items):
+    """
+    run func on each item using up to governor.max_in_flight threads, yielding (item, result) as they finish.
+
+    exceptions raised by func are raised when its result is reached.
+    """
+    if profiler.enabled:
+        func = profiler.attributed(func)
+    with ThreadPoolExecutor(governor.max_in_flight, thread_name_prefix="worker") as executor:
+        futures = {executor.submit(func, item): item for item in items}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+# the number of courses for_each_course works on at the same time
+course_concurrency = 4
+
+
+def for_each_course(courses, func, on_result=None):
+    """
+    run func(course) for each of courses, course_concurrency at a time, and return the results keyed by course id
+    along with the courses that failed.
+
+    the messages printed for each course are held back and printed in course order, so the output doesn't
+    depend on which course finishes first. on_result(course, result) is called in the same order, so callers can
+    keep each result as it arrives. a course that fails is reported without stopping the others, and callers
+    finish with exit_on_course_failures once they have used the results of the rest.
+    """
+    def run(course):
+        _buffered.lines = []
+        try:
+            return func(course), None, _buffered.lines
+        except (Exception, SystemExit) as e:
+            return None, e, _buffered.lines
+        finally:
+            _buffered.lines = None
+
+    results = {}
+    failures = []
+    with ThreadPoolExecutor(course_concurrency, thread_name_prefix="course") as executor:
+        for course, future in [(course, executor.submit(run, course)) for course in courses]:
+            result, exception, lines = future.result()
+            for line in lines:
+                click.echo(line)
+            if exception is None:
+                results[course.id] = result
+                if on_result:
+                    on_result(course, result)
+            else:
+                failures.append(course)
+                if not isinstance(exception, SystemExit):
+                    logger.debug("course failed", exc_info=exception)
+                    error(f"{course.name} failed: {exception}")
+    return results, failures
+
+
+def exit_on_course_failures(courses, failures):
+    """ exit with an error if any of the courses for_each_course ran failed """
+    if failures:
+        error(f"{len(failures)} of {len(courses)} courses failed: {', '.join(c.name for c in failures)}")
+        sys.exit(1)
+
+
+def wait_for_progress(progress, poll=1.0, on_update=None):
+    """ wait for the canvas job behind a canvasapi Progress to finish, calling on_update with each poll """
+    while progress.workflow_state in ("queued", "running"):
+        time.sleep(poll)
+        progress = progress.query()
+        if on_update:
+            on_update(progress)
+    if progress.workflow_state == "failed":
+        raise CanvasException(f"canvas job {progress.id} failed: {getattr(progress, 'message', '')}")
+    return progress
+
+
+def graphql(canvas, query, variables=None):
+    """ run a parameterized graphql query and return its data """
+    result = canvas.graphql(query, variables or {})
+    if result.get('errors'):
+        raise CanvasException(f"graphql query failed: {result['errors']}")
+    return result['data']
+
+
+# maximum number of selections graphql_batch will put in one request
+graphql_batch_size = 20
+
+
+def graphql_batch(canvas, selections):
+    """
+    run independent top level selections in one round trip.
+
+    selections maps an alias to a (selection, variables) pair. variables maps each $name used in the
+    selection to a (graphql type, value) pair. variables the selection doesn't use are dropped.
+    returns a dictionary that maps each alias to the data of its selection.
+    """
+    declarations = []
+    fields = []
+    values = {}
+    for alias, (selection, variables) in selections.items():
+        used = set(re.findall(r"\$(\w+)", selection))
+        for name, (gql_type, value) in variables.items():
+            if name in used:
+                declarations.append(f"${alias}_{name}: {gql_type}")
+                values[f"{alias}_{name}"] = value
+        fields.append(f"{alias}: " + re.sub(r"\$(\w+)", lambda m: f"${alias}_{m.group(1)}", selection))
+    arguments = f"({', '.join(declarations)})" if declarations else ""
+    return graphql(canvas, f"query batch{arguments} {{ {' '.join(fields)} }}", values)
+
+
+class GraphQLConnection(NamedTuple):
+    """
+    how to fetch the rest of a connection nested in the nodes of another connection.
+
+    selection is a top level field that takes $id (the id_field of the parent node), $cursor, and
+    optionally $first. path is the dot separated path from that field to the connection.
+    """
+    selection: str
+    path: str
+    id_field: str = "id"
+    nested: dict = None
+
+
+def _dig(data, path):
+    for field in path.split('.'):
+        data = data[field]
+    return data
+
+
+def _complete_nested(canvas, nodes, nested):
+    for name, spec in nested.items():
+        parents = [node for node in nodes if node.get(name)]
+        pending = [node for node in parents if node[name].get('pageInfo', {}).get('hasNextPage')]
+        while pending:
+            batch = pending[:graphql_batch_size]
+            data = graphql_batch(canvas, {
+                f"n{i}": (spec.selection, {"id": ("ID!", node[spec.id_field]),
+                                           "cursor": ("String", node[name]['pageInfo']['endCursor']),
+                                           "first": ("Int", page_size)}) for i, node in enumerate(batch)})
+            for i, node in enumerate(batch):
+                connection = _dig(data[f"n{i}"], spec.path)
+                node[name]['nodes'].extend(connection['nodes'])
+                node[name]['pageInfo'] = connection['pageInfo']
+            pending = [node for node in pending if node[name]['pageInfo']['hasNextPage']]
+        if spec.nested:
+            _complete_nested(canvas, [inner for node in parents for inner in node[name]['nodes']], spec.nested)
+
+
+def graphql_nodes(canvas, query, path, variables=None, nested=None):
+    """
+    stream the nodes of the connection at path in the result of a parameterized query.
+
+    the connection must select pageInfo { hasNextPage endCursor } and take after: $cursor so the
+    following pages can be requested. if the query declares $first, it gets the page_size policy.
+    nested maps the names of connections inside each node to the GraphQLConnection used to fetch
+    their remaining pages, so a node is only yielded once all its nested connections are complete.
+    """
+    variables = dict(variables or {})
+    if "$first" in query:
+        variables.setdefault("first", page_size)
+    cursor = None
+    while True:
+        connection = _dig(graphql(canvas, query, {**variables, "cursor": cursor}), path)
+        nodes = connection['nodes']
+        if nested:
+            _complete_nested(canvas, nodes, nested)
+        yield from nodes
+        page_info = connection.get('pageInfo')
+        if not page_info or not page_info['hasNextPage']:
+            return
+        cursor = page_info['endCursor']
+
 
 def get_canvas_object():
     parser = ConfigParser()
     parser.read([config_ini])
+    if "SERVER" not in parser and cassette.mode == "replay":
+        # replayed traffic doesn't depend on the server or token, so a configuration isn't needed
+        parser.read_dict({"SERVER": {"url": "https://replay.invalid", "token": "replay"}})
     if "SERVER" not in parser:
         error(f"did not find [SERVER] section in {config_ini}")
         info("try using the help-me-setup command")
@@ -86,8 +720,12 @@ def get_canvas_object():
         error(f"did not find url or token in {config_ini}")
         info("try using the help-me-setup command")
         sys.exit(1)
+    cassette.secrets.add(parser['SERVER']['token'])
+    url = urllib.parse.urlparse(parser['SERVER']['url'])
+    cassette.base_url = f"{url.scheme}://{url.netloc}"
     try:
         canvas = Canvas(parser['SERVER']['url'], parser['SERVER']['token'])
+        governed_requester(canvas._Canvas__requester)
         user = canvas.get_current_user()
         info(f"accessing canvas as {user.name} ({user.id})")
         canvas.user_id = user.id
@@ -103,10 +741,43 @@ def get_canvas_object():
 @click.group()
 @click.option("--log-level", type=click.Choice(['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'], case_sensitive=False),
               help="set python logging level")
-def canvas_tool(log_level):
+@click.option("--page-size", "per_page", default=page_size, show_default=True, type=click.IntRange(1, 100),
+              help="number of elements to request per page from canvas")
+@click.option("--prefetch/--no-prefetch", default=prefetch_pages, show_default=True,
+              help="request the next page of a listing while the current page is processed")
+@click.option("--profile/--no-profile", default=False, show_default=True,
+              help="report api calls, latencies, and time spent in local work when the command finishes")
+@click.option("--trace", "trace_file", metavar="out.json", type=click.Path(dir_okay=False, writable=True),
+              help="write a chrome trace of the command phases, api calls, and file transfers")
+@click.option("--roster-ttl", "roster_max_age", default=roster_ttl, show_default=True, metavar="SECONDS",
+              help="how long a saved course roster is reused. 0 always fetches a fresh roster")
+@click.option("--record", "record_dir", metavar="DIR", type=click.Path(file_okay=False),
+              help="record the canvas traffic of this run to a cassette in DIR")
+@click.option("--replay", "replay_dir", metavar="DIR", type=click.Path(exists=True, file_okay=False),
+              help="replay the canvas traffic recorded in DIR instead of accessing canvas")
+@click.pass_context
+def canvas_tool(ctx, log_level, per_page, prefetch, profile, trace_file, roster_max_age, record_dir, replay_dir):
+    global page_size, prefetch_pages, roster_ttl
+    page_size = per_page
+    prefetch_pages = prefetch
+    roster_ttl = roster_max_age
+    if record_dir and replay_dir:
+        raise click.UsageError("--record and --replay cannot be used together")
+    if record_dir:
+        cassette.record(record_dir)
+    if replay_dir:
+        cassette.replay(replay_dir)
+    if profile:
+        profiler.enabled = True
+        atexit.register(profiler.report)
+    if trace_file:
+        tracer.enabled = True
+        atexit.register(tracer.write, trace_file)
+        ctx.with_resource(traced(ctx.invoked_subcommand, "command"))
     if log_level:
         log_level_int = getattr(logging, log_level.upper())
         logging.basicConfig(level=log_level_int)
+    atexit.register(lambda: logger.info(f"rate limit governor: {governor.counters()}"))
 
 
 def get_course(canvas, name, is_active=True) -> Course:
@@ -127,7 +798,7 @@ def get_course(canvas, name, is_active=True) -> Course:
 
 def get_courses(canvas: Canvas, name: str, is_active=True, is_finished=False) -> [Course]:
     ''' find the courses based on partial match '''
-    courses = canvas.get_courses(enrollment_type="teacher")
+    courses = paginated(canvas.get_courses(enrollment_type="teacher"))
     now = datetime.datetime.now(datetime.timezone.utc)
     course_list = []
     for c in courses:
@@ -180,36 +851,337 @@ def get_assignment(course, title):
     return course.get_assignment(filtered_assignments[0]['assignment_id'])
 
 
+class RosterEntry(NamedTuple):
+    id: int
+    name: str
+    sortable_name: str
+    sis_user_id: str
+    email: str
+    enrollment_state: str
+    enrollment_type: str
+
+    @property
+    def active_student(self):
+        return self.enrollment_state == "active" and self.enrollment_type == "StudentEnrollment"
+
+
+class Roster:
+    """ the people in a course, indexed by id and searchable by case-insensitive substring """
+
+    def __init__(self, entries, fetched_at, fresh=False):
+        self.entries = entries
+        self.fetched_at = fetched_at
+        # true if the roster was fetched from canvas during this run rather than loaded from data_dir
+        self.fresh = fresh
+        self.by_id = {e.id: e for e in entries}
+        self._search_keys = [([str(f).lower() for f in (e.name, e.sortable_name, e.sis_user_id, e.email) if f], e)
+                             for e in entries]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, id):
+        return self.by_id.get(id)
+
+    def search(self, term, students_only=False):
+        """ the entries with a name, sortable name, SIS id or email containing term, optionally only active students """
+        term = term.lower()
+        return [e for fields, e in self._search_keys
+                if any(term in f for f in fields) and (e.active_student or not students_only)]
+
+
+_rosters = {}
+
+
+def canvas_host():
+    """ the canvas server being accessed, used to keep local state from different servers apart """
+    url = canvas_url
+    if not url:
+        # commands working only from local state don't connect to canvas
+        parser = ConfigParser()
+        parser.read([config_ini])
+        url = parser.get("SERVER", "url", fallback="")
+    return urllib.parse.urlparse(url).netloc or "canvas"
+
+
+def open_database(name):
+    """ open (creating if needed) the sqlite database called name in data_dir """
+    os.makedirs(data_dir, exist_ok=True)
+    return sqlite3.connect(os.path.join(data_dir, f"{canvas_host()}-{name}.sqlite"))
+
+
+def _roster_file(course):
+    return os.path.join(data_dir, "rosters", f"{canvas_host()}-{course.id}.json")
+
+
+def _fetch_roster(course):
+    entries = []
+    for u in paginated(course.get_users(include=["enrollments", "email"],
+                                        enrollment_state=["active", "invited", "completed", "inactive"]),
+                       stream=True):
+        enrollments = getattr(u, "enrollments", None) or [{}]
+        entries.append(RosterEntry(u.id, u.name, getattr(u, "sortable_name", u.name), getattr(u, "sis_user_id", None),
+                                   getattr(u, "email", None), enrollments[0].get("enrollment_state", "active"),
+                                   enrollments[0].get("type", "StudentEnrollment")))
+    return entries
+
+
+def get_roster(course, max_age=None) -> Roster:
+    """
+    get the roster of a course, loading it at most once per run.
+
+    rosters are saved under data_dir and reused for roster_ttl seconds (or max_age if given) across runs.
+    """
+    max_age = roster_ttl if max_age is None else max_age
+    now = time.time()
+    roster = _rosters.get(course.id)
+    if roster and now - roster.fetched_at <= max_age:
+        return roster
+    path = _roster_file(course)
+    if max_age > 0 and os.path.exists(path):
+        with open(path) as fd:
+            saved = json.load(fd)
+        # rosters saved before a field was added to RosterEntry are fetched again
+        if now - saved["fetched_at"] <= max_age and all(len(e) == len(RosterEntry._fields) for e in saved["entries"]):
+            roster = Roster([RosterEntry(*e) for e in saved["entries"]], saved["fetched_at"])
+            _rosters[course.id] = roster
+            return roster
+    with traced("get_roster"):
+        roster = Roster(_fetch_roster(course), now, fresh=True)
+    _rosters[course.id] = roster
+    if roster_ttl > 0:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fd:
+            json.dump({"fetched_at": roster.fetched_at, "entries": roster.entries}, fd)
+    return roster
+
+
+def get_roster_entry(course, user_id):
+    """ look up a user in the course roster, fetching a fresh roster if a saved one doesn't have them """
+    roster = get_roster(course)
+    if user_id not in roster.by_id and not roster.fresh:
+        roster = get_roster(course, max_age=0)
+    return roster.get(user_id)
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode="w"):
+    """ write path through a temporary file that replaces it only when writing finishes, so it is never partial """
+    part = f"{path}.part"
+    try:
+        with open(part, mode) as fd:
+            yield fd
+        os.replace(part, path)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+
+
+class Journal:
+    """
+    an append-only record of the units of work a run has finished, so an interrupted run can pick up where it
+    stopped.
+
+    the journal is named for the command and the arguments that identify the run. it is replayed when resume is
+    set and started over otherwise, and it is removed once the run finishes. dry runs only read it.
+    """
+
+    def __init__(self, command, *run, resume=False, dryrun=False):
+        key = hashlib.sha1(json.dumps([str(r) for r in run]).encode()).hexdigest()[:16]
+        self.name = f"{canvas_host()}-{command}-{key}"
+        self.path = os.path.join(data_dir, "journals", f"{self.name}.jsonl")
+        self.dryrun = dryrun
+        self.done = set()
+        self._lock = threading.Lock()
+        self._fd = None
+        if os.path.exists(self.path):
+            if resume:
+                with open(self.path) as fd:
+                    for line in fd:
+                        try:
+                            self.done.add(tuple(json.loads(line)))
+                        except ValueError:
+                            # the last line can be cut off by the interruption
+                            pass
+                info(f"resuming with {len(self.done)} completed steps from the last run")
+            else:
+                warn(f"starting over. use --resume to continue the last {command} run instead")
+        elif resume:
+            warn(f"no interrupted {command} run to resume")
+
+    def __enter__(self):
+        if not self.dryrun:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._fd = open(self.path, "a" if self.done else "w")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._fd:
+            self._fd.close()
+        finished = exc_type is None or (exc_type is SystemExit and not exc.code)
+        if self.dryrun:
+            return
+        if finished or not self.done:
+            # a run that stopped before finishing anything leaves nothing to resume
+            os.remove(self.path)
+        elif self.done:
+            info(f"stopped with {len(self.done)} steps done. rerun with --resume to continue")
+
+    def __contains__(self, unit):
+        return tuple(str(u) for u in unit) in self.done
+
+    def record(self, *unit):
+        """ note that a unit of work, named by its kind and key, has finished """
+        unit = tuple(str(u) for u in unit)
+        if self.dryrun:
+            return
+        with self._lock:
+            self._fd.write(json.dumps(unit) + "\n")
+            self._fd.flush()
+            self.done.add(unit)
+
+
+class Plan:
+    """
+    the steps a dry run decided on, saved with --plan-out so the real run can --apply exactly those.
+
+    versions hold the updated_at, or whatever else shows a change, of each object the steps depend on, so applying
+    can cheaply tell if the plan has gone stale. owners hold the journal units of the steps that change an object
+    themselves, since once one of them is done the object is expected to have changed.
+    """
+
+    def __init__(self, command, *run):
+        self.command = command
+        self.run = [str(r) for r in run]
+        self.steps = []
+        self.versions = {}
+        self.owners = {}
+
+    def add(self, action, **step):
+        self.steps.append({"action": action, **step})
+
+    def depends_on(self, key, version, *units):
+        """ units are the journal units of the steps in this plan that change key """
+        self.versions[str(key)] = version
+        if units:
+            self.owners.setdefault(str(key), []).extend([str(u) for u in unit] for unit in units)
+
+    def save(self, path):
+        with atomic_open(path) as fd:
+            json.dump({"command": self.command, "run": self.run, "versions": self.versions, "owners": self.owners,
+                       "steps": self.steps}, fd, indent=1)
+        info(f"saved {len(self.steps)} steps to {path}. run again with --no-dryrun --apply {path} to do them")
+
+    @classmethod
+    def load(cls, path, command, *run):
+        """ load a plan saved by save, exiting if it was made for a different command or arguments """
+        with open(path) as fd:
+            saved = json.load(fd)
+        plan = cls(command, *run)
+        if saved["command"] != plan.command or saved["run"] != plan.run:
+            error(f"{path} is a plan for {saved['command']} {' '.join(saved['run'])}, not this run")
+            sys.exit(2)
+        plan.steps = saved["steps"]
+        plan.versions = saved["versions"]
+        plan.owners = saved.get("owners", {})
+        return plan
+
+    def check(self, current, journal=None):
+        """
+        exit if anything the plan depends on has changed. current maps the same keys to their versions now.
+        when resuming, objects changed by steps the journal has as done are not checked.
+        """
+        current = json.loads(json.dumps({str(k): v for k, v in current.items()}))
+        stale = [key for key, version in self.versions.items() if current.get(key) != version and
+                 not (journal and any(unit in journal for unit in self.owners.get(key, ())))]
+        if stale:
+            error("the plan is out of date. changed since it was made:")
+            for key in stale:
+                error(f"    {key}")
+            error("make a new plan with --plan-out")
+            sys.exit(2)
+
+
+def check_plan_options(dryrun, plan_out, plan_file):
+    if plan_out and not dryrun:
+        error("--plan-out saves the plan of a dry run, so it can't be used with --no-dryrun")
+        sys.exit(2)
+    if plan_out and plan_file:
+        error("--plan-out and --apply can't be used together")
+        sys.exit(2)
+
+
+@functools.lru_cache(maxsize=1 << 16)
 def maybe_a_word(word):
     if not word.isalpha():
         return False
 
     word = word.strip().lower()
-    vowels = [x for x in word if x in "aeiou"]
+    vowels = sum(1 for x in word if x in "aeiou")
     if not vowels:
         return False
 
-    ratio = round(len(word) / len(vowels), 1)
+    ratio = round(len(word) / vowels, 1)
     return 1.5 <= ratio <= 8.0
 
 
+word_pattern = re.compile(r'\w+')
+
+
 class WordCounter(HTMLParser):
+    """ counts the words in html. the same counter can be reused with count() """
+
     def __init__(self):
         super().__init__()
         self.checked_word_count = 0
         self.word_count = 0
 
     def handle_data(self, data):
-        data.translate(str.maketrans('', '', string.punctuation))
-        words = re.findall(r'\w+', data)
+        words = word_pattern.findall(data)
         self.word_count += len(words)
-        self.checked_word_count += len(set([w for w in words if maybe_a_word(w)]))
+        self.checked_word_count += sum(1 for w in set(words) if maybe_a_word(w))
+
+    def count(self, content):
+        self.reset()
+        self.checked_word_count = 0
+        self.word_count = 0
+        self.feed(content)
+        return self.checked_word_count
+
+
+_word_counters = threading.local()
 
 
+def _count_words(content):
+    counter = getattr(_word_counters, "counter", None)
+    if counter is None:
+        counter = _word_counters.counter = WordCounter()
+    return counter.count(content)
+
+
+@profiled("count_words")
 def count_words(content):
-    wc = WordCounter()
-    wc.feed(content)
-    return wc.checked_word_count
+    return _count_words(content)
+
+
+# batches smaller than this are not worth starting a process pool for
+word_count_pool_threshold = 2000
+
+
+@profiled("count_words_batch")
+def count_words_batch(contents, processes=None):
+    """ count_words for each of contents. large batches are spread across a pool of processes """
+    contents = list(contents)
+    if processes == 1 or len(contents) < word_count_pool_threshold:
+        return [_count_words(c) for c in contents]
+    processes = processes or os.cpu_count()
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(_count_words, contents, chunksize=max(1, len(contents) // (processes * 4))))
+
 
 def print_config_ini_format(is_info):
     func = info if is_info else error
@@ -245,6 +1217,8 @@ rr4name = {}
 rr4id = {}
 rr4url = {}
 course_modules = {}
+# the updated_at of mapped pages and files, keyed like rr4name, for plans to check for changes
+rr_versions = {}
 
 
 def process_resource_record(rr):
@@ -258,31 +1232,81 @@ def base_url(url):
     return url.split("?")[0]
 
 
+def get_modules_with_items(course):
+    """ the modules of a course with their items inlined, so the whole module tree takes one request per page """
+    return paginated(course.get_modules(include=["items", "content_details"]))
+
+
+def module_items(module):
+    """ the items of a module from get_modules_with_items, fetching them if canvas left them out as too numerous """
+    items = getattr(module, "items", None)
+    if items is None:
+        return list(paginated(module.get_module_items(include=["content_details"])))
+    return [ModuleItem(module._requester, {**item, "course_id": module.course_id}) for item in items]
+
+
+@traced("map_course_resource_records")
 def map_course_resource_records(course):
     with click.progressbar(length=6, label="mapping existing resources") as bar:
-        for folder in course.get_folders():
-            for file in folder.get_files():
-                process_resource_record(
-                    ResourceRecord(file.id, base_url(file.url), "File", os.path.join(str(folder), str(file)).replace("\\", "/"), file.size == 0))
+        with traced("map files"):
+            for folder in paginated(course.get_folders()):
+                for file in paginated(folder.get_files()):
+                    name = os.path.join(str(folder), str(file)).replace("\\", "/")
+                    process_resource_record(ResourceRecord(file.id, base_url(file.url), "File", name, file.size == 0))
+                    rr_versions["File" + name] = getattr(file, "updated_at", None)
         bar.update(1)
-        for assignment in course.get_assignments():
-            process_resource_record(
-                ResourceRecord(assignment.id, base_url(assignment.html_url), "Assignment", assignment.name, not assignment.description))
+        with traced("map assignments"):
+            for assignment in paginated(course.get_assignments()):
+                process_resource_record(
+                    ResourceRecord(assignment.id, base_url(assignment.html_url), "Assignment", assignment.name, not assignment.description))
         bar.update(1)
-        for discussion in course.get_discussion_topics():
-            process_resource_record(
-                ResourceRecord(discussion.id, base_url(discussion.html_url), "Discussion", discussion.title, not discussion.message))
+        with traced("map discussions"):
+            for discussion in paginated(course.get_discussion_topics()):
+                process_resource_record(
+                    ResourceRecord(discussion.id, base_url(discussion.html_url), "Discussion", discussion.title, not discussion.message))
+                rr_versions["Discussion" + discussion.title] = getattr(discussion, "updated_at", None)
         bar.update(1)
-        for page in course.get_pages(include=["body"]):
-            process_resource_record(ResourceRecord(page.page_id, base_url(page.url), "Page", page.title, not page.body))
+        with traced("map pages"):
+            for page in paginated(course.get_pages(include=["body"])):
+                process_resource_record(ResourceRecord(page.page_id, base_url(page.url), "Page", page.title, not page.body))
+                rr_versions["Page" + page.title] = getattr(page, "updated_at", None)
         bar.update(1)
-        for quiz in course.get_quizzes():
-            process_resource_record(ResourceRecord(quiz.id, base_url(quiz.html_url), "Quiz", quiz.title, not quiz.description))
+        with traced("map quizzes"):
+            for quiz in paginated(course.get_quizzes()):
+                process_resource_record(ResourceRecord(quiz.id, base_url(quiz.html_url), "Quiz", quiz.title, not quiz.description))
         bar.update(1)
-        for mod in course.get_modules():
-            course_modules[mod.name] = mod
+        with traced("map modules"):
+            for mod in get_modules_with_items(course):
+                course_modules[mod.name] = mod
         bar.update(1)
 
+
+def content_versions(course, keys):
+    """
+    the updated_at of the pages, files and discussions in a course, and the item count of its modules, keyed by
+    type and name like "Page Week 1", along with the module names in order under "Modules", for checking the
+    versions a plan depends on. only the kinds of content named in keys are listed, and without their bodies.
+    """
+    versions = {}
+    if any(key.startswith("Page ") for key in keys):
+        for page in paginated(course.get_pages()):
+            versions[f"Page {page.title}"] = getattr(page, "updated_at", None)
+    if any(key.startswith("File ") for key in keys):
+        folders = {folder.id: str(folder) for folder in paginated(course.get_folders())}
+        for file in paginated(course.get_files()):
+            name = os.path.join(folders.get(file.folder_id, ""), str(file)).replace("\\", "/")
+            versions[f"File {name}"] = getattr(file, "updated_at", None)
+    if any(key.startswith("Module ") or key == "Modules" for key in keys):
+        versions["Modules"] = []
+        for module in paginated(course.get_modules()):
+            versions[f"Module {module.name}"] = module.items_count
+            versions["Modules"].append(module.name)
+    if any(key.startswith("Discussion ") for key in keys):
+        for discussion in paginated(course.get_discussion_topics()):
+            versions[f"Discussion {discussion.title}"] = getattr(discussion, "updated_at", None)
+    return versions
+
+
 letter_grades = [(96, "A+"), (93, "A"), (90, "A-"), (86, "B+"), (83, "B"), (80, "B-"), (76, "C+"), (73, "C"),
                  (70, "C-"), (66, "D+"), (63, "D"), (60, "D-"), (0, "F")]
 
@@ -0,0 +1,1125 @@
+"""
+a local stand-in for the canvas REST and GraphQL apis that serves a synthetic course.
+
+it only implements the endpoints and graphql fields canvas_tool uses, but it paginates the way canvas
+does (Link headers and graphql connections) and reports X-Rate-Limit-Remaining and X-Request-Cost from a
+simulated per-token cost bucket, so it can be used to measure how commands scale without a canvas tenant.
+
+    python fake_canvas.py --students 500 --port 8765
+
+prints the canvas_tool.ini to use. point canvas_tool at it with the CANVAS_TOOL_INI environment variable.
+"""
+import base64
+import datetime
+import io
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+import zipfile
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+
+first_names = ["Ada", "Alan", "Grace", "Edsger", "Barbara", "Donald", "Frances", "John", "Radia", "Ken", "Margaret",
+               "Dennis", "Shafi", "Leslie", "Sophie", "Tim", "Katherine", "Niklaus", "Hedy", "Guido"]
+last_names = ["Lovelace", "Turing", "Hopper", "Dijkstra", "Liskov", "Knuth", "Allen", "McCarthy", "Perlman",
+              "Thompson", "Hamilton", "Ritchie", "Goldwasser", "Lamport", "Wilson", "Berners-Lee", "Johnson", "Wirth",
+              "Lamarr", "van Rossum"]
+words = ["tree", "heap", "graph", "queue", "stack", "hash", "table", "sort", "merge", "quick", "binary", "search",
+         "node", "edge", "vertex", "array", "list", "pointer", "balance", "rotate", "insert", "delete", "bucket",
+         "probe", "recursion", "invariant", "amortized", "complexity", "the", "a", "is", "because", "when", "we"]
+
+now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+
+
+def iso(when):
+    return when.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def sentence(rng, count):
+    return " ".join(rng.choice(words) for _ in range(count))
+
+
+def global_id(type_name, legacy_id):
+    return base64.b64encode(f"{type_name}-{legacy_id}".encode()).decode()
+
+
+def legacy_id(id):
+    """ graphql ids can be either legacy ids or global ids """
+    id = str(id)
+    if id.isdigit():
+        return int(id)
+    return int(base64.b64decode(id).decode().rsplit("-", 1)[1])
+
+
+class FakeCourse:
+    """ a synthetic course. ids are allocated from a shared counter so they are unique across courses """
+
+    def __init__(self, fixture, name, start, end, students, seed):
+        rng = random.Random(seed)
+        self.fixture = fixture
+        self.id = fixture.next_id()
+        self.name = name
+        self.start = start
+        self.end = end
+        self.students = [fixture.user(i) for i in range(students)]
+        self.assignment_groups = [
+            {"id": fixture.next_id(), "name": name, "group_weight": weight}
+            for name, weight in [("Homework", 40), ("Quizzes", 20), ("Exams", 40), ("Imported Assignments", 0)]]
+        self.assignments = []
+        for i, (title, group, kind) in enumerate(
+                [("Programming 1", 0, "upload"), ("Programming 2", 0, "upload"), ("Discussion 1", 0, "discussion"),
+                 ("Discussion 2", 0, "discussion"), ("Quiz 1", 1, "quiz"), ("Midterm", 2, "none"),
+                 ("Final", 2, "none"), ("Reported Letter Grade", 3, "letter")]):
+            self.assignments.append({"id": fixture.next_id(), "name": title, "group": self.assignment_groups[group],
+                                     "kind": kind, "points_possible": 0 if kind == "letter" else 10 * (i + 1),
+                                     "due_at": start + datetime.timedelta(days=7 * (i + 1)),
+                                     "description": f"<p>{sentence(rng, 20)}</p>"})
+        self.discussions = [{"id": fixture.next_id(), "title": a["name"], "message": f"<p>{sentence(rng, 30)}</p>",
+                             "assignment": a} for a in self.assignments if a["kind"] == "discussion"]
+        self.student_by_id = {s["id"]: s for s in self.students}
+        self.submissions = {}
+        self.submission_by_user = {}
+        for a in self.assignments:
+            self.submissions[a["id"]] = [self.make_submission(rng, a, s) for s in self.students]
+            self.submission_by_user[a["id"]] = {s["user_id"]: s for s in self.submissions[a["id"]]}
+        self._grades = {}
+        self.folders = [{"id": fixture.next_id(), "full_name": "course files", "name": "course files"},
+                        {"id": fixture.next_id(), "full_name": "course files/slides", "name": "slides"}]
+        self.files = defaultdict(list)
+        for i in range(12):
+            folder = self.folders[i % 2]
+            self.files[folder["id"]].append(fixture.file(f"lecture{i:02}.pdf", 2048 + i * 512))
+        self.pages = [{"page_id": fixture.next_id(), "url": f"week-{i}", "title": f"Week {i}",
+                       "body": f"<h1>Week {i}</h1><p>{sentence(rng, 60)}</p><ul><li>{sentence(rng, 8)}</li></ul>",
+                       "published": True, "front_page": i == 1, "publish_at": None, "updated_at": iso(start)}
+                      for i in range(1, 9)]
+        self.quizzes = []
+        for a in self.assignments:
+            if a["kind"] == "quiz":
+                quiz = {"id": fixture.next_id(), "title": a["name"], "description": f"<p>{sentence(rng, 10)}</p>",
+                        "assignment": a, "groups": [{"id": fixture.next_id(), "name": "pick one", "position": 3}]}
+                quiz["questions"] = [{"id": fixture.next_id(), "position": p, "question_text": f"<p>{sentence(rng, 9)}?</p>",
+                                      "quiz_group_id": quiz["groups"][0]["id"] if p >= 3 else None} for p in range(1, 6)]
+                quiz["submissions"] = [{"id": fixture.next_id(), "user_id": s["id"], "attempt": 1,
+                                        "workflow_state": "complete",
+                                        "time_spent": rng.randint(300, 3000), "fudge_points": 0.0,
+                                        "score": rng.randint(0, 50)} for s in self.students]
+                self.quizzes.append(quiz)
+        self.modules = []
+        for i in range(1, 5):
+            items = [{"id": fixture.next_id(), "title": f"Week {i}", "type": "Page", "page_url": f"week-{i}"},
+                     {"id": fixture.next_id(), "title": f"Week {i} slides", "type": "File",
+                      "content_id": self.files[self.folders[1]["id"]][i]["id"]},
+                     {"id": fixture.next_id(), "title": "Assignments", "type": "SubHeader"},
+                     {"id": fixture.next_id(), "title": self.assignments[i - 1]["name"], "type": "Assignment",
+                      "content_id": self.assignments[i - 1]["id"]},
+                     {"id": fixture.next_id(), "title": "course site", "type": "ExternalUrl",
+                      "external_url": "https://example.com", "new_tab": True}]
+            self.modules.append({"id": fixture.next_id(), "name": f"Week {i}", "items": items,
+                                 "prerequisite_module_ids": [self.modules[-1]["id"]] if self.modules else []})
+
+    def make_submission(self, rng, assignment, student):
+        submitted = rng.random() < 0.9 and assignment["kind"] not in ("none", "letter")
+        score = round(rng.uniform(0.4, 1.0) * assignment["points_possible"], 1) if submitted or assignment[
+            "kind"] == "none" else None
+        if assignment["kind"] == "letter":
+            score = None
+        submitted_at = assignment["due_at"] - datetime.timedelta(hours=rng.randint(-12, 72)) if submitted else None
+        submission = {"id": self.fixture.next_id(), "user_id": student["id"], "assignment": assignment,
+                      "score": score, "grade": rng.choice(["A", "B+", "C"]) if assignment["kind"] == "letter" else score,
+                      "submitted_at": submitted_at, "attempt": 1 if submitted else None,
+                      "late": bool(submitted_at and submitted_at > assignment["due_at"]),
+                      "missing": not submitted and assignment["kind"] not in ("none", "letter"),
+                      "attachments": [], "comments": [], "entries": []}
+        if submitted and assignment["kind"] == "upload":
+            if rng.random() < 0.3:
+                submission["attachments"].append(self.fixture.file("project.zip", 0, zip_of=["main.py", "util.py"]))
+            else:
+                submission["attachments"].append(self.fixture.file("main.py", 400))
+        if submitted and assignment["kind"] == "discussion":
+            for e in range(rng.randint(1, 3)):
+                # the first entry is a post and the rest are replies to it
+                submission["entries"].append({"id": self.fixture.next_id(), "user_id": student["id"],
+                                              "message": f"<p>{sentence(rng, rng.randint(3, 40))}</p>",
+                                              "created_at": submitted_at + datetime.timedelta(minutes=e),
+                                              "reply": e > 0})
+        for c in range(rng.randint(0, 2)):
+            submission["comments"].append({"id": self.fixture.next_id(), "comment": sentence(rng, 12),
+                                           "attachments": [], "created_at": assignment["due_at"]})
+        return submission
+
+    def add_assignment(self, name, kind, description=""):
+        """ add an assignment created through the api along with an empty submission for each student """
+        rng = random.Random(name)
+        group = self.assignment_groups[1 if kind == "quiz" else 0]
+        a = {"id": self.fixture.next_id(), "name": name, "group": group, "kind": kind, "points_possible": 10,
+             "due_at": self.start + datetime.timedelta(days=7 * (len(self.assignments) + 1)), "description": description}
+        self.submissions[a["id"]] = [self.make_submission(rng, a, s) for s in self.students]
+        self.submission_by_user[a["id"]] = {s["user_id"]: s for s in self.submissions[a["id"]]}
+        self.assignments.append(a)
+        self._grades.clear()
+        return a
+
+    def group_grade(self, group, student):
+        """ the percentage a student has in an assignment group, None if nothing is graded """
+        key = (group["id"], student["id"])
+        if key not in self._grades:
+            scores = [(s["score"], a["points_possible"]) for a in self.assignments if a["group"] is group
+                      for s in [self.submission_by_user[a["id"]][student["id"]]] if s["score"] is not None]
+            points = sum(p for _, p in scores)
+            self._grades[key] = round(sum(x for x, _ in scores) / points * 100, 2) if points else None
+        return self._grades[key]
+
+    def enrollment_grades(self, student):
+        total = sum(self.group_grade(g, student) * g["group_weight"] / 100 for g in self.assignment_groups
+                    if g["group_weight"] and self.group_grade(g, student) is not None)
+        return round(total, 2)
+
+
+class Fixture:
+    """ the whole fake tenant: a teacher, an active course, and a finished one """
+
+    def __init__(self, students=50, seed=146):
+        self._next_id = 1000
+        self._id_lock = threading.Lock()
+        self.users = {}
+        self.files = {}
+        self.teacher = {"id": 1, "name": "Pat Teacher", "sortable_name": "Teacher, Pat"}
+        self.courses = [
+            FakeCourse(self, "SP26: CS146-01 Data Structures and Algorithms", now - datetime.timedelta(days=30),
+                       now + datetime.timedelta(days=60), students, seed),
+            FakeCourse(self, "FA25: CS146-02 Data Structures and Algorithms", now - datetime.timedelta(days=300),
+                       now - datetime.timedelta(days=180), students, seed + 1),
+        ]
+        self.grades = {}
+
+    def next_id(self):
+        with self._id_lock:
+            self._next_id += 1
+            return self._next_id
+
+    def user(self, i):
+        if i not in self.users:
+            first, last = first_names[i % len(first_names)], last_names[(i // len(first_names)) % len(last_names)]
+            name = f"{first} {last} {i:04}"
+            self.users[i] = {"id": 100000 + i, "name": name, "sortable_name": f"{last} {i:04}, {first}",
+                             "short_name": name, "sis_user_id": f"{10000000 + i}", "login_id": f"s{i:04}",
+                             "email": f"{first.lower()}.{i:04}@example.edu"}
+        return self.users[i]
+
+    def file(self, name, size, zip_of=None):
+        id = self.next_id()
+        if zip_of:
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, "w") as zf:
+                for member in zip_of:
+                    zf.writestr(member, f"# {member} for {id}\nprint({id})\n")
+            content = buffer.getvalue()
+        else:
+            content = (f"# {name} {id}\n".encode() * (size // 16 + 1))[:max(size, 1)]
+        self.files[id] = {"id": id, "display_name": name, "filename": name, "size": len(content), "content": content,
+                          "updated_at": iso(now)}
+        return self.files[id]
+
+    def course(self, id):
+        return next(c for c in self.courses if c.id == int(id))
+
+
+class CostBucket:
+    """ the canvas rate limit: a leaky bucket with a pre-flight penalty for requests in flight """
+
+    def __init__(self, capacity=700.0, leak_rate=10.0, penalty=50.0):
+        self.capacity = capacity
+        self.leak_rate = leak_rate
+        self.penalty = penalty
+        self.used = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _leak(self):
+        t = time.monotonic()
+        self.used = max(0.0, self.used - (t - self.updated) * self.leak_rate)
+        self.updated = t
+
+    def start(self):
+        with self.lock:
+            self._leak()
+            if self.used + self.penalty > self.capacity:
+                return False
+            self.used += self.penalty
+            return True
+
+    def finish(self, cost):
+        with self.lock:
+            self._leak()
+            self.used += cost - self.penalty
+            return self.capacity - self.used
+
+
+# --- a very small graphql evaluator. just enough of the language for the queries canvas_tool sends ---
+
+token_re = re.compile(r'\s*(?:(\.\.\.)|([{}()\[\]:!$@=,])|("(?:[^"\\]|\\.)*")|(-?\d+(?:\.\d+)?)|(\w+))')
+
+
+def tokenize(text):
+    tokens = []
+    text = re.sub(r"#[^\n]*", "", text)
+    pos = 0
+    while pos < len(text):
+        m = token_re.match(text, pos)
+        if not m or m.end() == pos:
+            if text[pos:].strip():
+                raise ValueError(f"cannot parse graphql at {text[pos:pos + 20]}")
+            break
+        pos = m.end()
+        tokens.append(next(g for g in m.groups() if g is not None))
+    return [t for t in tokens if t != ","]
+
+
+class Parser:
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.tokens[self.pos]
+        if expected and token != expected:
+            raise ValueError(f"expected {expected} got {token}")
+        self.pos += 1
+        return token
+
+    def document(self):
+        if self.peek() in ("query", "mutation"):
+            self.take()
+            if self.peek() not in ("(", "{"):
+                self.take()
+            if self.peek() == "(":
+                while self.take() != ")":
+                    pass
+        return self.selection_set()
+
+    def value(self):
+        token = self.take()
+        if token == "$":
+            return ("var", self.take())
+        if token == "[":
+            values = []
+            while self.peek() != "]":
+                values.append(self.value())
+            self.take("]")
+            return values
+        if token == "{":
+            fields = {}
+            while self.peek() != "}":
+                name = self.take()
+                self.take(":")
+                fields[name] = self.value()
+            self.take("}")
+            return fields
+        if token.startswith('"'):
+            return json.loads(token)
+        if re.match(r"-?\d", token):
+            return float(token) if "." in token else int(token)
+        return {"true": True, "false": False, "null": None}.get(token, token)
+
+    def arguments(self):
+        args = {}
+        if self.peek() == "(":
+            self.take()
+            while self.peek() != ")":
+                name = self.take()
+                self.take(":")
+                args[name] = self.value()
+            self.take(")")
+        return args
+
+    def directives(self):
+        directives = []
+        while self.peek() == "@":
+            self.take()
+            directives.append((self.take(), self.arguments()))
+        return directives
+
+    def selection_set(self):
+        selections = []
+        self.take("{")
+        while self.peek() != "}":
+            if self.peek() == "...":
+                self.take()
+                self.take("on")
+                type_name = self.take()
+                selections.append(("fragment", type_name, self.directives(), self.selection_set()))
+                continue
+            name = self.take()
+            alias = name
+            if self.peek() == ":":
+                self.take()
+                name = self.take()
+            args = self.arguments()
+            directives = self.directives()
+            children = self.selection_set() if self.peek() == "{" else None
+            selections.append(("field", alias, name, args, directives, children))
+        self.take("}")
+        return selections
+
+
+def resolve_args(args, variables):
+    def value(v):
+        if isinstance(v, tuple) and v[0] == "var":
+            return variables.get(v[1])
+        if isinstance(v, list):
+            return [value(i) for i in v]
+        if isinstance(v, dict):
+            return {k: value(i) for k, i in v.items()}
+        return v
+
+    return {k: value(v) for k, v in args.items()}
+
+
+def included(directives, variables):
+    for name, args in directives:
+        condition = resolve_args(args, variables).get("if")
+        if (name == "include" and not condition) or (name == "skip" and condition):
+            return False
+    return True
+
+
+def submission_updated_at(course, submission):
+    return submission["submitted_at"] or course.start
+
+
+def updated_since(course, submission, since):
+    return not since or iso(submission_updated_at(course, submission)) >= since
+
+
+class Mapped:
+    """ a list of graphql views that are only built for the slice a page needs """
+
+    def __init__(self, items, view):
+        self.items = items
+        self.view = view
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        return [self.view(i) for i in self.items[index]]
+
+
+def connection(items, args):
+    start = int(base64.b64decode(args["after"]).decode()) if args.get("after") else 0
+    first = min(int(args.get("first") or 20), 100)
+    return {"__typename": "Connection", "nodes": items[start:start + first],
+            "edges": [{"node": n, "cursor": base64.b64encode(str(start + i + 1).encode()).decode()}
+                      for i, n in enumerate(items[start:start + first])],
+            "pageInfo": {"hasNextPage": start + first < len(items),
+                         "endCursor": base64.b64encode(str(start + first).encode()).decode()}}
+
+
+def execute(obj, selections, variables):
+    result = {}
+    for selection in selections:
+        if selection[0] == "fragment":
+            _, type_name, directives, children = selection
+            if obj.get("__typename") == type_name and included(directives, variables):
+                result.update(execute(obj, children, variables))
+            continue
+        _, alias, name, args, directives, children = selection
+        if not included(directives, variables):
+            continue
+        value = obj.get(name)
+        if callable(value):
+            value = value(resolve_args(args, variables))
+        if name.endswith("Connection") and isinstance(value, (list, Mapped)):
+            value = connection(value, resolve_args(args, variables))
+        result[alias] = complete(value, children, variables)
+    return result
+
+
+def complete(value, children, variables):
+    if children is None or value is None:
+        return value
+    if isinstance(value, list):
+        return [complete(v, children, variables) for v in value]
+    return execute(value, children, variables)
+
+
+class Graph:
+    """ graphql views of the fixture data. connections are lists that execute() paginates """
+
+    def __init__(self, fixture):
+        self.fixture = fixture
+
+    def user(self, user):
+        return {"__typename": "User", "_id": str(user["id"]), "id": global_id("User", user["id"]),
+                "name": user["name"], "sortableName": user["sortable_name"], "email": user["email"],
+                "sisId": user["sis_user_id"]}
+
+    def enrollment(self, course, student):
+        score = course.enrollment_grades(student)
+        return {"__typename": "Enrollment", "_id": str(student["id"]), "user": self.user(student),
+                "type": "StudentEnrollment", "state": "active",
+                "grades": {"currentScore": score, "finalScore": score}}
+
+    def course(self, course):
+        return {"__typename": "Course", "_id": str(course.id), "id": global_id("Course", course.id),
+                "name": course.name,
+                "enrollmentsConnection": lambda args: Mapped(course.students, lambda s: self.enrollment(course, s)),
+                "assignmentGroupsConnection": lambda args: Mapped(course.assignment_groups,
+                                                                  lambda g: self.assignment_group(course, g)),
+                "assignmentsConnection": lambda args: Mapped(course.assignments, lambda a: self.assignment(course, a)),
+                "submissionsConnection": lambda args: Mapped(
+                    [s for a in course.assignments for s in course.submissions[a["id"]]],
+                    lambda s: self.submission(course, s))}
+
+    def assignment_group(self, course, group):
+        def grade(student):
+            score = course.group_grade(group, student)
+            return {"currentScore": score, "finalScore": score, "enrollment": self.enrollment(course, student)}
+
+        return {"__typename": "AssignmentGroup", "_id": str(group["id"]), "id": global_id("AssignmentGroup", group["id"]),
+                "name": group["name"], "groupWeight": group["group_weight"],
+                "gradesConnection": lambda args: Mapped(course.students, grade),
+                "assignmentsConnection": lambda args: Mapped([a for a in course.assignments if a["group"] is group],
+                                                             lambda a: self.assignment(course, a))}
+
+    def assignment(self, course, assignment):
+        return {"__typename": "Assignment", "_id": str(assignment["id"]), "id": global_id("Assignment", assignment["id"]),
+                "name": assignment["name"], "pointsPossible": assignment["points_possible"],
+                "dueAt": iso(assignment["due_at"]),
+                "submissionsConnection": lambda args: Mapped(
+                    [s for s in course.submissions[assignment["id"]]
+                     if updated_since(course, s, (args.get("filter") or {}).get("updatedSince"))],
+                    lambda s: self.submission(course, s))}
+
+    def attachment(self, file):
+        return {"__typename": "File", "_id": str(file["id"]), "displayName": file["display_name"],
+                "url": f"{self.fixture.base_url}/files/{file['id']}/download?verifier=fake", "size": file["size"]}
+
+    def submission(self, course, submission):
+        user = course.student_by_id[submission["user_id"]]
+        return {"__typename": "Submission", "_id": str(submission["id"]), "id": global_id("Submission", submission["id"]),
+                "score": submission["score"], "grade": submission["grade"], "user": self.user(user),
+                "assignment": {"_id": str(submission["assignment"]["id"]), "name": submission["assignment"]["name"]},
+                "submittedAt": iso(submission["submitted_at"]) if submission["submitted_at"] else None,
+                "updatedAt": iso(submission_updated_at(course, submission)),
+                "attempt": submission["attempt"], "late": submission["late"], "missing": submission["missing"],
+                "state": "submitted" if submission["submitted_at"] else "unsubmitted",
+                "attachments": [self.attachment(f) for f in submission["attachments"]],
+                "commentsConnection": lambda args: [
+                    {"__typename": "SubmissionComment", "_id": str(c["id"]), "comment": c["comment"],
+                     "createdAt": iso(c["created_at"]), "attachments": [self.attachment(f) for f in c["attachments"]]}
+                    for c in submission["comments"]]}
+
+    def find(self, type_name, id):
+        id = legacy_id(id)
+        for course in self.fixture.courses:
+            if type_name == "Course" and course.id == id:
+                return self.course(course)
+            for group in course.assignment_groups:
+                if type_name == "AssignmentGroup" and group["id"] == id:
+                    return self.assignment_group(course, group)
+            for a in course.assignments:
+                if type_name == "Assignment" and a["id"] == id:
+                    return self.assignment(course, a)
+                if type_name == "Submission":
+                    for s in course.submissions[a["id"]]:
+                        if s["id"] == id:
+                            return self.submission(course, s)
+        return None
+
+    def root(self):
+        def node(args):
+            type_name = base64.b64decode(args["id"]).decode().rsplit("-", 1)[0]
+            return self.find(type_name, args["id"])
+
+        return {"course": lambda args: self.find("Course", args["id"]),
+                "assignmentGroup": lambda args: self.find("AssignmentGroup", args["id"]),
+                "assignment": lambda args: self.find("Assignment", args["id"]),
+                "node": node, "legacyNode": lambda args: self.find(args["type"], args["_id"])}
+
+    def query(self, query, variables):
+        return {"data": execute(self.root(), Parser(query).document(), variables or {})}
+
+
+# --- the REST side ---
+
+def rest_course(course):
+    return {"id": course.id, "name": course.name, "course_code": course.name.split()[1],
+            "start_at": iso(course.start), "end_at": iso(course.end), "workflow_state": "available"}
+
+
+def rest_user(user):
+    return {k: user.get(k) for k in ("id", "name", "sortable_name", "short_name", "sis_user_id", "login_id", "email")}
+
+
+def rest_file(fixture, file, folder_id=None):
+    return {"id": file["id"], "display_name": file["display_name"], "filename": file["filename"], "size": file["size"],
+            "folder_id": folder_id, "updated_at": file["updated_at"],
+            "url": f"{fixture.base_url}/files/{file['id']}/download?verifier=fake", "content-type": "text/plain"}
+
+
+def rest_assignment(course, a):
+    topic = next(({"id": d["id"], "title": d["title"], "group_category_id": d.get("group_category_id")}
+                  for d in course.discussions if d["assignment"] is a), None)
+    return {"discussion_topic": topic, "id": a["id"], "name": a["name"], "course_id": course.id, "due_at": iso(a["due_at"]),
+            "html_url": f"/courses/{course.id}/assignments/{a['id']}", "description": a["description"],
+            "points_possible": a["points_possible"], "assignment_group_id": a["group"]["id"],
+            "grading_type": "letter_grade" if a["kind"] == "letter" else "points",
+            "submission_types": ["discussion_topic"] if a["kind"] == "discussion" else ["online_upload"]}
+
+
+def rest_submission(fixture, course, s):
+    rc = {"id": s["id"], "user_id": s["user_id"], "assignment_id": s["assignment"]["id"], "course_id": course.id,
+          "score": s["score"], "grade": None if s["grade"] is None else str(s["grade"]),
+          "submitted_at": iso(s["submitted_at"]) if s["submitted_at"] else None, "attempt": s["attempt"],
+          "late": s["late"], "missing": s["missing"],
+          "workflow_state": "submitted" if s["submitted_at"] else "unsubmitted",
+          "attachments": [rest_file(fixture, f) for f in s["attachments"]]}
+    if s["assignment"]["kind"] == "discussion":
+        rc["discussion_entries"] = [{"id": e["id"], "user_id": e["user_id"], "message": e["message"],
+                                     "created_at": iso(e["created_at"])} for e in s["entries"]]
+    return rc
+
+
+def quiz_events(course, quiz, submission):
+    rng = random.Random(submission["id"])
+    events = []
+    when = course.start
+    for question in quiz["questions"]:
+        answer = ""
+        for _ in range(rng.randint(1, 4)):
+            answer = (answer + " " + sentence(rng, rng.randint(1, 6))).strip()
+            when += datetime.timedelta(seconds=rng.randint(5, 90))
+            events.append({"id": len(events) + 1, "event_type": "question_answered", "created_at": iso(when),
+                           "event_data": [{"quiz_question_id": str(question["id"]), "answer": f"<p>{answer}</p>"}]})
+        events.append({"id": len(events) + 1, "event_type": "page_blurred", "created_at": iso(when), "event_data": None})
+    return events
+
+
+class Routes:
+    def __init__(self, fixture):
+        self.fixture = fixture
+        self.graph = Graph(fixture)
+        self.batches = []
+        # progress ids of running jobs and when they finish
+        self.jobs = {}
+        self.routes = []
+        for method, pattern, handler in [
+            ("GET", r"users/self", self.self_user),
+            ("GET", r"courses", self.courses),
+            ("GET", r"courses/(\d+)", self.course),
+            ("GET", r"courses/(\d+)/(?:search_)?users", self.users),
+            ("GET", r"courses/(\d+)/users/(\d+)", self.user),
+            ("GET", r"courses/(\d+)/enrollments", self.enrollments),
+            ("GET", r"courses/(\d+)/analytics/assignments", self.assignment_data),
+            ("GET", r"courses/(\d+)/assignments", self.assignments),
+            ("GET", r"courses/(\d+)/assignments/(\d+)", self.assignment),
+            ("GET", r"courses/(\d+)/assignments/(\d+)/submissions", self.submissions),
+            ("PUT", r"courses/(\d+)/assignments/(\d+)/submissions/(\d+)", self.edit_submission),
+            ("GET", r"courses/(\d+)/students/submissions", self.student_submissions),
+            ("POST", r"courses/(\d+)/assignments/(\d+)/submissions/update_grades", self.update_grades),
+            ("GET", r"courses/(\d+)/discussion_topics", self.discussions),
+            ("GET", r"courses/(\d+)/discussion_topics/(\d+)/view", self.discussion_view),
+            ("GET", r"progress/(\d+)", self.progress),
+            ("POST", r"courses/(\d+)/content_migrations", self.create_content_migration),
+            ("GET", r"courses/(\d+)/content_migrations/(\d+)/migration_issues/?", self.migration_issues),
+            ("GET", r"courses/(\d+)/files", self.course_files),
+            ("GET", r"courses/(\d+)/pages", self.pages),
+            ("GET", r"courses/(\d+)/folders", self.folders),
+            ("GET", r"folders/(\d+)/files", self.folder_files),
+            ("GET", r"courses/(\d+)/modules", self.modules),
+            ("GET", r"courses/(\d+)/modules/(\d+)/items", self.module_items),
+            ("GET", r"courses/(\d+)/quizzes", self.quizzes),
+            ("GET", r"courses/(\d+)/quizzes/(\d+)/questions", self.questions),
+            ("GET", r"courses/(\d+)/quizzes/(\d+)/groups/(\d+)", self.quiz_group),
+            ("GET", r"courses/(\d+)/quizzes/(\d+)/submissions", self.quiz_submissions),
+            ("PUT", r"courses/(\d+)/quizzes/(\d+)/submissions/(\d+)", self.update_quiz_submission),
+            ("GET", r"courses/(\d+)/quizzes/(\d+)/submissions/(\d+)/events", self.quiz_submission_events),
+            ("POST", r"courses/(\d+)/assignments", self.create_assignment),
+            ("POST", r"courses/(\d+)/quizzes", self.create_quiz),
+            ("POST", r"courses/(\d+)/discussion_topics", self.create_discussion),
+            ("POST", r"courses/(\d+)/pages", self.create_page),
+            ("POST", r"courses/(\d+)/modules", self.create_module),
+            ("POST", r"courses/(\d+)/modules/(\d+)/items", self.create_module_item),
+            ("POST", r"conversations", self.create_conversation),
+            ("GET", r"conversations/batches", self.conversation_batches),
+        ]:
+            self.routes.append((method, re.compile(f"/api/v1/{pattern}"), handler))
+
+    def match(self, method, path):
+        for route_method, pattern, handler in self.routes:
+            m = pattern.fullmatch(path)
+            if m and route_method == method:
+                return pattern.pattern, handler, [int(g) for g in m.groups()]
+        return None, None, None
+
+    def self_user(self, params):
+        return self.fixture.teacher
+
+    def courses(self, params):
+        return [rest_course(c) for c in self.fixture.courses]
+
+    def course(self, params, course_id):
+        return rest_course(self.fixture.course(course_id))
+
+    def users(self, params, course_id):
+        term = params.get("search_term", [""])[0].lower()
+        types = params.get("enrollment_type[]")
+        users = [(u, "StudentEnrollment") for u in self.fixture.course(course_id).students]
+        if not types or "teacher" in types:
+            users.append((self.fixture.teacher, "TeacherEnrollment"))
+        if types and "student" not in types:
+            users = [(u, t) for u, t in users if t != "StudentEnrollment"]
+        return [{**rest_user(u), "enrollments": [{"type": t, "enrollment_state": "active"}]}
+                for u, t in users if term in u["name"].lower()]
+
+    def user(self, params, course_id, user_id):
+        return rest_user(self.fixture.course(course_id).student_by_id[user_id])
+
+    def enrollments(self, params, course_id):
+        course = self.fixture.course(course_id)
+        rc = []
+        for s in course.students:
+            score = course.enrollment_grades(s)
+            rc.append({"id": s["id"] + 1, "user_id": s["id"], "course_id": course_id, "type": "StudentEnrollment",
+                       "enrollment_state": "active", "user": rest_user(s),
+                       "grades": {"current_score": score, "final_score": score}})
+        return rc
+
+    def assignment_data(self, params, course_id):
+        return [{"assignment_id": a["id"], "title": a["name"], "points_possible": a["points_possible"]}
+                for a in self.fixture.course(course_id).assignments]
+
+    def assignments(self, params, course_id):
+        course = self.fixture.course(course_id)
+        return [rest_assignment(course, a) for a in course.assignments]
+
+    def assignment(self, params, course_id, assignment_id):
+        course = self.fixture.course(course_id)
+        return rest_assignment(course, next(a for a in course.assignments if a["id"] == assignment_id))
+
+    def submissions(self, params, course_id, assignment_id):
+        course = self.fixture.course(course_id)
+        return [rest_submission(self.fixture, course, s) for s in course.submissions[assignment_id]]
+
+    def student_submissions(self, params, course_id):
+        course = self.fixture.course(course_id)
+        student_ids = params.get("student_ids[]", ["all"])
+        students = course.students if "all" in student_ids else [course.student_by_id[int(i)] for i in student_ids]
+        assignment_ids = {int(i) for i in params.get("assignment_ids[]", [])}
+        assignments = [a for a in course.assignments if not assignment_ids or a["id"] in assignment_ids]
+
+        def submission(student, assignment):
+            return rest_submission(self.fixture, course, course.submission_by_user[assignment["id"]][student["id"]])
+
+        if params.get("grouped", ["false"])[0].lower() in ("true", "1"):
+            return Mapped(students, lambda s: {"user_id": s["id"], "section_id": course.id + 1,
+                                               "submissions": [submission(s, a) for a in assignments]})
+        return Mapped([(s, a) for s in students for a in assignments], lambda pair: submission(*pair))
+
+    def edit_submission(self, params, course_id, assignment_id, user_id):
+        course = self.fixture.course(course_id)
+        s = course.submission_by_user[assignment_id][user_id]
+        grade = params.get("submission[posted_grade]", [None])[0]
+        if grade is not None:
+            s["grade"] = grade
+        return rest_submission(self.fixture, course, s)
+
+    def update_grades(self, params, course_id, assignment_id):
+        course = self.fixture.course(course_id)
+        for key, values in params.items():
+            m = re.fullmatch(r"grade_data\[(\d+)\]\[posted_grade\]", key)
+            if m:
+                course.submission_by_user[assignment_id][int(m.group(1))]["grade"] = values[0]
+        return self.progress(params, self.fixture.next_id())
+
+    def progress(self, params, progress_id):
+        completion = 100
+        if progress_id in self.jobs:
+            start, end = self.jobs[progress_id]
+            completion = min(100, int(100 * (time.time() - start) / (end - start)))
+        return {"id": progress_id, "workflow_state": "completed" if completion == 100 else "running",
+                "completion": completion, "url": f"{self.fixture.base_url}/api/v1/progress/{progress_id}"}
+
+    def create_content_migration(self, params, course_id):
+        course = self.fixture.course(course_id)
+        source = self.fixture.course(params["settings[source_course_id]"][0])
+        selected = {key[len("select["):-len("][]")]: {int(v) for v in values} for key, values in params.items()
+                    if key.startswith("select[")}
+
+        def chosen(key, items, id_key="id"):
+            return [i for i in items if not selected or i[id_key] in selected.get(key, ())]
+
+        # the copy happens right away, but the progress takes a moment to finish like a real migration
+        for a in chosen("assignments", source.assignments):
+            course.add_assignment(a["name"], "none", a["description"])
+        for d in chosen("discussion_topics", source.discussions):
+            course.discussions.append({**d, "id": self.fixture.next_id(), "assignment": None})
+        for p in chosen("pages", source.pages, "page_id"):
+            if not any(existing["url"] == p["url"] for existing in course.pages):
+                course.pages.append({**p, "page_id": self.fixture.next_id()})
+        folders = {f["full_name"]: f for f in course.folders}
+        for folder in source.folders:
+            files = chosen("files", source.files[folder["id"]])
+            if files and folder["full_name"] not in folders:
+                folders[folder["full_name"]] = {**folder, "id": self.fixture.next_id()}
+                course.folders.append(folders[folder["full_name"]])
+            course.files[folders.get(folder["full_name"], folder)["id"]].extend(files)
+        for m in chosen("modules", source.modules):
+            course.modules.append({"id": self.fixture.next_id(), "name": m["name"], "prerequisite_module_ids": [],
+                                   "items": [{**i, "id": self.fixture.next_id()} for i in m["items"]]})
+
+        progress_id = self.fixture.next_id()
+        self.jobs[progress_id] = (time.time(), time.time() + 1.5)
+        return {"id": self.fixture.next_id(), "migration_type": "course_copy_importer", "workflow_state": "running",
+                "progress_url": f"{self.fixture.base_url}/api/v1/progress/{progress_id}"}
+
+    def migration_issues(self, params, course_id, migration_id):
+        return [{"id": self.fixture.next_id(), "issue_type": "warning", "workflow_state": "active",
+                 "description": "external tool links were copied but the tools need to be configured"}]
+
+    def course_files(self, params, course_id):
+        course = self.fixture.course(course_id)
+        return [rest_file(self.fixture, f, folder_id) for folder_id, files in course.files.items() for f in files]
+
+    def discussion_view(self, params, course_id, topic_id):
+        course = self.fixture.course(course_id)
+        topic = next(d for d in course.discussions if d["id"] == topic_id)
+        view = []
+        participants = {}
+        for s in course.submissions[topic["assignment"]["id"]]:
+            post = None
+            for e in s["entries"]:
+                entry = {"id": e["id"], "user_id": e["user_id"], "message": e["message"],
+                         "created_at": iso(e["created_at"]), "parent_id": post["id"] if e["reply"] else None,
+                         "replies": []}
+                participants[e["user_id"]] = course.student_by_id[e["user_id"]]
+                if e["reply"]:
+                    post["replies"].append(entry)
+                else:
+                    post = entry
+                    view.append(entry)
+        return {"participants": [{"id": u["id"], "display_name": u["name"]} for u in participants.values()],
+                "unread_entries": [], "forced_entries": [], "entry_ratings": {}, "view": view, "new_entries": []}
+
+    def discussions(self, params, course_id):
+        course = self.fixture.course(course_id)
+        if params.get("only_announcements") == ["True"]:
+            return []
+        return [{"id": d["id"], "title": d["title"], "message": d["message"], "discussion_type": "threaded",
+                 "html_url": f"/courses/{course_id}/discussion_topics/{d['id']}",
+                 "updated_at": d.get("updated_at", iso(course.start)),
+                 "assignment_id": d["assignment"]["id"] if d["assignment"] else None} for d in course.discussions]
+
+    def pages(self, params, course_id):
+        return [{**p, "html_url": f"/courses/{course_id}/pages/{p['url']}"} for p in self.fixture.course(course_id).pages]
+
+    def folders(self, params, course_id):
+        course = self.fixture.course(course_id)
+        return [{**f, "files_count": len(course.files[f["id"]])} for f in course.folders]
+
+    def folder_files(self, params, folder_id):
+        course = next(c for c in self.fixture.courses if folder_id in c.files)
+        return [rest_file(self.fixture, f, folder_id) for f in course.files[folder_id]]
+
+    # like canvas, include[]=items leaves out the items of modules with more than this many
+    inline_items_limit = 100
+
+    def modules(self, params, course_id):
+        rc = []
+        for i, m in enumerate(self.fixture.course(course_id).modules):
+            module = {"id": m["id"], "name": m["name"], "position": i + 1, "unlock_at": None, "published": True,
+                      "require_sequential_progress": False, "prerequisite_module_ids": m["prerequisite_module_ids"],
+                      "items_count": len(m["items"])}
+            if "items" in params.get("include[]", []) and len(m["items"]) <= self.inline_items_limit:
+                module["items"] = self.module_items(params, course_id, m["id"])
+            rc.append(module)
+        return rc
+
+    def module_items(self, params, course_id, module_id):
+        module = next(m for m in self.fixture.course(course_id).modules if m["id"] == module_id)
+        return [{"indent": 0, "published": True, "position": i + 1, "module_id": module_id, **item}
+                for i, item in enumerate(module["items"])]
+
+    def quiz(self, course_id, quiz_id):
+        course = self.fixture.course(course_id)
+        return course, next(q for q in course.quizzes if q["id"] == quiz_id)
+
+    def quizzes(self, params, course_id):
+        return [{"id": q["id"], "title": q["title"], "description": q["description"], "quiz_type": "assignment",
+                 "assignment_id": q["assignment"]["id"], "html_url": f"/courses/{course_id}/quizzes/{q['id']}"}
+                for q in self.fixture.course(course_id).quizzes]
+
+    def questions(self, params, course_id, quiz_id):
+        course, quiz = self.quiz(course_id, quiz_id)
+        return [{**q, "quiz_id": quiz_id} for q in quiz["questions"]]
+
+    def quiz_group(self, params, course_id, quiz_id, group_id):
+        course, quiz = self.quiz(course_id, quiz_id)
+        return {**next(g for g in quiz["groups"] if g["id"] == group_id), "quiz_id": quiz_id}
+
+    def quiz_submissions(self, params, course_id, quiz_id):
+        course, quiz = self.quiz(course_id, quiz_id)
+        return {"quiz_submissions": [{**s, "quiz_id": quiz_id} for s in quiz["submissions"]]}
+
+    def update_quiz_submission(self, params, course_id, quiz_id, submission_id):
+        course, quiz = self.quiz(course_id, quiz_id)
+        s = next(s for s in quiz["submissions"] if s["id"] == submission_id)
+        for key, value in params.items():
+            if key.endswith("[fudge_points]"):
+                s["fudge_points"] = float(value[0])
+        return {"quiz_submissions": [{**s, "quiz_id": quiz_id}]}
+
+    def quiz_submission_events(self, params, course_id, quiz_id, submission_id):
+        course, quiz = self.quiz(course_id, quiz_id)
+        s = next(s for s in quiz["submissions"] if s["id"] == submission_id)
+        return {"quiz_submission_events": quiz_events(course, quiz, s)}
+
+    def create_assignment(self, params, course_id):
+        course = self.fixture.course(course_id)
+        a = course.add_assignment(params["assignment[name]"][0], "none", params.get("assignment[description]", [""])[0])
+        return rest_assignment(course, a)
+
+    def create_quiz(self, params, course_id):
+        course = self.fixture.course(course_id)
+        title = params["quiz[title]"][0]
+        quiz = {"id": self.fixture.next_id(), "title": title, "description": params.get("quiz[description]", [""])[0],
+                "assignment": course.add_assignment(title, "quiz"), "groups": [], "questions": [], "submissions": []}
+        course.quizzes.append(quiz)
+        return {"id": quiz["id"], "title": title, "description": quiz["description"], "quiz_type": "assignment",
+                "assignment_id": quiz["assignment"]["id"], "html_url": f"/courses/{course_id}/quizzes/{quiz['id']}"}
+
+    def create_discussion(self, params, course_id):
+        course = self.fixture.course(course_id)
+        d = {"id": self.fixture.next_id(), "title": params["title"][0], "message": params.get("message", [""])[0],
+             "assignment": None, "updated_at": iso(datetime.datetime.now(datetime.timezone.utc))}
+        course.discussions.append(d)
+        return {"id": d["id"], "title": d["title"], "message": d["message"], "discussion_type": "threaded",
+                "html_url": f"/courses/{course_id}/discussion_topics/{d['id']}", "assignment_id": None}
+
+    def create_page(self, params, course_id):
+        course = self.fixture.course(course_id)
+        title = params["wiki_page[title]"][0]
+        url = re.sub(r"[^a-z0-9]+", "-", title.lower()).strip("-")
+        if any(p["url"] == url for p in course.pages):
+            url += f"-{len(course.pages)}"
+        page = {"page_id": self.fixture.next_id(), "url": url, "title": title,
+                "body": params.get("wiki_page[body]", [""])[0], "published": False, "front_page": False,
+                "publish_at": None, "updated_at": iso(datetime.datetime.now(datetime.timezone.utc))}
+        course.pages.append(page)
+        return {**page, "html_url": f"/courses/{course_id}/pages/{url}"}
+
+    def create_module(self, params, course_id):
+        course = self.fixture.course(course_id)
+        module = {"id": self.fixture.next_id(), "name": params["module[name]"][0], "items": [],
+                  "prerequisite_module_ids": []}
+        course.modules.append(module)
+        return {"id": module["id"], "name": module["name"], "position": len(course.modules), "unlock_at": None,
+                "published": params.get("module[published]", ["True"])[0].lower() == "true",
+                "require_sequential_progress": False, "prerequisite_module_ids": [], "items_count": 0}
+
+    def create_module_item(self, params, course_id, module_id):
+        module = next(m for m in self.fixture.course(course_id).modules if m["id"] == module_id)
+        item = {"id": self.fixture.next_id()}
+        for key in ("title", "type", "content_id", "page_url", "external_url", "indent", "new_tab"):
+            if f"module_item[{key}]" in params:
+                value = params[f"module_item[{key}]"][0]
+                item[key] = int(value) if key in ("content_id", "indent") else value.lower() == "true" \
+                    if key == "new_tab" else value
+        module["items"].append(item)
+        return {"indent": 0, "published": True, "position": len(module["items"]), "module_id": module_id, **item}
+
+    def create_conversation(self, params):
+        subject = params.get("subject", [""])[0]
+        if params.get("mode") == ["async"] and len(params.get("recipients[]", [])) > 1:
+            # async bulk messages are sent in the background. like canvas, the batch is only listed once the
+            # job starts, and it doesn't say what its subject is
+            now = time.time()
+            self.batches.append({"id": self.fixture.next_id(), "workflow_state": "sending", "completion": 0.5,
+                                 "recipient_count": len(params["recipients[]"]), "tags": [],
+                                 "message": {"body": params.get("body", [""])[0]},
+                                 "starts_at": now + 0.3, "done_at": now + 1.5})
+            return []
+        return [{"id": self.fixture.next_id(), "subject": subject}]
+
+    def conversation_batches(self, params):
+        now = time.time()
+        self.batches = [b for b in self.batches if b["done_at"] > now]
+        return [{k: v for k, v in b.items() if k not in ("starts_at", "done_at")} for b in self.batches
+                if b["starts_at"] <= now]
+
+
+class FakeCanvasHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=()):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def params(self, url):
+        params = urllib.parse.parse_qs(url.query)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if body and self.headers.get("Content-Type", "").startswith("application/json"):
+            return params, json.loads(body)
+        for key, values in urllib.parse.parse_qs(body.decode()).items():
+            params.setdefault(key, []).extend(values)
+        return params, None
+
+    def handle_any(self, method):
+        server = self.server
+        url = urllib.parse.urlparse(self.path)
+        params, body = self.params(url)
+        if url.path == "/__stats":
+            return self.send_json(200, server.stats_snapshot())
+        if not server.bucket.start():
+            server.count("throttled", url.path)
+            content = b"403 Forbidden (Rate Limit Exceeded)\n"
+            self.send_response(403)
+            self.send_header("X-Rate-Limit-Remaining", "0.0")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        start = time.perf_counter()
+        if server.latency:
+            time.sleep(server.latency)
+        status, payload, raw, route = 200, None, None, url.path
+        try:
+            m = re.fullmatch(r"/files/(\d+)/download", url.path)
+            if m:
+                route = "/files/:id/download"
+                raw = server.fixture.files[int(m.group(1))]["content"]
+            elif url.path == "/api/graphql":
+                route = f"/api/graphql"
+                payload = server.graph.query(body["query"], body.get("variables"))
+            else:
+                route, handler, args = server.routes.match(method, url.path)
+                if not handler:
+                    status, payload = 404, {"errors": [{"message": "The specified resource does not exist."}]}
+                else:
+                    payload = handler(params, *args)
+        except (StopIteration, KeyError):
+            status, payload = 404, {"errors": [{"message": "The specified resource does not exist."}]}
+        headers = []
+        if isinstance(payload, (list, Mapped)) or (isinstance(payload, dict) and len(payload) == 1 and isinstance(
+                next(iter(payload.values())), list) and status == 200 and method == "GET"):
+            payload, headers = self.paginate(url, params, payload)
+        items = len(payload) if isinstance(payload, list) else 1
+        cost = 0.1 + 0.002 * items + (time.perf_counter() - start)
+        remaining = server.bucket.finish(cost)
+        headers += [("X-Request-Cost", f"{cost:.4f}"), ("X-Rate-Limit-Remaining", f"{remaining:.4f}")]
+        server.count("requests", route)
+        if raw is not None:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(raw)))
+            for key, value in headers:
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(raw)
+        else:
+            self.send_json(status, payload, headers)
+
+    def paginate(self, url, params, payload):
+        root = None
+        if isinstance(payload, dict):
+            root, items = next(iter(payload.items()))
+        else:
+            items = payload
+        per_page = min(int(params.get("per_page", ["10"])[0]), 100)
+        page = int(params.get("page", ["1"])[0])
+        chunk = items[(page - 1) * per_page:page * per_page]
+        headers = []
+        links = []
+        if page * per_page < len(items):
+            query = {k: v for k, v in params.items() if k not in ("page", "per_page")}
+            query.update({"page": [str(page + 1)], "per_page": [str(per_page)]})
+            links.append(f'<{self.server.fixture.base_url}{url.path}?{urllib.parse.urlencode(query, doseq=True)}>; rel="next"')
+        if links:
+            headers.append(("Link", ", ".join(links)))
+        return ({root: chunk} if root else chunk), headers
+
+    def do_GET(self):
+        self.handle_any("GET")
+
+    def do_POST(self):
+        self.handle_any("POST")
+
+    def do_PUT(self):
+        self.handle_any("PUT")
+
+
+class FakeCanvasServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fixture, port=0, latency=0.0, bucket=None):
+        super().__init__(("127.0.0.1", port), FakeCanvasHandler)
+        self.fixture = fixture
+        fixture.base_url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.routes = Routes(fixture)
+        self.graph = Graph(fixture)
+        self.batches = []
+        self.latency = latency
+        self.bucket = bucket or CostBucket()
+        self.stats = defaultdict(lambda: defaultdict(int))
+        self.stats_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return self.fixture.base_url
+
+    def count(self, kind, route):
+        with self.stats_lock:
+            self.stats[kind][route] += 1
+
+    def stats_snapshot(self):
+        with self.stats_lock:
+            return {kind: dict(routes) for kind, routes in self.stats.items()}
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats.clear()
+
+    def config_ini(self):
+        return f"[SERVER]\nurl={self.url}\ntoken=fake-token-{'x' * 24}\n[MOSS]\nuserid=0\n"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-canvas", daemon=True).start()
+        return self
+
+
+@click.command()
+@click.option("--students", default=50, show_default=True, help="number of students in each course")
+@click.option("--port", default=8765, show_default=True)
+@click.option("--latency", default=0.0, show_default=True, help="seconds to delay each response")
+@click.option("--seed", default=146, show_default=True)
+def main(students, port, latency, seed):
+    """serve a synthetic canvas course for canvas_tool"""
+    server = FakeCanvasServer(Fixture(students, seed), port, latency)
+    click.echo(f"serving {students} students per course at {server.url}. use this canvas_tool.ini:\n")
+    click.echo(server.config_ini())
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
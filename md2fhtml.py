@@ -1,7 +1,10 @@
 import markdownify
 import markdown
 
+from core import profiled
 
+
+@profiled("html to markdown")
 def html2mdstr(html_str: str):
     """Converts html in string form to markdown"""
     md_str = markdownify.markdownify(html_str)
@@ -14,6 +17,7 @@ def html2mdlist(html_list: list):
     return html2mdstr(html_str)
 
 
+@profiled("markdown to html")
 def md2htmlstr(md_str: str):
     """Converts markdown in string form to html"""
     html_str = markdown.markdown(md_str)
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+from canvasapi import Canvas
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_canvas import Fixture, FakeCanvasServer
+
+
+@pytest.fixture(scope="session")
+def server():
+    server = FakeCanvasServer(Fixture(7)).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def canvas(server):
+    server.reset_stats()
+    return Canvas(server.url, "fake-token")
+
+
+@pytest.fixture
+def course(server):
+    """ the active course of the fixture """
+    return server.fixture.courses[0]
+
+
+def graphql_requests(server):
+    return server.stats_snapshot().get("requests", {}).get("/api/graphql", 0)
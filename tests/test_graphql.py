@@ -0,0 +1,91 @@
+import core
+from core import GraphQLConnection, graphql_batch, graphql_nodes
+from conftest import graphql_requests
+from fake_canvas import global_id
+
+comments = "commentsConnection(first: $first) { nodes { _id } pageInfo { hasNextPage endCursor } }"
+
+submissions_query = """
+query submissions($assignmentid: ID!, $cursor: String, $first: Int) {
+    assignment(id: $assignmentid) {
+        submissionsConnection(first: $first, after: $cursor) {
+            nodes { id _id """ + comments + """ }
+            pageInfo { hasNextPage endCursor }
+        }
+    }
+}
+"""
+
+more_comments = GraphQLConnection(
+    "node(id: $id) { ... on Submission { commentsConnection(first: $first, after: $cursor) { "
+    "nodes { _id } pageInfo { hasNextPage endCursor } } } }", "commentsConnection")
+
+
+def comment_ids(course, assignment):
+    return {str(s["id"]): [str(c["id"]) for c in s["comments"]] for s in course.submissions[assignment["id"]]}
+
+
+def test_graphql_nodes_follows_pages(server, canvas, course, monkeypatch):
+    monkeypatch.setattr(core, "page_size", 3)
+    query = """
+    query enrollments($courseid: ID!, $cursor: String, $first: Int) {
+        course(id: $courseid) {
+            enrollmentsConnection(first: $first, after: $cursor) {
+                nodes { user { _id } }
+                pageInfo { hasNextPage endCursor }
+            }
+        }
+    }
+    """
+    nodes = list(graphql_nodes(canvas, query, "course.enrollmentsConnection", {"courseid": course.id}))
+    assert [n["user"]["_id"] for n in nodes] == [str(s["id"]) for s in course.students]
+    assert graphql_requests(server) == 3
+
+
+def test_graphql_batch_runs_selections_in_one_request(server, canvas, course):
+    first, second = course.assignments[:2]
+    selection = "assignment(id: $id) { _id name }"
+    data = graphql_batch(canvas, {"a": (selection, {"id": ("ID!", first["id"]), "unused": ("Int", 1)}),
+                                  "b": (selection, {"id": ("ID!", second["id"])})})
+    assert data == {"a": {"_id": str(first["id"]), "name": first["name"]},
+                    "b": {"_id": str(second["id"]), "name": second["name"]}}
+    assert graphql_requests(server) == 1
+
+
+def test_nested_connections_are_completed(server, canvas, course, monkeypatch):
+    monkeypatch.setattr(core, "page_size", 1)
+    assignment = next(a for a in course.assignments
+                      if any(len(s["comments"]) > 1 for s in course.submissions[a["id"]]))
+    nodes = list(graphql_nodes(canvas, submissions_query, "assignment.submissionsConnection",
+                               {"assignmentid": assignment["id"]}, nested={"commentsConnection": more_comments}))
+    assert {n["_id"]: [c["_id"] for c in n["commentsConnection"]["nodes"]] for n in nodes} == \
+        comment_ids(course, assignment)
+    assert not any(n["commentsConnection"]["pageInfo"]["hasNextPage"] for n in nodes)
+
+
+def test_connections_nested_two_deep_are_completed(server, canvas, course, monkeypatch):
+    monkeypatch.setattr(core, "page_size", 2)
+    query = """
+    query assignments($courseid: ID!, $cursor: String, $first: Int) {
+        course(id: $courseid) {
+            assignmentsConnection(first: $first, after: $cursor) {
+                nodes { id _id submissionsConnection(first: $first) {
+                    nodes { id _id """ + comments + """ }
+                    pageInfo { hasNextPage endCursor } } }
+                pageInfo { hasNextPage endCursor }
+            }
+        }
+    }
+    """
+    more_submissions = GraphQLConnection(
+        "node(id: $id) { ... on Assignment { submissionsConnection(first: $first, after: $cursor) { "
+        "nodes { id _id " + comments + " } pageInfo { hasNextPage endCursor } } } }", "submissionsConnection",
+        nested={"commentsConnection": more_comments})
+    nodes = list(graphql_nodes(canvas, query, "course.assignmentsConnection", {"courseid": course.id},
+                               nested={"submissionsConnection": more_submissions}))
+    assert [n["_id"] for n in nodes] == [str(a["id"]) for a in course.assignments]
+    for node, assignment in zip(nodes, course.assignments):
+        assert node["id"] == global_id("Assignment", assignment["id"])
+        submissions = node["submissionsConnection"]["nodes"]
+        assert {s["_id"]: [c["_id"] for c in s["commentsConnection"]["nodes"]] for s in submissions} == \
+            comment_ids(course, assignment)